@@ -0,0 +1,95 @@
+import gc
+import os
+import time
+
+"""
+Configuration for gunicorn, which runs the server in production. gunicorn
+loads this file automatically when started from the `server/` folder.
+
+Each worker loads and warms up the models before it takes any requests, so
+no request pays for it.
+"""
+
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "180"))
+"""Seconds a worker can be silent before it is killed and restarted. Scanning
+a shelf can take well over gunicorn's default of 30 seconds."""
+
+graceful_timeout = timeout
+"""Seconds workers have to finish their requests when restarting."""
+
+threads = int(os.getenv("GUNICORN_THREADS", "1"))
+"""Number of threads serving requests in each worker. With an inference pool
+(`INFERENCE_WORKERS`), requests mostly wait on the pool, so a single worker
+with many threads can serve them."""
+
+preload_app = bool(int(os.getenv("PRELOAD_MODELS", "1")))
+"""True if the app and models should be loaded once in the master process
+before forking the workers. The workers then share the memory holding the
+weights instead of each loading their own copy."""
+
+_start = time.time()
+"""When gunicorn started loading this file."""
+
+
+def pre_fork(server, worker) -> None:
+    """Picks the slot of the CPU cores a new worker will run on: the first
+    one not taken by a running worker, so restarted workers reuse the slot
+    of the worker they replace."""
+    taken = {getattr(w, "cpu_slot", None) for w in server.WORKERS.values()}
+    worker.cpu_slot = next(i for i in range(len(taken) + 1) if i not in taken)
+
+
+def worker_exit(server, worker) -> None:
+    """Stops the inference pool of a worker, if started."""
+    from tabby_server import inference
+
+    inference.shutdown()
+
+
+def when_ready(server) -> None:
+    """Loads the models in the master process if preloading, then logs how
+    long the master process took to start."""
+
+    if preload_app:
+        from tabby_server import startup
+
+        startup.load_models()
+
+        # Move every object loaded so far out of the garbage collector's
+        # reach. Otherwise, collecting in a worker touches the objects and
+        # copies the pages they are on.
+        gc.freeze()
+        startup.log_memory_usage("Master")
+
+    server.log.info(f"Master ready in {time.time() - _start:.2f}s")
+
+
+def post_fork(server, worker) -> None:
+    """Loads (if not preloaded) and warms up the models in a new worker, or
+    starts its inference pool, which does so in each of its processes. Then
+    starts the threads running queued scans."""
+    start = time.time()
+
+    from tabby_server import cores, inference, startup
+    from tabby_server.api import books
+
+    # With a pool, its processes split the cores of this worker's slot
+    cores.assign(worker.cpu_slot, server.cfg.workers)
+
+    if inference.WORKERS > 0:
+        # Start before serving, while the worker has a single thread to fork
+        inference.start()
+    else:
+        startup.load_models()
+        worker.notify()  # Don't get killed for loading slowly
+        startup.warm_up()
+
+    # Run scans queued before the worker started, such as by a worker which
+    # died, without waiting for the first new one
+    books.scan_jobs.start()
+
+    server.log.info(
+        f"Worker {worker.pid} ready in {time.time() - start:.2f}s "
+        f"({time.time() - _start:.2f}s since start)"
+    )
+    startup.log_memory_usage(f"Worker {worker.pid}")
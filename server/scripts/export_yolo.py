@@ -0,0 +1,40 @@
+from typing import Literal
+import cyclopts as cy
+from ultralytics import YOLO
+
+from tabby_server.vision import image_labelling
+
+
+app = cy.App()
+
+
+@app.default
+def main(
+    backend: Literal["onnx", "openvino"] = "onnx",
+    /,
+    *,
+    half: bool = False,
+) -> None:
+    """Exports the shelf model so it can be run with another backend. The
+    exported model is saved next to `shelf_yolo.pt`, where the server looks
+    for it when `YOLO_BACKEND` is set.
+
+    Args:
+        backend: Backend to export the model for.
+        half: If given, exports the model in FP16. Only has an effect for
+            OpenVINO.
+    """
+
+    model = YOLO(image_labelling.MODEL_PATHS["torch"], task="segment")
+    path = model.export(
+        format=backend,
+        imgsz=image_labelling.EXPECTED_SIZE,
+        dynamic=True,  # Allow batches of any size
+        half=half,
+    )
+    print(f"Exported model to {path}")
+    print(f"Run the server with YOLO_BACKEND={backend} to use it.")
+
+
+if __name__ == "__main__":
+    app()
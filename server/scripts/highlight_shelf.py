@@ -1,7 +1,7 @@
+import sys
 import cyclopts as cy
 import cv2 as cv
 import numpy as np
-import torch
 
 from tabby_server.vision import image_labelling
 
@@ -22,15 +22,12 @@ def main(
     """
 
     image = cv.imread(str(image_path))
-    h, w, _ = image.shape
-
+    if image is None:
+        print(f"Couldn't read an image from {image_path}.")
+        sys.exit(1)
     print(f"{image.shape=}")
 
-    image_processed = cv.resize(image, (640, 640))
-    image_processed = image_processed / 255.0
-    image_tensor = (
-        torch.from_numpy(image_processed).float().permute(2, 0, 1).unsqueeze(0)
-    )
+    image_tensor, letterbox = image_labelling.letterboxer.letterbox(image)
 
     results = image_labelling.find_books(image_tensor)
 
@@ -42,20 +39,7 @@ def main(
     for result in results:
 
         # scale results to the original image
-        x1 = int(result["box"]["x1"] / 640.0 * w)
-        x2 = int(result["box"]["x2"] / 640.0 * w)
-        y1 = int(result["box"]["y1"] / 640.0 * h)
-        y2 = int(result["box"]["y2"] / 640.0 * h)
-
-        # ensure coords are in range
-        x1 = min(max(x1, 0), w - 1)
-        x2 = min(max(x2, 0), w - 1)
-        y1 = min(max(y1, 0), h - 1)
-        y2 = min(max(y2, 0), h - 1)
-
-        # ensure x1 < x2 and y1 < y2
-        x1, x2 = min(x1, x2), max(x1, x2)
-        y1, y2 = min(y1, y2), max(y1, y2)
+        x1, y1, x2, y2 = letterbox.box_to_image(result["box"])
 
         print(f"Subimage Corners: {(x1, y1)}, {(x2, y2)}")
 
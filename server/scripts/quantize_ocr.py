@@ -0,0 +1,73 @@
+import sys
+import time
+import cv2 as cv
+import cyclopts as cy
+
+from tabby_server.vision import quantization
+
+
+app = cy.App()
+
+
+@app.default
+def main(
+    *image_paths: cy.types.ResolvedExistingFile,
+    min_similarity: float = 0.9,
+) -> None:
+    """Quantizes the EasyOCR models to int8, then checks that they read the
+    given images about as well as the float32 models. The quantized models
+    are saved where the server looks for them when `OCR_QUANTIZED` is set.
+
+    Args:
+        image_paths: Paths to the images used to calibrate and check the
+            quantized models.
+        min_similarity: Minimum mean similarity, from 0 to 1, between the text
+            read by the float32 and int8 models for the check to pass.
+    """
+
+    if not image_paths:
+        print("No images given to calibrate with.")
+        sys.exit(1)
+    images = []
+    for path in image_paths:
+        image = cv.imread(str(path))
+        if image is None:
+            print(f"Couldn't read the image {path}.")
+            sys.exit(1)
+        images.append(image)
+
+    reader = quantization.reader_unquantized()
+
+    print(f"Calibrating with {len(images)} image(s)...")
+    detector, recognizer = quantization.quantize_reader(reader, images)
+    quantization.save_quantized(detector, recognizer)
+    print(f"Saved quantized models to {quantization.MODEL_DIR}")
+
+    similarities = []
+    for path, image in zip(image_paths, images):
+        start = time.time()
+        expected = quantization.read_all_text(reader, image)
+        duration_float = time.time() - start
+
+        with quantization.using_models(reader, detector, recognizer):
+            start = time.time()
+            actual = quantization.read_all_text(reader, image)
+            duration_int8 = time.time() - start
+
+        similarity = quantization.text_similarity(expected, actual)
+        similarities.append(similarity)
+        print(
+            f"{path.name}: similarity {similarity:.3f}, "
+            f"float32 {duration_float:.2f}s, int8 {duration_int8:.2f}s"
+        )
+
+    mean_similarity = sum(similarities) / len(similarities)
+    print(f"Mean similarity: {mean_similarity:.3f}")
+    if mean_similarity < min_similarity:
+        print(f"Quantized models are less accurate than {min_similarity}.")
+        sys.exit(1)
+    print("Run the server with OCR_QUANTIZED=1 to use them.")
+
+
+if __name__ == "__main__":
+    app()
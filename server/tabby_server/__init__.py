@@ -1,7 +1,9 @@
 from logging.config import dictConfig
 from flask import Flask
 from http import HTTPStatus
-from tabby_server.api import books
+from tabby_server import cores
+from tabby_server.api import books, uploads
+from tabby_server.vision import image_labelling
 
 """
 This is the central file of our app. Everything is called from here.
@@ -20,6 +22,7 @@ def create_app_instance(name: str = "Tabby_Server"):
 
 
 app = create_app_instance()
+app.config["MAX_CONTENT_LENGTH"] = uploads.MAX_UPLOAD_BYTES
 
 # Test Python Files.
 # OCR or Text Recognition
@@ -37,6 +40,23 @@ def hello_world():
     return {"message": "Hello from Koyeb..."}, HTTPStatus.OK
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Gets histograms of how the work of this process was batched and how
+    many angles text was read at, how many cores and threads it runs the
+    models on, how often its scan results were reused, and how many queued
+    scans there are of each status."""
+    return {
+        "cores": cores.layout(),
+        "find_books": image_labelling.batcher.stats(),
+        "ocr_angles_read": books.angles_read.to_dict(),
+        "recognize_spines": books.recognition_batcher.stats(),
+        "scan_cache": books.scan_cache.stats(),
+        "scan_jobs": books.scan_jobs.stats(),
+        "spine_cache": books.spine_cache.stats(),
+    }, HTTPStatus.OK
+
+
 @app.route("/api/test", methods=["POST"])
 def test():
     return {"message": "Hello world!"}, HTTPStatus.OK
@@ -45,6 +65,7 @@ def test():
 dictConfig(
     {
         "version": 1,
+        "disable_existing_loggers": False,  # Keep gunicorn's loggers
         "formatters": {
             "default": {
                 "format": "[%(asctime)s] (%(levelname)s) %(module)s: %(message)s",  # noqa: E501
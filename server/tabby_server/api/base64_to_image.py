@@ -1,8 +1,7 @@
 import base64
 import cv2
-import io
 import numpy as np
-from PIL import Image
+from tabby_server.vision import decoding
 
 
 """ Example Useage
@@ -31,12 +30,12 @@ def decode_image(string64: str) -> np.ndarray:
     # First decode the base64 into byte data
     imgdata = base64.decodebytes(bytes(string64, "utf-8"))
 
-    # Process the byte data into BGR (Blue, Gree, Red) where
-    # blue occupies the most significant bit and red occupies the LSB
-    img = Image.open(io.BytesIO(imgdata))
+    # Process the byte data into BGR (Blue, Gree, Red), at full resolution
+    opencv_img = decoding.decode_image(imgdata, min_area=0)
+    if opencv_img is None:
+        raise ValueError("Couldn't read an image from the given string.")
 
-    # Don't convert image from BRG into RGB
-    # Just read as is
-    opencv_img = cv2.cvtColor(np.array(img), cv2.IMREAD_COLOR)
+    # Give the image in RGB order, as Pillow reads it, without copying it
+    cv2.cvtColor(opencv_img, cv2.COLOR_BGR2RGB, dst=opencv_img)
 
     return opencv_img  # Function, END
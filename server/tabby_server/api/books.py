@@ -1,27 +1,31 @@
-from collections.abc import Generator
+from collections.abc import Callable, Generator, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from contextlib import contextmanager
-from dataclasses import asdict
+from dataclasses import asdict, dataclass, field
 from functools import cache
-from io import BytesIO
+import json
 import logging
 import os
 import re
 import time
-from typing import Literal
-from PIL import Image
-import PIL
+from typing import Any, Literal
 from dotenv import load_dotenv
-from flask import Blueprint, request, current_app
+from flask import Blueprint, Response, request, current_app
+from flask import stream_with_context
 from http import HTTPStatus
 import cv2 as cv
 from cv2.typing import MatLike
 import numpy as np
-import torch
 from tabby_server.services import google_books
 from tabby_server.services import tags
+from .. import batching, caching, inference, jobs
+from . import uploads
+from ..vision import decoding
+from ..vision import hashing
 from ..vision import ocr
 from ..vision import extraction
 from ..vision import image_labelling
+from ..vision import text_presence
 
 
 load_dotenv()
@@ -32,6 +36,124 @@ _SCAN_SHELF_MAX_RESULTS_PER_BOOK = 5
 _FILTER_ISBN: bool = bool(int(os.getenv("FILTER_ISBN", "1")))
 """True if books without ISBN should be filtered out, false otherwise."""
 
+_SCAN_SHELF_SINGLE_PASS: bool = bool(
+    int(os.getenv("SCAN_SHELF_SINGLE_PASS", "1"))
+)
+"""True if text should be detected once over the whole shelf image, false if
+each spine should be scanned separately."""
+
+_OCR_QUANTIZED: bool = bool(int(os.getenv("OCR_QUANTIZED", "0")))
+"""True if the OCR models should be run in int8, which is faster but needs
+the quantized models to be created first."""
+
+_OCR_BATCH_ACROSS_REQUESTS: bool = bool(
+    int(os.getenv("OCR_BATCH_ACROSS_REQUESTS", "0"))
+)
+"""True if the spines of shelves scanned at the same time should be read
+together, false if each shelf should be read on its own."""
+
+_OCR_BATCH_WINDOW: float = float(os.getenv("OCR_BATCH_WINDOW_MS", "10")) / 1000
+"""Maximum time, in seconds, a shelf waits for other shelves to be read
+with, set by the `OCR_BATCH_WINDOW_MS` environment variable in
+milliseconds."""
+
+_OCR_MAX_BATCH_SHELVES: int = int(os.getenv("OCR_MAX_BATCH_SHELVES", "4"))
+"""Maximum number of shelves whose spines are read together."""
+
+_SCAN_SHELF_ANGLES: tuple[Literal[0, 90, 180, 270], ...] = (270, 90, 0)
+"""Angles at which to read the text on each spine, from the most likely to
+the least. Titles on spines mostly run from top to bottom, which is upright
+once turned 270 degrees clockwise."""
+
+_SCAN_SHELF_NETWORK_WORKERS: int = int(
+    os.getenv("SCAN_SHELF_NETWORK_WORKERS", "8")
+)
+"""Maximum number of spines whose title and author are extracted with
+ChatGPT and searched for on Google Books at once, across every shelf scanned
+by this process."""
+
+_spine_lookups = ThreadPoolExecutor(
+    max_workers=max(1, _SCAN_SHELF_NETWORK_WORKERS),
+    thread_name_prefix="scan-spine",
+)
+"""Threads extracting the title and author of spines and searching for them,
+shared by every shelf scan. Its threads are only started once a spine is
+looked up, so forking before then is safe."""
+
+_SCAN_CACHE_SIZE: int = int(os.getenv("SCAN_CACHE_SIZE", "128"))
+"""Maximum number of scan results kept to answer repeated uploads of the
+same image. If 0, results aren't cached."""
+
+_SCAN_CACHE_TTL: float = float(os.getenv("SCAN_CACHE_TTL_SECONDS", "600"))
+"""Seconds a scan result is kept."""
+
+_SCAN_CACHE_MAX_DISTANCE: int = int(os.getenv("SCAN_CACHE_MAX_DISTANCE", "4"))
+"""Maximum number of bits, out of 64, in which the perceptual hashes of two
+images can differ for them to count as the same image."""
+
+scan_cache: caching.PerceptualCache[dict] = caching.PerceptualCache(
+    max_size=_SCAN_CACHE_SIZE,
+    ttl=_SCAN_CACHE_TTL,
+    max_distance=_SCAN_CACHE_MAX_DISTANCE,
+)
+"""Responses of `/scan_cover` and `/scan_shelf`, by the perceptual hash of
+the image scanned, the endpoint and whether Google Books was searched."""
+
+_SPINE_CACHE_SIZE: int = int(os.getenv("SPINE_CACHE_SIZE", "1024"))
+"""Maximum number of spines whose results are kept, so that scanning a
+shelf again only scans the spines which weren't on it before. If 0, results
+aren't cached."""
+
+_SPINE_CACHE_TTL: float = float(os.getenv("SPINE_CACHE_TTL_SECONDS", "3600"))
+"""Seconds the results of a spine are kept."""
+
+_SPINE_CACHE_MAX_DISTANCE: int = int(
+    os.getenv("SPINE_CACHE_MAX_DISTANCE", "0")
+)
+"""Maximum number of bits, out of 64, in which the perceptual hashes of two
+spines can differ for them to count as the same spine. Spines look much
+alike next to whole covers, so by default their hashes must match exactly."""
+
+spine_cache: caching.PerceptualCache[
+    tuple[list[google_books.Book], tuple[str, str]]
+] = caching.PerceptualCache(
+    max_size=_SPINE_CACHE_SIZE,
+    ttl=_SPINE_CACHE_TTL,
+    max_distance=_SPINE_CACHE_MAX_DISTANCE,
+)
+"""Books and (title, author) found on each spine, by the perceptual hash of
+the upright spine padded to a square, whether Google Books was searched and
+the aspect ratio of the spine."""
+
+_SCAN_JOBS_DB: str = os.getenv(
+    "SCAN_JOBS_DB",
+    os.path.normpath(
+        os.path.join(
+            os.path.dirname(os.path.abspath(__file__)),
+            "..",
+            "..",
+            "scan_jobs.sqlite3",
+        )
+    ),
+)
+"""Path to the SQLite database queued shelf scans are stored in. Defaults to
+the `server/` folder, wherever the server is started from."""
+
+_SCAN_JOB_WORKERS: int = int(os.getenv("SCAN_JOB_WORKERS", "1"))
+"""Number of threads running queued shelf scans in each worker."""
+
+_SCAN_JOB_TTL: float = float(os.getenv("SCAN_JOB_TTL_SECONDS", "3600"))
+"""Seconds the result of a queued shelf scan is kept after it finishes, and a
+shelf scan is kept waiting to be run before it is dropped."""
+
+_SCAN_JOB_MAX_QUEUED: int = int(os.getenv("SCAN_JOB_MAX_QUEUED", "32"))
+"""Maximum number of shelf scans waiting to be run. Each keeps its image in
+the database until it is run."""
+
+_SCAN_JOB_LEASE: float = float(os.getenv("SCAN_JOB_LEASE_SECONDS", "600"))
+"""Seconds a queued shelf scan can go without progress before it is assumed
+abandoned by a worker which died, and is run again."""
+
 subapp = Blueprint(name="books", import_name=__name__)
 
 G = "\u001b[32m"
@@ -39,10 +161,98 @@ B = "\u001b[34m"
 RESET = "\033[0m"
 
 _OCR_CONFIDENCE_MIN: float = 0.3
+"""Minimum confidence for recognized text to be used."""
+
+_OCR_LENGTH_MIN: int = 2
+"""Minimum length for recognized text to be used."""
 
 _RECOMMENDATIONS_INPUT_LIMIT: int = 100
 """Maximum number of books to give to recommendations."""
 
+_OCR_EARLY_EXIT: bool = bool(int(os.getenv("OCR_EARLY_EXIT", "1")))
+"""True if text should be read at one angle at a time, stopping once enough
+confident text is read, false if it should be read at every angle."""
+
+_OCR_QUALITY_BAR = ocr.QualityBar(
+    min_confidence=_OCR_CONFIDENCE_MIN,
+    min_length=_OCR_LENGTH_MIN,
+    min_characters=int(os.getenv("OCR_EARLY_EXIT_MIN_CHARACTERS", "8")),
+    min_mean_confidence=float(
+        os.getenv("OCR_EARLY_EXIT_MIN_MEAN_CONFIDENCE", "0.5")
+    ),
+)
+"""How much confident text must be read at an angle for no other angle to
+be tried, if `_OCR_EARLY_EXIT` is true."""
+
+angles_read = batching.Histogram((1, 2, 3, 4))
+"""Number of angles the text on each cover or spine was read at."""
+
+_DETECT_MAX_TILES: int = int(os.getenv("DETECT_MAX_TILES", "6"))
+"""Maximum number of tiles a wide image of a shelf is divided into to find
+the books on it. If 1, the whole image is always scanned at once."""
+
+_SKIP_BLANK_SPINES: bool = bool(int(os.getenv("SKIP_BLANK_SPINES", "1")))
+"""True if spines which can't have readable text should be skipped before
+reading them, false if every spine should be read."""
+
+_SPINE_MIN_WIDTH: int = int(os.getenv("SPINE_MIN_WIDTH", "8"))
+"""Minimum width, in pixels, of a spine for it to be read."""
+
+_SPINE_MIN_HEIGHT: int = int(os.getenv("SPINE_MIN_HEIGHT", "32"))
+"""Minimum height, in pixels, of a spine for it to be read."""
+
+_SPINE_MIN_EDGE_DENSITY: float = float(
+    os.getenv("SPINE_MIN_EDGE_DENSITY", "0.005")
+)
+"""Minimum fraction of the pixels of a spine which must be on an edge for it
+to be read."""
+
+
+@dataclass(kw_only=True)
+class ShelfScan:
+    """Dataclass which represents the results of scanning a shelf."""
+
+    shelf: list[list[google_books.Book]]
+    """List of lists of book information scanned. Each sublist corresponds
+    to a spine. Empty if Google Books wasn't searched."""
+
+    titles_authors: list[tuple[str, str]]
+    """Title and author of each spine. Empty strings if failure."""
+
+    spine_cache_hits: int = 0
+    """Number of spines whose results were reused from the spine cache."""
+
+    skipped_spines: dict[int, str] = field(default_factory=dict)
+    """Reason each spine which wasn't read was skipped, by index."""
+
+
+@dataclass(kw_only=True)
+class SpineScan:
+    """Dataclass which represents the results of scanning one spine of a
+    shelf."""
+
+    index: int
+    """Index of the spine among the spines found on the shelf."""
+
+    books: list[google_books.Book]
+    """Books found for the spine. Empty if Google Books wasn't searched."""
+
+    title_author: tuple[str, str]
+    """Title and author of the spine. Empty strings if failure."""
+
+    cached: bool = False
+    """True if the results were reused from the spine cache."""
+
+    skip_reason: str | None = None
+    """Why the spine wasn't read, or `None` if it was read."""
+
+    @classmethod
+    def skipped(cls, index: int, reason: str) -> "SpineScan":
+        """Creates the results of a spine which wasn't read."""
+        return cls(
+            index=index, books=[], title_author=("", ""), skip_reason=reason
+        )
+
 
 @contextmanager
 def logging_duration(message: str) -> Generator[None, None, None]:
@@ -57,6 +267,24 @@ def logging_duration(message: str) -> Generator[None, None, None]:
         logging.info(f"{B}END {duration:6.2f}s {message}{RESET}")
 
 
+def _read_uploaded_image() -> MatLike:
+    """Reads and decodes the image in the body of the current request.
+
+    Returns:
+        BGR image.
+    Raises:
+        uploads.RejectedUpload: If the body isn't an image, or is too large.
+    """
+    data = uploads.read_image(request)
+    image = decoding.decode_image(data)
+    if image is None:
+        raise uploads.RejectedUpload(
+            "Couldn't read an image from the given body.",
+            HTTPStatus.BAD_REQUEST,
+        )
+    return image
+
+
 @subapp.route("/scan_cover", methods=["POST"])
 def books_scan_cover():
     """Receives an image and returns a list of possible books that the image
@@ -74,17 +302,17 @@ def books_scan_cover():
     # Try scan image
     with logging_duration("Read image"):
         try:
-            img = Image.open(BytesIO(request.data))
-        except PIL.UnidentifiedImageError:
-            return {
-                "message": "Couldn't read an image from the given body."
-            }, HTTPStatus.BAD_REQUEST
-        img = img.convert("RGB")
-
-    # ai-gen start (ChatGPT-4o, 2)
-    img_mat = np.array(img)
-    img_mat = cv.cvtColor(img_mat, cv.COLOR_RGB2BGR)
-    # ai-gen end
+            img_mat = _read_uploaded_image()
+        except uploads.RejectedUpload as e:
+            return {"message": e.message}, e.status
+
+    # Answer uploads of nearly the same image from the cache
+    image_hash = hashing.perceptual_hash(img_mat)
+    cache_key = ("scan_cover", use_google_books)
+    cached_result = scan_cache.get(cache_key, image_hash)
+    if cached_result is not None:
+        logging.info("Using cached result")
+        return cached_result, HTTPStatus.OK
 
     # Scan cover
     books, (title, author) = scan_cover(
@@ -99,6 +327,10 @@ def books_scan_cover():
     result = _get_result_dict(books)
     result["title"] = title
     result["author"] = author
+
+    # Failed scans are redone, since the user may be retrying
+    if books if use_google_books else title:
+        scan_cache.put(cache_key, image_hash, result)
     return result, HTTPStatus.OK
 
 
@@ -109,8 +341,18 @@ def scan_cover(
 ) -> tuple[list[google_books.Book], tuple[str, str]]:
     """Takes in an image of a cover and returns a list of results.
 
+    Text is first read from a downscaled copy of the image, and a higher
+    resolution is only used if too little confident text is found.
+
     Args:
         image_matrix: Image to scan.
+        angles: Angles at which to read the text, from the most likely to
+            the least. If more than one is given and `OCR_EARLY_EXIT` is
+            set, they are tried one at a time until enough confident text is
+            read. Otherwise, the orientation of the text is predicted first,
+            and each region of text is only read at every angle if unsure.
+        use_google_books: If true, search Google Books for the extracted
+            title and author.
     Returns:
         (1) List of book information scanned. Empty if there is a failure at
         any part.
@@ -118,24 +360,69 @@ def scan_cover(
     """
 
     # Find text
-    recognized_texts: list[ocr.RecognizedText] = []
-    for angle in angles:
-        with logging_duration(f"Recognize text using OCR ({angle} deg)"):
-            text_recognizer = get_text_recognizer()
-            recognized_texts += text_recognizer.find_text(image_matrix, angle)
+    recognized_texts = inference.run(read_cover, image_matrix, angles)
+    _record_angles_read(recognized_texts)
+
+    return scan_recognized_texts(recognized_texts, use_google_books)
+
+
+def _record_angles_read(recognized_texts: ocr.RecognizedTextBatch) -> None:
+    """Logs and counts the angles some text was read at."""
+    logging.info(f"Read text at {recognized_texts.angles} deg")
+    if recognized_texts.angles:
+        angles_read.observe(len(recognized_texts.angles))
+
+
+def read_cover(
+    image_matrix: MatLike, angles: tuple[Literal[0, 90, 180, 270], ...]
+) -> ocr.RecognizedTextBatch:
+    """Reads the text on a cover. Run through `inference`.
+
+    Args:
+        image_matrix: Image of the cover.
+        angles: Same as `scan_cover()`.
+    Returns:
+        Text recognized on the cover.
+    """
+    text_recognizer = get_text_recognizer()
+    with logging_duration(f"Recognize text using OCR ({angles} deg)"):
+        return text_recognizer.find_text_scaled(
+            image_matrix,
+            angles,
+            min_confidence=_OCR_CONFIDENCE_MIN,
+            min_length=_OCR_LENGTH_MIN,
+            quality=_OCR_QUALITY_BAR if _OCR_EARLY_EXIT else None,
+        )
+
+
+def scan_recognized_texts(
+    recognized_texts: ocr.RecognizedTextBatch,
+    use_google_books: bool = True,
+) -> tuple[list[google_books.Book], tuple[str, str]]:
+    """Takes in the text recognized on a cover and returns a list of results.
+
+    Args:
+        recognized_texts: Text recognized on the cover.
+        use_google_books: If true, search Google Books for the extracted
+            title and author.
+    Returns:
+        (1) List of book information scanned. Empty if there is a failure at
+        any part.
+        (2) Title and author tuple. Empty strings if failure.
+    """
 
     # Filter out bad text
-    recognized_texts = [
-        r
-        for r in recognized_texts
-        if r.confidence >= _OCR_CONFIDENCE_MIN and len(r.text) >= 2
-    ]
+    recognized_texts = recognized_texts.filtered(
+        _OCR_CONFIDENCE_MIN, _OCR_LENGTH_MIN
+    )
 
     # Log text
-    if recognized_texts:
+    if len(recognized_texts) > 0:
         logging.info("Found text:")
-        for r in recognized_texts:
-            logging.info(f"  ({r.confidence * 100:5.2f}%) {r.text}")
+        for text, confidence in zip(
+            recognized_texts.texts, recognized_texts.confidences
+        ):
+            logging.info(f"  ({confidence * 100:5.2f}%) {text}")
     else:  # None found
         logging.info("Found NO text")
         return [], ("", "")
@@ -190,7 +477,7 @@ def get_text_recognizer() -> ocr.TextRecognizer:
     Returns:
         Text recognizer object.
     """
-    return ocr.TextRecognizer()
+    return ocr.TextRecognizer(quantized=_OCR_QUANTIZED)
 
 
 @subapp.route("/search", methods=["GET"])
@@ -274,51 +561,310 @@ def _get_result_dict(books: list[google_books.Book]) -> dict:
 
 
 @subapp.route("/scan_shelf", methods=["POST"])
-def books_scan_shelf() -> tuple[dict, HTTPStatus]:
+def books_scan_shelf() -> tuple[dict, HTTPStatus] | Response:
     """Scans a shelf. This gives a list of books that could be in the given
     image.
 
     The body of the request should be binary data (JPG or PNG) reprsenting
     the image.
+
+    If the `stream` parameter is given, or the request accepts
+    `application/x-ndjson` or `text/event-stream`, the results of each
+    spine are streamed as they are found. See `_stream_scan_shelf()`.
     """
     current_app.logger.info(f"{G}START       /scan_shelf{RESET}")
 
     # Get param
     use_google_books: bool = not ("nosearch" in request.args)
+    stream_format = _stream_format()
 
     # Load image
     with logging_duration("Read image"):
         try:
-            img_file = Image.open(BytesIO(request.data))
-        except PIL.UnidentifiedImageError:
-            return {
-                "message": "Couldn't read an image from the given body."
-            }, HTTPStatus.BAD_REQUEST
+            img_mat = _read_uploaded_image()
+        except uploads.RejectedUpload as e:
+            return {"message": e.message}, e.status
+
+    # Answer uploads of nearly the same image from the cache
+    image_hash = hashing.perceptual_hash(img_mat)
+    cache_key = ("scan_shelf", use_google_books)
+    cached_result = scan_cache.get(cache_key, image_hash)
+    if cached_result is not None:
+        logging.info("Using cached result")
+        if stream_format is not None:
+            count = len(cached_result["titles"])
+            cached_records = [
+                {"type": "spines", "count": count},
+                {"type": "summary", **cached_result},
+            ]
+            return _stream_response(iter(cached_records), stream_format)
+        return cached_result, HTTPStatus.OK
+
+    # Find the spines, and scan each of them as it is needed
+    count, spine_scans = scan_shelf_spines(
+        img_mat, use_google_books=use_google_books
+    )
 
-    img = img_file.convert("RGB")
-    # ai-gen start (ChatGPT-4o, 2)
-    img_mat = np.array(img)
-    img_mat = cv.cvtColor(img_mat, cv.COLOR_RGB2BGR)
-    # ai-gen end
+    def cache_result(result_dict: dict) -> None:
+        _cache_shelf_result(image_hash, use_google_books, result_dict)
 
-    # scan shelf
-    scanned_shelf, titles_authors = scan_shelf(
-        img_mat, use_google_books=use_google_books
+    if stream_format is not None:
+        records = _stream_scan_shelf(
+            count, spine_scans, use_google_books, cache_result
+        )
+        return _stream_response(records, stream_format)
+
+    shelf_scan = _collect_spines(count, spine_scans, use_google_books)
+    result_dict = _shelf_result_dict(shelf_scan)
+    cache_result(result_dict)
+    return result_dict, HTTPStatus.OK
+
+
+def _cache_shelf_result(
+    image_hash: int, use_google_books: bool, result_dict: dict
+) -> None:
+    """Stores the response to a request to scan a shelf in the scan cache,
+    unless the scan failed."""
+    # Failed scans are redone, since the user may be retrying
+    if (
+        result_dict["results"]
+        if use_google_books
+        else any(result_dict["titles"])
+    ):
+        scan_cache.put(
+            ("scan_shelf", use_google_books), image_hash, result_dict
+        )
+
+
+@subapp.route("/scan_shelf/jobs", methods=["POST"])
+def books_scan_shelf_jobs_post() -> tuple[dict, HTTPStatus]:
+    """Queues a scan of a shelf, to be run in the background. Unlike
+    `/scan_shelf`, this returns as soon as the image is received.
+
+    The body of the request should be binary data (JPG or PNG) representing
+    the image. The scan is polled with `GET /scan_shelf/jobs/<id>`.
+    """
+    current_app.logger.info(f"{G}START       /scan_shelf/jobs{RESET}")
+
+    use_google_books: bool = not ("nosearch" in request.args)
+    with logging_duration("Read image"):
+        try:
+            data = uploads.read_image(request)
+        except uploads.RejectedUpload as e:
+            return {"message": e.message}, e.status
+
+    try:
+        job_id = scan_jobs.submit({"use_google_books": use_google_books}, data)
+    except jobs.QueueFull:
+        return {
+            "message": "Too many scans are queued. Try again later."
+        }, HTTPStatus.SERVICE_UNAVAILABLE
+    logging.info(f"Queued job {job_id}")
+    return {
+        "message": "Queued the scan.",
+        "id": job_id,
+        "status": jobs.QUEUED,
+    }, HTTPStatus.ACCEPTED
+
+
+@subapp.route("/scan_shelf/jobs/<job_id>", methods=["GET"])
+def books_scan_shelf_jobs_get(job_id: str) -> tuple[dict, HTTPStatus]:
+    """Gets the progress and, once done, the result of a queued scan of a
+    shelf."""
+    job = scan_jobs.get(job_id)
+    if job is None:
+        return {
+            "message": "No scan with the given id, or it expired."
+        }, HTTPStatus.NOT_FOUND
+    messages = {
+        jobs.QUEUED: "The scan is waiting to be run.",
+        jobs.RUNNING: "The scan is running.",
+        jobs.DONE: "The scan is done.",
+        jobs.FAILED: "The scan failed.",
+    }
+    return {"message": messages[job["status"]], **job}, HTTPStatus.OK
+
+
+def _run_scan_shelf_job(
+    params: dict[str, Any],
+    payload: bytes,
+    report: Callable[[dict[str, Any]], None],
+) -> dict[str, Any]:
+    """Scans a shelf queued by `/scan_shelf/jobs`. Run by `scan_jobs`.
+
+    Args:
+        params: Dict with "use_google_books".
+        payload: Encoded image of the shelf.
+        report: Called with the number of "spines" found and the number
+            "scanned" so far, each time a spine is scanned.
+    Returns:
+        Same as the response of `/scan_shelf`.
+    """
+    use_google_books: bool = params["use_google_books"]
+    image = decoding.decode_image(payload)
+    if image is None:
+        raise ValueError("Couldn't read an image from the given body.")
+
+    image_hash = hashing.perceptual_hash(image)
+    cached_result = scan_cache.get(
+        ("scan_shelf", use_google_books), image_hash
     )
+    if cached_result is not None:
+        logging.info("Using cached result")
+        return cached_result
+
+    count, spine_scans = scan_shelf_spines(image, use_google_books)
+    report({"spines": count, "scanned": 0})
+    done = []
+    for spine_scan in spine_scans:
+        done.append(spine_scan)
+        report({"spines": count, "scanned": len(done)})
+
+    result_dict = _shelf_result_dict(
+        _collect_spines(count, iter(done), use_google_books)
+    )
+    _cache_shelf_result(image_hash, use_google_books, result_dict)
+    return result_dict
+
+
+scan_jobs = jobs.JobQueue(
+    _SCAN_JOBS_DB,
+    _run_scan_shelf_job,
+    workers=_SCAN_JOB_WORKERS,
+    ttl=_SCAN_JOB_TTL,
+    lease=_SCAN_JOB_LEASE,
+    max_queued=_SCAN_JOB_MAX_QUEUED,
+)
+"""Scans of shelves queued by `/scan_shelf/jobs`, shared by every worker."""
+
+
+def _stream_format() -> Literal["ndjson", "sse"] | None:
+    """Gets the format the results of the current request to scan a shelf
+    should be streamed in.
+
+    Returns:
+        "sse" for server-sent events, "ndjson" for one JSON object per line,
+        or `None` if the results shouldn't be streamed.
+    """
+    stream = request.args.get("stream")
+    if stream is None:
+        accepted = request.accept_mimetypes.best_match(
+            ["application/json", "application/x-ndjson", "text/event-stream"]
+        )
+        if accepted == "text/event-stream":
+            return "sse"
+        if accepted == "application/x-ndjson":
+            return "ndjson"
+        return None
+    return "sse" if stream == "sse" else "ndjson"
+
+
+def _stream_scan_shelf(
+    count: int,
+    spine_scans: Iterator[SpineScan],
+    use_google_books: bool,
+    on_summary: Callable[[dict], None],
+) -> Iterator[dict[str, Any]]:
+    """Gives the records streamed in response to a request to scan a shelf.
+
+    Args:
+        count: Number of spines found on the shelf.
+        spine_scans: Results of each spine, as given by
+            `scan_shelf_spines()`.
+        use_google_books: If true, Google Books was searched for each spine.
+        on_summary: Called with the summary before it is given.
+    Returns:
+        (1) `{"type": "spines", "count": ...}`, the number of spines found.
+        (2) For each spine, in the order they finish, a record with
+        `"type": "spine"`, its `"index"`, `"title"`, `"author"`, the
+        `"results"` found for it, whether it was `"cached"` and the
+        `"skipReason"` if it was skipped.
+        (3) `{"type": "summary", ...}`, with the same fields as the response
+        when not streaming.
+    """
+    yield {"type": "spines", "count": count}
+
+    done = []
+    try:
+        for spine_scan in spine_scans:
+            done.append(spine_scan)
+            title, author = spine_scan.title_author
+            books = _filter_books(spine_scan.books)
+            yield {
+                "type": "spine",
+                "index": spine_scan.index,
+                "title": title,
+                "author": author,
+                "results": [asdict(b) for b in books],
+                "cached": spine_scan.cached,
+                "skipReason": spine_scan.skip_reason,
+            }
+    except Exception:
+        logging.exception("Failed to scan shelf")
+        yield {"type": "error", "message": "Failed to scan the shelf."}
+        return
+
+    result_dict = _shelf_result_dict(
+        _collect_spines(count, iter(done), use_google_books)
+    )
+    on_summary(result_dict)
+    yield {"type": "summary", **result_dict}
+
+
+def _stream_response(
+    records: Iterator[dict[str, Any]], stream_format: Literal["ndjson", "sse"]
+) -> Response:
+    """Streams records as they are given, either as newline-delimited JSON
+    or as server-sent events whose event name is the type of each record."""
+
+    def encode() -> Iterator[str]:
+        for record in records:
+            data = json.dumps(record)
+            if stream_format == "sse":
+                yield f"event: {record['type']}\ndata: {data}\n\n"
+            else:
+                yield data + "\n"
+            logging.info(f"Streamed {record['type']} record")
+
+    mimetype = {
+        "ndjson": "application/x-ndjson",
+        "sse": "text/event-stream",
+    }[stream_format]
+    return Response(
+        stream_with_context(encode()),
+        mimetype=mimetype,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def _filter_books(books: list[google_books.Book]) -> list[google_books.Book]:
+    """Filters out books without ISBNs, if `FILTER_ISBN` is set, and limits
+    the books of a spine to `_SCAN_SHELF_MAX_RESULTS_PER_BOOK`."""
+    if _FILTER_ISBN:
+        books = [b for b in books if b.isbn]
+    return books[:_SCAN_SHELF_MAX_RESULTS_PER_BOOK]
+
+
+def _shelf_result_dict(shelf_scan: ShelfScan) -> dict:
+    """Creates the response to a request to scan a shelf.
+
+    Returns:
+        Same dictionary as `_get_result_dict()`, with the first book found
+        for each spine, plus "titles", "authors", "spineCacheHits" and
+        "skippedSpines".
+    """
 
     # filter out any books without ISBNs
     # and limit each sublist to a maximum number of books
     new_shelf = []
-    for books in scanned_shelf:
-        if _FILTER_ISBN:
-            books = [b for b in books if b.isbn]
-        books = books[:_SCAN_SHELF_MAX_RESULTS_PER_BOOK]
+    for books in shelf_scan.shelf:
+        books = _filter_books(books)
         if len(books) >= 1:  # if not empty, append it
             new_shelf.append(books)
 
     titles = []
     authors = []
-    for title, author in titles_authors:
+    for title, author in shelf_scan.titles_authors:
         titles.append(title)
         authors.append(author)
 
@@ -331,77 +877,404 @@ def books_scan_shelf() -> tuple[dict, HTTPStatus]:
     result_dict = _get_result_dict(results)
     result_dict["titles"] = titles
     result_dict["authors"] = authors
-
-    return result_dict, HTTPStatus.OK
+    result_dict["spineCacheHits"] = shelf_scan.spine_cache_hits
+    result_dict["skippedSpines"] = [
+        {"index": i, "reason": reason}
+        for i, reason in sorted(shelf_scan.skipped_spines.items())
+    ]
+    return result_dict
 
 
 def scan_shelf(
     image: MatLike,
     use_google_books: bool = True,
-) -> tuple[list[list[google_books.Book]], list[tuple[str, str]]]:
+) -> ShelfScan:
     """Takes in an image of a shelf and returns a list of list of results.
 
+    Spines which can't have readable text, such as plain or tiny ones, are
+    skipped. Spines found on a shelf scanned before reuse their earlier
+    results from the spine cache. Only the remaining spines are scanned.
+
     Args:
         image: Image to scan.
     Returns:
-        (1) List of lists of book information scanned. Each sublist corresponds
-        to a subimage. Empty if there is a failure at any part.
-        (2) Title and author tuple. Empty strings if failure.
+        Results of the scan.
+    """
+    count, spine_scans = scan_shelf_spines(image, use_google_books)
+    return _collect_spines(count, spine_scans, use_google_books)
+
+
+def scan_shelf_spines(
+    image: MatLike,
+    use_google_books: bool = True,
+) -> tuple[int, Iterator[SpineScan]]:
+    """Finds the spines on a shelf, then gives the results of each spine as
+    soon as it is scanned.
+
+    Skipped spines and spines whose results are reused from the spine cache
+    are given first. The text of the remaining spines is then read all
+    together, and each of them is given as soon as its title and author are
+    extracted and searched for.
+
+    Args:
+        image: Image to scan.
+        use_google_books: If true, search Google Books for each spine.
+    Returns:
+        (1) Number of spines found.
+        (2) Results of each spine, in the order they finish. The spines are
+        only scanned as this is iterated over.
     """
 
-    w, h, _ = image.shape
+    # Get the outline of each book
+    spines = find_spines(image)
+    logging.info(f"Found {len(spines)} books in shelf image.")
+    return len(spines), _scan_spines(image, spines, use_google_books)
+
+
+def _scan_spines(
+    image: MatLike,
+    spines: list[np.ndarray],
+    use_google_books: bool,
+) -> Iterator[SpineScan]:
+    """Scans each spine on a shelf. Same as (2) of `scan_shelf_spines()`."""
+
+    # Crop each spine once. Reading every spine together only needs them in
+    # greyscale, while reading them separately detects text in color
+    if _SCAN_SHELF_SINGLE_PASS:
+        image_grey = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+        crops = [ocr.crop_polygon(image_grey, outline) for outline in spines]
+    else:
+        crops = [ocr.crop_polygon(image, outline) for outline in spines]
+    spine_images = [spine_image for spine_image, _ in crops]
+
+    # Skip spines which can't have readable text
+    new = []
+    spine_keys: dict[int, tuple[bool, int]] = {}
+    spine_hashes: dict[int, int] = {}
+    for i, spine_image in enumerate(spine_images):
+        if _SKIP_BLANK_SPINES:
+            reason = text_presence.skip_reason(
+                spine_image,
+                _SPINE_MIN_WIDTH,
+                _SPINE_MIN_HEIGHT,
+                _SPINE_MIN_EDGE_DENSITY,
+            )
+            if reason is not None:
+                yield SpineScan.skipped(i, reason)
+                continue
+
+        # Reuse the results of spines scanned before
+        spine_keys[i] = (use_google_books, hashing.aspect_bucket(spine_image))
+        spine_hashes[i] = hashing.perceptual_hash(
+            spine_image, pad_to_square=True
+        )
+        cached = spine_cache.get(spine_keys[i], spine_hashes[i])
+        if cached is not None:
+            books, title_author = cached
+            yield SpineScan(
+                index=i, books=books, title_author=title_author, cached=True
+            )
+        else:
+            new.append(i)
+    logging.info(f"Scanning {len(new)} spines not found in the cache.")
+
+    # Read the text of each new book
+    texts_by_spine: Iterable[ocr.RecognizedTextBatch]
+    if _SCAN_SHELF_SINGLE_PASS:
+        texts_by_spine, new_skipped = _read_spines_single_pass(
+            image, [spines[i] for i in new], [crops[i] for i in new]
+        )
+    else:
+        texts_by_spine = _read_spines_separately(
+            [spine_images[i] for i in new]
+        )
+        new_skipped = {}
+
+    # Find each of them. ChatGPT and Google Books are asked about several
+    # spines at once, while the text of the next spines is still being read
+    pending: dict[Future, int] = {}
+
+    def finish(future: Future) -> SpineScan:
+        i = pending.pop(future)
+        books, title_author = future.result()
+        # Failed spines are redone, like failed scans
+        if books if use_google_books else any(title_author):
+            spine_cache.put(
+                spine_keys[i], spine_hashes[i], (books, title_author)
+            )
+        return SpineScan(index=i, books=books, title_author=title_author)
 
-    image_processed = cv.resize(image, (640, 640))
-    image_processed = image_processed / 255.0
-    image_tensor = (
-        torch.from_numpy(image_processed).float().permute(2, 0, 1).unsqueeze(0)
+    try:
+        for k, recognized_texts in enumerate(texts_by_spine):
+            i = new[k]
+            if k in new_skipped:
+                yield SpineScan.skipped(i, new_skipped[k])
+                continue
+
+            _record_angles_read(recognized_texts)
+            future = _spine_lookups.submit(
+                scan_recognized_texts,
+                recognized_texts,
+                use_google_books=use_google_books,
+            )
+            pending[future] = i
+            for future in [f for f in pending if f.done()]:
+                yield finish(future)
+
+        for future in as_completed(list(pending)):
+            yield finish(future)
+    finally:
+        # Don't look up spines nobody will get if the scan failed or the
+        # client went away
+        for future in pending:
+            future.cancel()
+
+
+def _collect_spines(
+    count: int, spine_scans: Iterator[SpineScan], use_google_books: bool
+) -> ShelfScan:
+    """Puts the results of each spine of a shelf together, in order.
+
+    Args:
+        count: Number of spines found on the shelf.
+        spine_scans: Results of each spine, as given by
+            `scan_shelf_spines()`.
+        use_google_books: If true, Google Books was searched for each spine.
+    Returns:
+        Results of the scan.
+    """
+    shelf: list[list[google_books.Book]] = [[] for _ in range(count)]
+    titles_authors = [("", "")] * count
+    cache_hits = 0
+    skipped: dict[int, str] = {}
+    for spine_scan in spine_scans:
+        shelf[spine_scan.index] = spine_scan.books
+        titles_authors[spine_scan.index] = spine_scan.title_author
+        cache_hits += spine_scan.cached
+        if spine_scan.skip_reason is not None:
+            skipped[spine_scan.index] = spine_scan.skip_reason
+    logging.info(f"Skipped {len(skipped)} spines without readable text.")
+
+    if not use_google_books:
+        shelf = []
+
+    return ShelfScan(
+        shelf=shelf,
+        titles_authors=titles_authors,
+        spine_cache_hits=cache_hits,
+        skipped_spines=skipped,
     )
 
-    # Get subimages
-    subimages = []
+
+def find_spines(image: MatLike) -> list[np.ndarray]:
+    """Finds the outline of each book on a shelf.
+
+    Args:
+        image: Image of the shelf.
+    Returns:
+        Outline of each spine, as given by `_spine_outline()`.
+    """
+
+    spines: list[np.ndarray] = []
     with logging_duration("Find books on shelf"):
-        segmentation_results = image_labelling.find_books(image_tensor)
-    for sr in segmentation_results:
+        segmentation_results = image_labelling.find_books_tiled(
+            image, _DETECT_MAX_TILES
+        )
+    for sr, letterbox in segmentation_results:
 
         # scale results to the original image
-        x1 = int(sr["box"]["x1"] / 640.0 * w)
-        x2 = int(sr["box"]["x2"] / 640.0 * w)
-        y1 = int(sr["box"]["y1"] / 640.0 * h)
-        y2 = int(sr["box"]["y2"] / 640.0 * h)
+        x1, y1, x2, y2 = letterbox.box_to_image(sr["box"])
 
-        # ensure coords are in range
-        x1 = min(max(x1, 0), w - 1)
-        x2 = min(max(x2, 0), w - 1)
-        y1 = min(max(y1, 0), h - 1)
-        y2 = min(max(y2, 0), h - 1)
+        if x1 < x2 and y1 < y2:  # if none of the dimensions are 0, add it
+            spines.append(_spine_outline(sr, letterbox, (x1, y1, x2, y2)))
 
-        # ensure x1 < x2 and y1 < y2
-        x1, x2 = min(x1, x2), max(x1, x2)
-        y1, y2 = min(y1, y2), max(y1, y2)
+    return spines
 
-        subimage = image[y1:y2, x1:x2, :]
-        if np.all(subimage.shape):  # if none of the dimensions are 0, add it
-            subimages.append(subimage)
 
-    logging.info(f"Found {len(subimages)} books in shelf image.")
+def _spine_outline(
+    segmentation_result: dict[str, Any],
+    letterbox: image_labelling.Letterbox,
+    box: tuple[int, int, int, int],
+) -> np.ndarray:
+    """Gets the outline of a spine found on a shelf, in the coordinates of
+    the shelf image.
 
-    # Scan each subimage
-    titles_authors: list[tuple[str, str]] = []
+    Args:
+        segmentation_result: Result given by `find_books()` for the spine.
+        letterbox: How the shelf image, or the tile of it the spine was found
+            in, was letterboxed for `find_books()`.
+        box: Bounding box of the spine on the shelf image, in the format
+            (x1, y1, x2, y2). Used if the result has no usable segment.
+    Returns:
+        Nx2 matrix of the points of the outline.
+    """
+    x1, y1, x2, y2 = box
+    segments = segmentation_result.get("segments", {})
+    xs, ys = segments.get("x", []), segments.get("y", [])
+    if len(xs) >= 3 and len(xs) == len(ys):
+        outline = letterbox.to_image(np.stack([xs, ys], axis=1))
+        outline = np.clip(outline, (x1, y1), (x2, y2))
+        if cv.contourArea(outline.astype(np.float32)) >= 1.0:
+            return outline
+    return np.array([[x1, y1], [x2, y1], [x2, y2], [x1, y2]], dtype=float)
+
+
+def _read_spines_separately(
+    spine_images: list[MatLike],
+) -> Iterator[ocr.RecognizedTextBatch]:
+    """Reads the text on each spine of a shelf by running the full OCR
+    pipeline on each cropped spine.
+
+    Args:
+        spine_images: Upright image of each spine, as given by
+            `ocr.crop_polygon()`.
+    Returns:
+        Text recognized on each spine, in order, given as soon as it's read.
+    """
     with logging_duration("Use OCR on each image."):
-        shelf: list[list[google_books.Book]] = []
-        for subimage in subimages:
-            books, (title, author) = scan_cover(
-                subimage,
-                angles=(0, 90, 270),
-                use_google_books=use_google_books,
-            )
-            shelf.append(books)
-            titles_authors.append((title, author))
+        yield from inference.run_each(
+            read_cover, spine_images, [_SCAN_SHELF_ANGLES] * len(spine_images)
+        )
 
-    if not use_google_books:
-        shelf = []
 
-    return shelf, titles_authors
+def _read_spines_single_pass(
+    image: MatLike,
+    spines: list[np.ndarray],
+    crops: list[tuple[MatLike, np.ndarray]],
+) -> tuple[list[ocr.RecognizedTextBatch], dict[int, str]]:
+    """Reads the text on each spine of a shelf while only detecting text
+    once.
+
+    Text detection runs a single time on the whole (scaled) shelf image, and
+    each region of text is assigned to the spine that contains it. The text
+    of every spine is then recognized together, each spine at the angle
+    predicted for it. If `SKIP_BLANK_SPINES` is set, spines without any text
+    detected on them are skipped.
+
+    Args:
+        image: Image of the shelf.
+        spines: Outline of each spine, as given by `_spine_outline()`.
+        crops: Greyscale image of each spine and the matrix it was cropped
+            with, as given by `ocr.crop_polygon()`.
+    Returns:
+        (1) Text recognized on each spine. Empty for skipped spines.
+        (2) Reason each skipped spine was skipped, by index.
+    """
+    if not spines:
+        return [], {}
+
+    scaled_image, side_ratio = ocr.scale_image(image, ocr.SHELF_MAX_AREA)
+    regions = inference.run(detect_text, scaled_image)
+    regions = regions.scaled(1.0 / side_ratio)
+    regions_by_spine = ocr.group_regions_by_polygons(regions, spines)
+
+    skipped = {}
+    if _SKIP_BLANK_SPINES:
+        skipped = {
+            i: text_presence.NO_TEXT_DETECTED
+            for i, regions in enumerate(regions_by_spine)
+            if len(regions) == 0
+        }
+    readable = [i for i in range(len(spines)) if i not in skipped]
+
+    # Make coordinates relative to each upright cropped spine
+    spine_images = []
+    spine_regions = []
+    for i in readable:
+        spine_image, matrix = crops[i]
+        spine_images.append(spine_image)
+        spine_regions.append(regions_by_spine[i].transformed(matrix))
+
+    texts_by_spine = [ocr.RecognizedTextBatch.empty()] * len(spines)
+    with logging_duration("Use OCR on each image."):
+        texts = recognize_spines(spine_images, spine_regions)
+    for i, spine_texts in zip(readable, texts):
+        texts_by_spine[i] = spine_texts
+    return texts_by_spine, skipped
+
+
+def detect_text(image: MatLike) -> ocr.TextRegions:
+    """Detects each word of text on an image of a shelf, without reading
+    it. Run through `inference`.
+
+    Args:
+        image: Image of the shelf, scaled down.
+    Returns:
+        Regions of text on the image.
+    """
+    with logging_duration("Detect text on shelf"):
+        return get_text_recognizer().detect_regions(image, merge_lines=False)
+
+
+def read_spines(
+    spine_images: list[MatLike], spine_regions: list[ocr.TextRegions]
+) -> list[ocr.RecognizedTextBatch]:
+    """Reads the text in the given regions of many spines, each at the angle
+    predicted for it. The lines of text of every spine are read together in
+    large batches. Run through `inference`.
+
+    Args:
+        spine_images: Greyscale image of each spine.
+        spine_regions: Regions of text on each spine.
+    Returns:
+        Text recognized on each spine.
+    """
+    text_recognizer = get_text_recognizer()
+    region_count = sum(len(regions) for regions in spine_regions)
+    with logging_duration(
+        f"Recognize text using OCR ({len(spine_images)} spines,"
+        f" {region_count} regions)"
+    ):
+        angles = text_recognizer.choose_angles_many(
+            list(zip(spine_images, spine_regions)), _SCAN_SHELF_ANGLES
+        )
+        logging.info(f"Reading spines at {angles} deg")
+        return text_recognizer.recognize_many(
+            list(zip(spine_images, spine_regions, angles))
+        )
+
+
+def recognize_spines(
+    spine_images: list[MatLike], spine_regions: list[ocr.TextRegions]
+) -> list[ocr.RecognizedTextBatch]:
+    """Same as `read_spines()`, but if `OCR_BATCH_ACROSS_REQUESTS` is set,
+    the spines are read together with those of other shelves being scanned
+    at the same time."""
+    if _OCR_BATCH_ACROSS_REQUESTS:
+        return recognition_batcher.submit((spine_images, spine_regions))
+    return inference.run(read_spines, spine_images, spine_regions)
+
+
+def _read_shelves(
+    shelves: list[tuple[list[MatLike], list[ocr.TextRegions]]],
+) -> list[list[ocr.RecognizedTextBatch]]:
+    """Reads the spines of many shelves in one call to `read_spines()`.
+
+    Args:
+        shelves: List of (spine_images, spine_regions) tuples, one per shelf.
+    Returns:
+        Text recognized on each spine of each shelf.
+    """
+    spine_images = [image for images, _ in shelves for image in images]
+    spine_regions = [r for _, regions in shelves for r in regions]
+    texts = inference.run(read_spines, spine_images, spine_regions)
+
+    texts_by_shelf = []
+    start = 0
+    for images, _ in shelves:
+        end = start + len(images)
+        texts_by_shelf.append(texts[start:end])
+        start = end
+    return texts_by_shelf
+
+
+recognition_batcher = batching.MicroBatcher(
+    _read_shelves,
+    max_batch_size=_OCR_MAX_BATCH_SHELVES,
+    window=_OCR_BATCH_WINDOW,
+)
+"""Batches the spines of shelves scanned at the same time, if
+`OCR_BATCH_ACROSS_REQUESTS` is set."""
 
 
 @subapp.route("/recommendations", methods=["POST"])
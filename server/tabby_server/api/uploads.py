@@ -0,0 +1,215 @@
+from http import HTTPStatus
+import os
+import struct
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.wrappers import Request
+
+"""
+Reads uploaded images from the body of a request as it arrives, rejecting
+bodies which aren't images, or are too large, before the rest is read.
+
+The body is read in chunks. Its first bytes must start like a known image
+format, and the width and height given in the header of the image are
+checked as soon as the header has arrived, so a worker is freed as soon as
+it's clear the image won't be scanned. Only then is one buffer for the whole
+body allocated from the `Content-Length` of the request, so a client can't
+make a worker hold memory just by announcing a large body.
+"""
+
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+"""Maximum size, in bytes, of the body of a request, set by the
+`MAX_UPLOAD_BYTES` environment variable. Also used as `MAX_CONTENT_LENGTH`
+of the app."""
+
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", "50000000"))
+"""Maximum width times height of an uploaded image, set by the
+`MAX_IMAGE_PIXELS` environment variable."""
+
+_CHUNK_SIZE = 64 * 1024
+"""Number of bytes read from the body of a request at a time."""
+
+_SNIFF_SIZE = 12
+"""Number of bytes needed to recognize the format of an image."""
+
+
+class RejectedUpload(ValueError):
+    """Raised when the body of a request can't be scanned."""
+
+    def __init__(self, message: str, status: HTTPStatus) -> None:
+        """Creates a new RejectedUpload object.
+
+        Args:
+            message: Why the body was rejected, to respond with.
+            status: Status to respond with.
+        """
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def read_image(
+    request: Request,
+    max_bytes: int = MAX_UPLOAD_BYTES,
+    max_pixels: int = MAX_IMAGE_PIXELS,
+) -> bytearray:
+    """Reads an image from the body of a request, checking its format and
+    size as it arrives.
+
+    Args:
+        request: Request whose body to read.
+        max_bytes: Maximum size of the body, in bytes.
+        max_pixels: Maximum width times height of the image.
+    Returns:
+        Encoded image.
+    Raises:
+        RejectedUpload: If the body isn't a JPG, PNG, GIF or WebP image, or
+            is too large.
+    """
+    content_length = request.content_length
+    if content_length is not None and content_length > max_bytes:
+        raise _too_large(f"more than {max_bytes} bytes")
+
+    # Grows as the header arrives, and is only allocated in full once the
+    # header has been checked
+    buffer = bytearray()
+    size = 0
+    image_format = None
+    checked_size = False
+    try:
+        stream = request.stream
+        while content_length is None or size < content_length:
+            count = _CHUNK_SIZE
+            if content_length is not None:
+                count = min(count, content_length - size)
+            chunk = stream.read(count)
+            if not chunk:
+                break
+            end = size + len(chunk)
+            if end > max_bytes:
+                raise _too_large(f"more than {max_bytes} bytes")
+            if end <= len(buffer):
+                buffer[size:end] = chunk
+            else:
+                buffer += chunk
+            size = end
+
+            # Reject the body as soon as enough of it has arrived
+            if image_format is None and size >= _SNIFF_SIZE:
+                image_format = sniff_format(buffer)
+                if image_format is None:
+                    raise _not_an_image()
+            if image_format is not None and not checked_size:
+                with memoryview(buffer)[:size] as head:
+                    dimensions = image_size(head, image_format)
+                if dimensions is not None:
+                    width, height = dimensions
+                    if width * height > max_pixels:
+                        raise _too_large(
+                            f"{width}x{height}, more than {max_pixels} pixels"
+                        )
+                    checked_size = True
+                    if content_length is not None:
+                        full = bytearray(content_length)
+                        full[:size] = buffer
+                        buffer = full
+    except RequestEntityTooLarge:
+        raise _too_large(f"more than {max_bytes} bytes")
+
+    if image_format is None:
+        raise _not_an_image()
+    del buffer[size:]
+    return buffer
+
+
+def sniff_format(data: bytes | bytearray) -> str | None:
+    """Recognizes the format of an image from its first bytes.
+
+    Args:
+        data: Start of the encoded image, at least 12 bytes.
+    Returns:
+        "JPEG", "PNG", "GIF" or "WEBP", or `None` if it isn't one of them.
+    """
+    if data.startswith(b"\xff\xd8\xff"):
+        return "JPEG"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "PNG"
+    if data.startswith((b"GIF87a", b"GIF89a")):
+        return "GIF"
+    if data.startswith(b"RIFF") and data[8:12] == b"WEBP":
+        return "WEBP"
+    return None
+
+
+def image_size(data: memoryview, image_format: str) -> tuple[int, int] | None:
+    """Reads the width and height of an image from its header.
+
+    Args:
+        data: View of the start of the encoded image.
+        image_format: Format given by `sniff_format()`.
+    Returns:
+        Width and height, or `None` if the header hasn't all arrived yet.
+    """
+    if image_format == "JPEG":
+        return _jpeg_size(data)
+    if image_format == "PNG" and len(data) >= 24:
+        width, height = struct.unpack_from(">II", data, 16)
+        return width, height
+    if image_format == "GIF" and len(data) >= 10:
+        width, height = struct.unpack_from("<HH", data, 6)
+        return width, height
+    if image_format == "WEBP" and len(data) >= 30:
+        return _webp_size(data)
+    return None
+
+
+def _jpeg_size(data: memoryview) -> tuple[int, int] | None:
+    """Reads the width and height of a JPEG from its start of frame marker,
+    which comes after any metadata, such as EXIF."""
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            return None  # Not a marker, so the JPEG is corrupt
+        marker = data[offset + 1]
+        if marker == 0xFF:  # Padding
+            offset += 1
+            continue
+        (length,) = struct.unpack_from(">H", data, offset + 2)
+        # Start of frame markers, except DHT, JPG and DAC
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            if offset + 9 > len(data):
+                return None
+            height, width = struct.unpack_from(">HH", data, offset + 5)
+            return width, height
+        offset += 2 + length
+    return None
+
+
+def _webp_size(data: memoryview) -> tuple[int, int] | None:
+    """Reads the width and height of a WebP from its first chunk."""
+    chunk = bytes(data[12:16])
+    if chunk == b"VP8 ":
+        width, height = struct.unpack_from("<HH", data, 26)
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b"VP8L":
+        (bits,) = struct.unpack_from("<I", data, 21)
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X":
+        width = int.from_bytes(data[24:27], "little") + 1
+        height = int.from_bytes(data[27:30], "little") + 1
+        return width, height
+    return None
+
+
+def _too_large(reason: str) -> RejectedUpload:
+    """Creates the error for an upload which is too large."""
+    return RejectedUpload(
+        f"The given image is too large ({reason}).",
+        HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+    )
+
+
+def _not_an_image() -> RejectedUpload:
+    """Creates the error for an upload which isn't an image."""
+    return RejectedUpload(
+        "Couldn't read an image from the given body.", HTTPStatus.BAD_REQUEST
+    )
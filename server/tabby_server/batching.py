@@ -0,0 +1,161 @@
+from bisect import bisect_left
+from collections.abc import Callable, Sequence
+from concurrent.futures import Future
+import threading
+import time
+from typing import Any, Generic, TypeVar
+
+"""
+Groups work arriving from concurrent requests into batches, so that a model
+runs once over many inputs instead of once per input.
+"""
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+"""Upper bounds of the buckets of the batch size histograms."""
+
+WAIT_TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+"""Upper bounds of the buckets of the wait time histograms, in seconds."""
+
+
+class Histogram:
+    """Thread-safe histogram counting observed values in buckets."""
+
+    def __init__(self, bounds: Sequence[float]) -> None:
+        """Creates a new Histogram object.
+
+        Args:
+            bounds: Upper bound of each bucket, in increasing order. Values
+                above the last bound are counted in an extra bucket.
+        """
+        self._bounds = tuple(bounds)
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        """Counts a value in the bucket it belongs to."""
+        with self._lock:
+            self._counts[bisect_left(self._bounds, value)] += 1
+            self._sum += value
+
+    def to_dict(self) -> dict[str, Any]:
+        """Gets the histogram as a dict which can be sent as JSON.
+
+        Returns:
+            Dict with "buckets", mapping the upper bound of each bucket to
+            how many values are in it ("+Inf" for the last), "count", the
+            number of values, and "sum", their sum.
+        """
+        with self._lock:
+            labels = [str(b) for b in self._bounds] + ["+Inf"]
+            return {
+                "buckets": dict(zip(labels, self._counts)),
+                "count": sum(self._counts),
+                "sum": self._sum,
+            }
+
+
+class MicroBatcher(Generic[T, R]):
+    """Collects items submitted by concurrent threads into batches, and runs
+    a function once per batch.
+
+    A batch is started by the first item to arrive. It is run once it holds
+    `max_batch_size` items or `window` seconds after that first item arrived,
+    whichever is sooner. Items arriving while a batch runs are put in the
+    next one, so batches grow under load without waiting any longer.
+    """
+
+    def __init__(
+        self,
+        fn: Callable[[list[T]], list[R]],
+        *,
+        max_batch_size: int,
+        window: float,
+    ) -> None:
+        """Creates a new MicroBatcher object.
+
+        Args:
+            fn: Function run on each batch. Given a list of items, returns a
+                list of results in the same order.
+            max_batch_size: Maximum number of items in a batch.
+            window: Maximum time, in seconds, the first item of a batch waits
+                for others to join it.
+        """
+        self._fn = fn
+        self._max_batch_size = max(max_batch_size, 1)
+        self._window = window
+        self._queue: list[tuple[T, Future, float]] = []
+        self._condition = threading.Condition()
+        self._thread: threading.Thread | None = None
+
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        """Number of items in each batch run."""
+
+        self.wait_times = Histogram(WAIT_TIME_BUCKETS)
+        """Seconds each item waited for its batch to start running."""
+
+    def submit(self, item: T) -> R:
+        """Adds an item to the next batch, then waits for its result.
+
+        Args:
+            item: Item to add.
+        Returns:
+            Result for the item.
+        Raises:
+            Exception: Whatever the function raised on the batch.
+        """
+        future: Future = Future()
+        with self._condition:
+            # Started on first use, since threads don't survive forking
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._queue.append((item, future, time.monotonic()))
+            self._condition.notify()
+        return future.result()
+
+    def stats(self) -> dict[str, Any]:
+        """Gets the batch size and wait time histograms as a dict which can
+        be sent as JSON."""
+        return {
+            "batch_size": self.batch_sizes.to_dict(),
+            "wait_seconds": self.wait_times.to_dict(),
+        }
+
+    def _run(self) -> None:
+        """Runs batches forever, in the batcher's thread."""
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                deadline = self._queue[0][2] + self._window
+                while len(self._queue) < self._max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                size = self._max_batch_size
+                batch = self._queue[:size]
+                del self._queue[:size]
+
+            start = time.monotonic()
+            self.batch_sizes.observe(len(batch))
+            for _, _, submitted in batch:
+                self.wait_times.observe(start - submitted)
+
+            try:
+                results = self._fn([item for item, _, _ in batch])
+                if len(results) != len(batch):
+                    raise ValueError(
+                        f"Got {len(results)} results for a batch of "
+                        f"{len(batch)} items"
+                    )
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
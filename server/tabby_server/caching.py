@@ -0,0 +1,112 @@
+from collections import OrderedDict
+from collections.abc import Hashable
+import threading
+import time
+from typing import Any, Generic, TypeVar
+
+from tabby_server.vision.hashing import hamming_distance
+
+"""
+Caches results by the perceptual hash of the image they were computed from,
+so that scanning nearly the same image again doesn't redo the work.
+"""
+
+V = TypeVar("V")
+
+
+class PerceptualCache(Generic[V]):
+    """Thread-safe cache mapping perceptual hashes of images to results.
+
+    A lookup matches any stored hash within `max_distance` bits of the given
+    one, under the same key, so a retaken or recompressed image finds the
+    result of the original. Entries expire `ttl` seconds after being stored,
+    and the least recently used entry is evicted when the cache is full.
+    """
+
+    def __init__(
+        self, *, max_size: int, ttl: float, max_distance: int
+    ) -> None:
+        """Creates a new PerceptualCache object.
+
+        Args:
+            max_size: Maximum number of entries. If 0, nothing is stored.
+            ttl: Seconds an entry is kept after being stored.
+            max_distance: Maximum number of bits in which a stored hash can
+                differ from the one looked up to match it.
+        """
+        self._max_size = max_size
+        self._ttl = ttl
+        self._max_distance = max_distance
+        self._entries: OrderedDict[tuple[Hashable, int], tuple[V, float]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        """Number of lookups which found a result."""
+
+        self.misses = 0
+        """Number of lookups which found nothing."""
+
+    def get(self, key: Hashable, image_hash: int) -> V | None:
+        """Looks up the result stored for the closest matching hash.
+
+        Args:
+            key: Key the result was stored under, such as the options it was
+                computed with.
+            image_hash: Perceptual hash of the image.
+        Returns:
+            The stored result, or `None` if no hash matches.
+        """
+        with self._lock:
+            now = time.monotonic()
+            best = None
+            best_distance = self._max_distance + 1
+            for entry_key, (_, expiry) in list(self._entries.items()):
+                if expiry <= now:
+                    del self._entries[entry_key]
+                    continue
+                if entry_key[0] != key:
+                    continue
+                distance = hamming_distance(entry_key[1], image_hash)
+                if distance < best_distance:
+                    best, best_distance = entry_key, distance
+
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(best)
+            return self._entries[best][0]
+
+    def put(self, key: Hashable, image_hash: int, value: V) -> None:
+        """Stores a result, evicting the least recently used entry if full.
+
+        Args:
+            key: Key to store the result under.
+            image_hash: Perceptual hash of the image.
+            value: Result to store.
+        """
+        if self._max_size <= 0:
+            return
+        with self._lock:
+            entry_key = (key, image_hash)
+            self._entries[entry_key] = (value, time.monotonic() + self._ttl)
+            self._entries.move_to_end(entry_key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Removes every entry."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict[str, Any]:
+        """Gets the number of hits, misses and entries as a dict which can be
+        sent as JSON."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+            }
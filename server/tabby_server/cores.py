@@ -0,0 +1,133 @@
+import logging
+import os
+from typing import Any
+import cv2 as cv
+import torch
+
+"""
+Divides the CPU cores of the machine between the processes running the
+models.
+
+By default, torch and OpenCV each start as many threads as there are cores
+in every process. With several gunicorn workers or inference processes
+running the models at once, the threads then fight over the cores and every
+request slows down. Instead, each process is given its own slot: a share of
+the cores, whose size sets its thread counts and which it can optionally be
+pinned to.
+"""
+
+CPU_CORES = int(os.getenv("CPU_CORES", "0"))
+"""Maximum number of cores shared between the processes, set by the
+`CPU_CORES` environment variable. If 0, every core available is used."""
+
+PIN_CPU_CORES = bool(int(os.getenv("PIN_CPU_CORES", "0")))
+"""True if each process should only be allowed to run on its own cores,
+false if only its thread counts should be set."""
+
+_layout: dict[str, Any] | None = None
+"""Slot assigned to this process by `assign()`, or `None` if not assigned."""
+
+
+def available_cores() -> list[int]:
+    """Gets the cores this process may use, limited to `CPU_CORES`.
+
+    Returns:
+        IDs of the cores, in increasing order. If this process was assigned
+        a slot, only the cores of the slot.
+    """
+    if _layout is not None:
+        return list(_layout["cores"])
+    try:
+        cores = sorted(os.sched_getaffinity(0))
+    except AttributeError:  # Not on Linux
+        cores = list(range(os.cpu_count() or 1))
+    if CPU_CORES > 0:
+        cores = cores[:CPU_CORES]
+    return cores
+
+
+def split_cores(cores: list[int], slots: int) -> list[list[int]]:
+    """Divides cores into slots as evenly as possible.
+
+    Each core belongs to exactly one slot if there are at least as many
+    cores as slots. Otherwise, each slot gets one core, and slots share
+    cores in turn.
+
+    Args:
+        cores: IDs of the cores to divide.
+        slots: Number of slots.
+    Returns:
+        IDs of the cores of each slot.
+    """
+    if slots >= len(cores):
+        return [[cores[i % len(cores)]] for i in range(slots)]
+    size, extra = divmod(len(cores), slots)
+    groups = []
+    start = 0
+    for i in range(slots):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(cores[start:end])
+        start = end
+    return groups
+
+
+def assign(
+    slot: int,
+    slots: int,
+    cores: list[int] | None = None,
+    pin: bool = PIN_CPU_CORES,
+) -> list[int]:
+    """Gives this process one slot of the cores, setting the number of
+    threads torch and OpenCV run on to its number of cores.
+
+    Args:
+        slot: Index of the slot of this process, from 0 to `slots - 1`.
+        slots: Number of processes the cores are divided between.
+        cores: IDs of the cores to divide. Defaults to
+            `available_cores()`.
+        pin: If true, only allow this process to run on the cores of its
+            slot.
+    Returns:
+        IDs of the cores of the slot.
+    """
+
+    global _layout
+    if cores is None:
+        cores = available_cores()
+    slot_cores = split_cores(cores, max(slots, 1))[slot % max(slots, 1)]
+
+    torch.set_num_threads(len(slot_cores))
+    cv.setNumThreads(len(slot_cores))
+    pinned = False
+    if pin and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, slot_cores)
+        pinned = True
+
+    _layout = {
+        "slot": slot,
+        "slots": slots,
+        "cores": slot_cores,
+        "pinned": pinned,
+    }
+    logging.info(
+        f"Process {os.getpid()} got slot {slot + 1}/{slots} with cores "
+        f"{slot_cores}{' (pinned)' if pinned else ''}"
+    )
+    return slot_cores
+
+
+def layout() -> dict[str, Any]:
+    """Gets how the cores are divided for this process, as a dict which can
+    be sent as JSON.
+
+    Returns:
+        Dict with "torch_threads" and "opencv_threads", the number of
+        threads each library runs on. If a slot was assigned, also has
+        "slot", its index, "slots", the number of slots, "cores", the IDs of
+        its cores, and "pinned", whether the process only runs on them.
+    """
+    return {
+        **(_layout or {}),
+        "torch_threads": torch.get_num_threads(),
+        "opencv_threads": cv.getNumThreads(),
+    }
@@ -0,0 +1,189 @@
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import logging
+import multiprocessing
+from multiprocessing.sharedctypes import Synchronized
+import os
+import threading
+from typing import Any, TypeVar
+
+from tabby_server import cores
+
+"""
+Runs model inference in a pool of long-lived processes, separate from the
+ones serving requests.
+
+Request handlers hand each piece of CPU-heavy work to `run()`, `run_all()` or
+`run_each()`, which send it through the pool's queue and wait for the result.
+This way, a slow scan only holds up a request thread while cheap endpoints
+like `/books/search` keep being served, and the number of processes running
+the models can be sized independently of how many requests are served at
+once.
+
+If the pool isn't started, the work runs in the calling thread instead.
+"""
+
+T = TypeVar("T")
+
+WORKERS = int(os.getenv("INFERENCE_WORKERS", "0"))
+"""Number of processes in the pool, set by the `INFERENCE_WORKERS`
+environment variable. If 0, no pool is used."""
+
+_pool: ProcessPoolExecutor | None = None
+"""Pool running the work, or `None` if not started."""
+
+_pool_lock = threading.Lock()
+"""Lock held while starting or replacing the pool."""
+
+
+def start(workers: int = WORKERS) -> None:
+    """Starts the pool and waits until its processes are ready. Each process
+    loads and warms up the models before taking any work.
+
+    Args:
+        workers: Number of processes in the pool. If 0, no pool is started.
+    """
+
+    global _pool
+    if workers <= 0:
+        return
+    with _pool_lock:
+        if _pool is None:
+            _pool = _create_pool(workers)
+        pool = _pool
+    # Forked processes are all launched on the first submit
+    list(pool.map(_process_id, range(workers)))
+    logging.info(f"Started inference pool with {workers} processes")
+
+
+def shutdown() -> None:
+    """Stops the pool, if started, after its queued work is done."""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown()
+
+
+def run(fn: Callable[..., T], *args: Any) -> T:
+    """Runs a function in the pool and waits for its result.
+
+    Args:
+        fn: Function to run. Must be defined at the top level of a module,
+            so that it can be sent to another process.
+        *args: Arguments given to the function. Must be picklable.
+    Returns:
+        The return value of the function.
+    """
+    pool = _pool
+    if pool is None:
+        return fn(*args)
+    try:
+        return pool.submit(fn, *args).result()
+    except BrokenProcessPool:
+        _replace_pool(pool)
+        raise
+
+
+def run_all(fn: Callable[..., T], *iterables: Iterable[Any]) -> list[T]:
+    """Runs a function in the pool for each set of arguments, in parallel,
+    and waits for every result.
+
+    Args:
+        fn: Same as `run()`.
+        *iterables: Iterables of arguments, like for `map()`.
+    Returns:
+        The return value of each call, in order.
+    """
+    return list(run_each(fn, *iterables))
+
+
+def run_each(fn: Callable[..., T], *iterables: Iterable[Any]) -> Iterator[T]:
+    """Runs a function in the pool for each set of arguments, in parallel,
+    giving each result as soon as it and the ones before it are done. The
+    caller can then work on the first results while the rest are computed.
+
+    Args:
+        fn: Same as `run()`.
+        *iterables: Iterables of arguments, like for `map()`.
+    Returns:
+        Iterator over the return value of each call, in order.
+    """
+    pool = _pool
+    if pool is None:
+        yield from map(fn, *iterables)
+        return
+    try:
+        yield from pool.map(fn, *iterables)
+    except BrokenProcessPool:
+        _replace_pool(pool)
+        raise
+
+
+def _create_pool(workers: int, fork: bool = True) -> ProcessPoolExecutor:
+    """Creates a pool whose processes load and warm up the models.
+
+    Args:
+        workers: Number of processes in the pool.
+        fork: If true, fork the processes where possible. Only safe while
+            the calling process has a single thread.
+    """
+
+    # Forking lets the processes share the models preloaded by gunicorn
+    methods = multiprocessing.get_all_start_methods()
+    method = "spawn"
+    if fork and "fork" in methods:
+        method = "fork"
+    elif "forkserver" in methods:
+        method = "forkserver"
+    context = multiprocessing.get_context(method)
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=context,
+        initializer=_init_process,
+        initargs=(context.Value("i", 0), workers, cores.available_cores()),
+    )
+
+
+def _replace_pool(broken: ProcessPoolExecutor) -> None:
+    """Replaces a pool after one of its processes died, such as by running
+    out of memory, which breaks the whole pool."""
+    global _pool
+    with _pool_lock:
+        if _pool is not broken:  # Already replaced
+            return
+        logging.error("Inference process died, restarting the pool")
+        workers = broken._max_workers  # type: ignore[attr-defined]
+        broken.shutdown(wait=False, cancel_futures=True)
+        # Request threads (and others) are running by now, and forking them
+        # could copy a lock another thread holds into the new processes
+        _pool = _create_pool(workers, fork=False)
+
+
+def _init_process(
+    counter: Synchronized, workers: int, pool_cores: list[int]
+) -> None:
+    """Gives a new process of the pool its share of the pool's cores, then
+    loads and warms up the models in it.
+
+    Args:
+        counter: Number of processes started so far, shared by the pool.
+        workers: Number of processes in the pool.
+        pool_cores: IDs of the cores the pool runs on.
+    """
+    from tabby_server import startup
+
+    with counter.get_lock():
+        slot = counter.value % workers
+        counter.value += 1
+    cores.assign(slot, workers, pool_cores)
+
+    startup.load_models()
+    startup.warm_up()
+    startup.log_memory_usage(f"Inference process {os.getpid()}")
+
+
+def _process_id(_: int) -> int:
+    """Gets the ID of the process running this."""
+    return os.getpid()
@@ -0,0 +1,330 @@
+from collections.abc import Callable
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any
+import uuid
+
+"""
+Runs long jobs, such as scanning a shelf, in the background instead of while
+a request waits for them.
+
+Jobs are stored in a SQLite database, so they survive the process which
+queued them restarting, and can be shared by every gunicorn worker on the
+machine. Background threads in each worker take the oldest queued job, run
+it, and store its progress and result for clients to poll. A job whose
+worker died while running it is taken again once its lease runs out.
+"""
+
+JobHandler = Callable[
+    [dict[str, Any], bytes, Callable[[dict[str, Any]], None]], dict[str, Any]
+]
+"""Function running a job. Takes its parameters, its payload and a function
+to report its progress with, and returns its result."""
+
+QUEUED = "queued"
+"""Status of a job waiting to be run."""
+
+RUNNING = "running"
+"""Status of a job being run."""
+
+DONE = "done"
+"""Status of a job which finished, with a result."""
+
+FAILED = "failed"
+"""Status of a job which raised an error, or whose workers kept dying."""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    payload BLOB,
+    progress TEXT,
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    expires REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, created);
+"""
+"""Tables of the database."""
+
+_POLL_INTERVAL = 1.0
+"""Seconds an idle worker waits before checking for jobs queued by other
+processes."""
+
+
+class QueueFull(RuntimeError):
+    """Raised when a job is submitted while the queue is full."""
+
+
+class JobQueue:
+    """Durable queue of jobs, run by background threads.
+
+    Every process may use the same database. The threads of each process
+    are started by `start()`, or the first time a job is submitted.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        handler: JobHandler,
+        *,
+        workers: int,
+        ttl: float,
+        lease: float,
+        max_queued: int,
+        max_attempts: int = 3,
+    ) -> None:
+        """Creates a new JobQueue object. The database is only opened when
+        it is first used.
+
+        Args:
+            path: Path to the SQLite database, created if missing.
+            handler: Function running each job.
+            workers: Number of threads running jobs in each process. If 0,
+                jobs are only run by `run_next()`.
+            ttl: Seconds the result of a job is kept after it finishes, and
+                a queued job is kept waiting to be run before it is dropped.
+            lease: Seconds a job can go without reporting progress before it
+                is assumed to have been abandoned, and is run again.
+            max_queued: Maximum number of jobs waiting to be run. Each keeps
+                its payload until it is run.
+            max_attempts: Number of times a job is started before it fails.
+        """
+        self._path = path
+        self._handler = handler
+        self._workers = workers
+        self._ttl = ttl
+        self._lease = lease
+        self._max_queued = max_queued
+        self._max_attempts = max_attempts
+        self._local = threading.local()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._started_pid: int | None = None
+
+    def submit(
+        self, params: dict[str, Any], payload: bytes | bytearray
+    ) -> str:
+        """Queues a job.
+
+        Args:
+            params: Parameters of the job, which can be sent as JSON.
+            payload: Data of the job, such as an uploaded image.
+        Returns:
+            ID of the job.
+        Raises:
+            QueueFull: If `max_queued` jobs are already waiting to be run.
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        db = self._connect()
+        with db:
+            # Lock the database, so that workers can't fill the queue at once
+            db.execute("BEGIN IMMEDIATE")
+            self._purge_expired(db, now)
+            (queued,) = db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)
+            ).fetchone()
+            if queued >= self._max_queued:
+                raise QueueFull(f"{queued} jobs are already queued")
+            db.execute(
+                "INSERT INTO jobs (id, status, params, payload, created,"
+                " updated, expires) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job_id,
+                    QUEUED,
+                    json.dumps(params),
+                    payload,
+                    now,
+                    now,
+                    now + self._ttl,
+                ),
+            )
+        self.start()
+        self._wake.set()
+        return job_id
+
+    def get(self, job_id: str) -> dict[str, Any] | None:
+        """Gets the status of a job, which can be sent as JSON.
+
+        Args:
+            job_id: ID of the job.
+        Returns:
+            Dict with "id", "status", "progress" reported so far, "result"
+            once done, and "error" if failed. `None` if there is no such job,
+            or it expired.
+        """
+        if not self._exists():
+            return None
+        db = self._connect()
+        with db:
+            self._purge_expired(db, time.time())
+        row = db.execute(
+            "SELECT status, progress, result, error FROM jobs" " WHERE id = ?",
+            (job_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        status, progress, result, error = row
+        return {
+            "id": job_id,
+            "status": status,
+            "progress": json.loads(progress) if progress else None,
+            "result": json.loads(result) if result else None,
+            "error": error,
+        }
+
+    def run_next(self) -> bool:
+        """Takes the oldest queued or abandoned job, and runs it in this
+        thread.
+
+        Returns:
+            True if a job was run, false if there were none.
+        """
+        claimed = self._claim()
+        if claimed is None:
+            return False
+        job_id, params, payload, attempts = claimed
+        if attempts > self._max_attempts:
+            logging.error(f"Job {job_id} abandoned {attempts - 1} times")
+            self._finish(job_id, FAILED, error="The job kept crashing.")
+            return True
+
+        logging.info(f"Running job {job_id}")
+
+        def report(progress: dict[str, Any]) -> None:
+            with self._connect() as db:
+                db.execute(
+                    "UPDATE jobs SET progress = ?, updated = ? WHERE id = ?",
+                    (json.dumps(progress), time.time(), job_id),
+                )
+
+        try:
+            result = self._handler(params, payload, report)
+        except Exception as e:
+            logging.exception(f"Job {job_id} failed")
+            self._finish(job_id, FAILED, error=str(e) or type(e).__name__)
+        else:
+            self._finish(job_id, DONE, result=result)
+        return True
+
+    def start(self) -> None:
+        """Starts the threads running jobs in this process, if not already
+        started. Safe to call again after forking."""
+        with self._lock:
+            if self._started_pid == os.getpid() or self._workers <= 0:
+                return
+            self._started_pid = os.getpid()
+            for i in range(self._workers):
+                threading.Thread(
+                    target=self._work, name=f"job-worker-{i}", daemon=True
+                ).start()
+
+    def stats(self) -> dict[str, int]:
+        """Gets the number of jobs with each status, as a dict which can be
+        sent as JSON."""
+        counts = {status: 0 for status in (QUEUED, RUNNING, DONE, FAILED)}
+        if not self._exists():
+            return counts
+        rows = (
+            self._connect()
+            .execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+            .fetchall()
+        )
+        counts.update(dict(rows))
+        return counts
+
+    def _work(self) -> None:
+        """Runs jobs until the process exits."""
+        while True:
+            try:
+                if self.run_next():
+                    continue
+            except sqlite3.Error:
+                logging.exception("Couldn't take a job from the queue")
+            self._wake.wait(_POLL_INTERVAL)
+            self._wake.clear()
+
+    def _claim(self) -> tuple[str, dict[str, Any], bytes, int] | None:
+        """Marks the oldest queued or abandoned job as running.
+
+        Returns:
+            ID, parameters, payload and number of times started of the job,
+            or `None` if there are none.
+        """
+        now = time.time()
+        db = self._connect()
+        with db:
+            # Lock the database, so that two workers can't take the same job
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT id, params, payload, attempts FROM jobs"
+                " WHERE status = ? OR (status = ? AND updated < ?)"
+                " ORDER BY created LIMIT 1",
+                (QUEUED, RUNNING, now - self._lease),
+            ).fetchone()
+            if row is None:
+                return None
+            job_id, params, payload, attempts = row
+            # Running jobs are kept until they finish or are abandoned
+            db.execute(
+                "UPDATE jobs SET status = ?, attempts = ?, updated = ?,"
+                " expires = NULL WHERE id = ?",
+                (RUNNING, attempts + 1, now, job_id),
+            )
+        return job_id, json.loads(params), payload, attempts + 1
+
+    def _finish(
+        self,
+        job_id: str,
+        status: str,
+        *,
+        result: dict[str, Any] | None = None,
+        error: str | None = None,
+    ) -> None:
+        """Stores the outcome of a job and drops its payload. The job then
+        expires after the TTL."""
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?,"
+                " payload = NULL, updated = ?, expires = ? WHERE id = ?",
+                (
+                    status,
+                    json.dumps(result) if result is not None else None,
+                    error,
+                    now,
+                    now + self._ttl,
+                    job_id,
+                ),
+            )
+
+    def _purge_expired(self, db: sqlite3.Connection, now: float) -> None:
+        """Deletes the queued jobs which waited too long to be run, and the
+        finished jobs whose results expired."""
+        db.execute("DELETE FROM jobs WHERE expires < ?", (now,))
+
+    def _exists(self) -> bool:
+        """Checks if the database was created, without creating it."""
+        return getattr(self._local, "db", None) is not None or os.path.exists(
+            self._path
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        """Gets the connection of this thread, opening it on first use."""
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self._path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(_SCHEMA)
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
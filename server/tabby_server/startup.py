@@ -0,0 +1,106 @@
+import logging
+import os
+import resource
+import cv2 as cv
+import torch
+
+from tabby_server.api import books
+from tabby_server.vision import image_labelling, ocr
+
+"""
+Loads the models and runs them once before the server takes any requests.
+
+Without this, the first scan after every deploy or worker restart would pay
+for loading EasyOCR and for the first (slow) inference of each model. These
+functions are called by the gunicorn hooks in `gunicorn.conf.py`.
+"""
+
+WARMUP_IMAGE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "vision", "warmup.jpg"
+)
+"""Path to the image of a shelf the models are warmed up with."""
+
+
+_MEMORY_FIELDS = ("Rss", "Pss", "Shared_Clean", "Shared_Dirty")
+"""Fields read from /proc/self/smaps_rollup, in kB."""
+
+
+def load_models() -> None:
+    """Loads every model used to scan books, if not already loaded.
+
+    Everything the models need to run is created here rather than in the
+    first inference, so that it can be shared by the workers when the models
+    are loaded before forking.
+    """
+
+    # The YOLO model is loaded when image_labelling is imported. It folds its
+    # batch norms into its convolutions the first time it runs, creating new
+    # weights, so do it now. Does nothing if already done.
+    if isinstance(image_labelling.model.model, torch.nn.Module):
+        image_labelling.model.fuse(verbose=False)
+
+    with books.logging_duration("Load EasyOCR reader"):
+        books.get_text_recognizer()
+
+
+def warm_up() -> None:
+    """Runs each model once on the warm-up image. Nothing is sent to ChatGPT
+    or Google Books.
+
+    Raises:
+        FileNotFoundError: If the warm-up image can't be read.
+    """
+
+    image = cv.imread(WARMUP_IMAGE_PATH)
+    if image is None:
+        raise FileNotFoundError(
+            f"Couldn't read the warm-up image at {WARMUP_IMAGE_PATH}"
+        )
+
+    with books.logging_duration("Warm up YOLO model"):
+        image_tensor, _ = image_labelling.letterboxer.letterbox(image)
+        image_labelling.find_books(image_tensor, check_values=False)
+
+    with books.logging_duration("Warm up EasyOCR reader"):
+        books.get_text_recognizer().find_text_scaled(
+            image, ladder=(ocr.MAX_AREA,)
+        )
+
+
+def memory_usage() -> dict[str, int]:
+    """Gets how much memory this process uses, in kB.
+
+    Returns:
+        Dict with "Rss", the memory the process uses. On Linux, also has
+        "Pss", which splits memory shared with other processes evenly between
+        them, and "Shared_Clean" and "Shared_Dirty", the memory shared with
+        other processes.
+    """
+
+    usage = {}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in _MEMORY_FIELDS:
+                    usage[name] = int(value.split()[0])
+    except OSError:  # Not on Linux, so use the peak instead
+        usage["Rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage
+
+
+def log_memory_usage(name: str) -> None:
+    """Logs how much memory this process uses.
+
+    Args:
+        name: Name of the process in the log.
+    """
+    usage = memory_usage()
+    shared = usage.get("Shared_Clean", 0) + usage.get("Shared_Dirty", 0)
+    message = f"{name} memory: RSS {usage['Rss'] / 1024:.0f} MiB"
+    if "Pss" in usage:
+        message += (
+            f", PSS {usage['Pss'] / 1024:.0f} MiB"
+            f", shared {shared / 1024:.0f} MiB"
+        )
+    logging.info(message)
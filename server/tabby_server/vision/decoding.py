@@ -0,0 +1,88 @@
+from io import BytesIO
+import os
+import cv2 as cv
+from cv2.typing import MatLike
+import numpy as np
+import PIL
+from PIL import Image, ImageOps
+
+"""
+Decodes uploaded images straight into the BGR arrays the rest of the server
+works on.
+
+Decoding with Pillow, then converting to RGB, to a numpy array and to BGR,
+makes several full-size copies of the image. Instead, OpenCV decodes the
+bytes of the request directly into one contiguous BGR array, applying the
+EXIF orientation of the image as it does. Large JPEGs are decoded at a
+reduced scale, which skips most of the work of decoding them, as long as the
+result is still at least `DECODE_MIN_AREA` pixels.
+"""
+
+DECODE_MIN_AREA = int(os.getenv("DECODE_MIN_AREA", "3000000"))
+"""Minimum area, in pixels, a JPEG may be reduced to while decoding it, set
+by the `DECODE_MIN_AREA` environment variable. If 0, images are always
+decoded at full resolution."""
+
+_REDUCED_FLAGS = (
+    (8, cv.IMREAD_REDUCED_COLOR_8),
+    (4, cv.IMREAD_REDUCED_COLOR_4),
+    (2, cv.IMREAD_REDUCED_COLOR_2),
+)
+"""Flags for decoding an image with its sides divided by each factor, from
+the largest factor to the smallest."""
+
+
+def decode_image(
+    data: bytes | bytearray, min_area: int = DECODE_MIN_AREA
+) -> MatLike | None:
+    """Decodes an image into a BGR array, upright according to its EXIF
+    orientation.
+
+    Args:
+        data: Encoded image, such as a JPG or PNG.
+        min_area: Minimum area, in pixels, a JPEG may be reduced to. If 0,
+            the image is decoded at full resolution.
+    Returns:
+        Contiguous BGR image, or `None` if the data isn't an image.
+    """
+    # Only the header is read here
+    try:
+        with Image.open(BytesIO(data)) as image:
+            image_format = image.format
+            width, height = image.size
+    except PIL.UnidentifiedImageError:
+        return None
+
+    flags = cv.IMREAD_COLOR
+    if image_format in ("JPEG", "MPO") and min_area > 0:
+        flags = _reduced_flags(width, height, min_area)
+
+    decoded = cv.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+    if decoded is None:  # Format OpenCV can't read, such as GIF
+        decoded = _decode_with_pillow(data)
+    return decoded
+
+
+def _reduced_flags(width: int, height: int, min_area: int) -> int:
+    """Gets the flags for decoding an image as small as possible while
+    keeping at least `min_area` pixels."""
+    for factor, flags in _REDUCED_FLAGS:
+        if (width // factor) * (height // factor) >= min_area:
+            return flags
+    return cv.IMREAD_COLOR
+
+
+def _decode_with_pillow(data: bytes | bytearray) -> MatLike | None:
+    """Decodes an image with Pillow, for formats OpenCV can't read.
+
+    Args:
+        data: Encoded image.
+    Returns:
+        Contiguous BGR image, or `None` if it couldn't be decoded.
+    """
+    try:
+        with Image.open(BytesIO(data)) as image:
+            rgb = ImageOps.exif_transpose(image).convert("RGB")
+    except (PIL.UnidentifiedImageError, OSError):
+        return None
+    return cv.cvtColor(np.asarray(rgb), cv.COLOR_RGB2BGR)
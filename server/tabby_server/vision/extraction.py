@@ -8,7 +8,7 @@ from openai.types.chat import ChatCompletion
 import logging
 
 from openai import OpenAI
-from tabby_server.vision.ocr import RecognizedText
+from tabby_server.vision.ocr import RecognizedText, RecognizedTextBatch
 
 # Load environmental variables from dotenv if they aren't already.
 load_dotenv()
@@ -85,22 +85,30 @@ class ExtractionResult:
 
 
 def extract_from_recognized_texts(
-    recognized_texts: list[RecognizedText],
+    recognized_texts: list[RecognizedText] | RecognizedTextBatch,
 ) -> Optional[ExtractionResult]:
     """Attempts to extract a result from the recognized texts by utilizing
     ChatGPT.
 
     Args:
-        recognized_texts: List of `RecognizedText` objects to extract from.
+        recognized_texts: Batch or list of `RecognizedText` objects to extract
+            from.
     Returns:
         An extraction result, which contains a list of options (pairs of
         titles and authors).
     """
 
+    if not isinstance(recognized_texts, RecognizedTextBatch):
+        recognized_texts = RecognizedTextBatch.from_texts(recognized_texts)
+
     # Create messages list to send as input
     input_message = "\n".join(
-        f"{r.text} {_SEPERATOR} {r.area} {_SEPERATOR} {r.center[0]}, {r.center[1]}"  # noqa: E501
-        for r in recognized_texts
+        f"{text} {_SEPERATOR} {area} {_SEPERATOR} {cx}, {cy}"
+        for text, area, (cx, cy) in zip(
+            recognized_texts.texts.tolist(),
+            recognized_texts.areas.tolist(),
+            recognized_texts.centers.tolist(),
+        )
     )
     messages = [
         {"role": "system", "content": _SYSTEM_MESSAGE},
@@ -0,0 +1,88 @@
+import cv2 as cv
+from cv2.typing import MatLike
+import numpy as np
+
+"""
+Perceptual hashes of images, which stay nearly the same when an image is
+recompressed, resized or slightly retaken, unlike hashes of the bytes.
+"""
+
+HASH_BITS = 64
+"""Number of bits in a perceptual hash."""
+
+_HASH_SIZE = 8
+"""Width and height of the block of low frequencies making up a hash."""
+
+_DCT_SIZE = 32
+"""Width and height an image is shrunk to before taking its DCT."""
+
+
+_ASPECT_STEPS = 4
+"""Number of aspect ratio buckets per doubling of the ratio of height to
+width."""
+
+
+def perceptual_hash(image: MatLike, pad_to_square: bool = False) -> int:
+    """Gets the perceptual hash (pHash) of an image.
+
+    The image is shrunk to a small greyscale square, so the hash doesn't
+    depend on its size, and only the lowest frequencies of its DCT are kept.
+    Each bit of the hash is whether one of them is above their median.
+
+    Args:
+        image: Image to hash, either BGR or greyscale.
+        pad_to_square: If true, the image is first padded to a square with
+            its mean brightness, so that it keeps its aspect ratio when
+            shrunk. Otherwise, long and narrow images such as spines are
+            stretched until their details are lost.
+    Returns:
+        Hash of `HASH_BITS` bits.
+    """
+    if image.ndim == 3:
+        image = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+    if pad_to_square:
+        image = _pad_to_square(image)
+    small = cv.resize(
+        image, (_DCT_SIZE, _DCT_SIZE), interpolation=cv.INTER_AREA
+    )
+    frequencies = cv.dct(small.astype(np.float32))
+    low = frequencies[:_HASH_SIZE, :_HASH_SIZE].flatten()
+    bits = low > np.median(low[1:])  # The first one is the mean brightness
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def aspect_bucket(image: MatLike) -> int:
+    """Gets a coarse bucket of the aspect ratio of an image, to tell apart
+    images whose hashes match but whose shapes don't.
+
+    Args:
+        image: Image to get the aspect ratio of.
+    Returns:
+        Ratio of height to width on a log scale, rounded to one of
+        `_ASPECT_STEPS` steps per doubling.
+    """
+    height, width = image.shape[:2]
+    return round(_ASPECT_STEPS * np.log2(max(height, 1) / max(width, 1)))
+
+
+def _pad_to_square(image: MatLike) -> MatLike:
+    """Pads a greyscale image on both sides of its shortest dimension with
+    its mean brightness, so that it's centered in a square."""
+    height, width = image.shape[:2]
+    size = max(height, width)
+    top = (size - height) // 2
+    left = (size - width) // 2
+    return cv.copyMakeBorder(
+        image,
+        top,
+        size - height - top,
+        left,
+        size - width - left,
+        cv.BORDER_CONSTANT,
+        value=cv.mean(image)[0],
+    )
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """Gets the number of bits which differ between two hashes."""
+    return (a ^ b).bit_count()
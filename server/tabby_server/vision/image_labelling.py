@@ -1,10 +1,17 @@
-from contextlib import contextmanager
-from typing import Any
+from dataclasses import dataclass
+from typing import Any, Literal, cast
 from ultralytics import YOLO
+from ultralytics.engine.results import Results
+import cv2
+import numpy as np
+import threading
 import torch
 import json
+import logging
 import os
 
+from tabby_server import batching, inference
+
 """
 Enables You Only Look Once (YOLO) image recognition.
 
@@ -15,43 +22,264 @@ This is unroutable and onlt meant to be called by an endpoint.
 """
 
 
-@contextmanager
-def temp_dir(path):
+# Expected Image Size for Model to Use
+EXPECTED_SIZE = (640, 640)
+
+BATCH_WINDOW = float(os.getenv("FIND_BOOKS_BATCH_WINDOW_MS", "10")) / 1000
+"""Maximum seconds an image waits for others to be batched with it in
+`find_books_batched()`."""
+
+MAX_BATCH_SIZE = int(os.getenv("FIND_BOOKS_MAX_BATCH_SIZE", "8"))
+"""Maximum number of images batched together in `find_books_batched()`."""
+
+Backend = Literal["torch", "onnx", "openvino"]
+"""Runtime used to run the model."""
+
+MODEL_DIR = os.path.dirname(os.path.abspath(__file__))
+"""Directory containing the model and its exported versions."""
+
+MODEL_PATHS: dict[Backend, str] = {
+    "torch": os.path.join(MODEL_DIR, "shelf_yolo.pt"),
+    "onnx": os.path.join(MODEL_DIR, "shelf_yolo.onnx"),
+    "openvino": os.path.join(MODEL_DIR, "shelf_yolo_openvino_model"),
+}
+"""Path to the model for each backend. Every path other than the one for
+torch is created by `scripts/export_yolo.py`."""
+
+BACKEND: Backend = os.getenv("YOLO_BACKEND", "torch")  # type: ignore
+"""Backend the model is run with, set by the `YOLO_BACKEND` environment
+variable."""
+
+
+def load_model(backend: Backend = "torch") -> YOLO:
+    """
+    Loads the shelf model to run with the given backend.
+
+    ONNX Runtime and OpenVINO run the model on the CPU faster and with less
+    memory than PyTorch. They need the model to be exported first. If the
+    exported model is missing, the PyTorch model is loaded instead.
     """
-    Context Manages to allow temporarily changing the working directory to
-    match the given path.
 
-    Ensures that the original path is restored even if the change fails or if
-    an exception occurs when this is in use.
+    path = MODEL_PATHS.get(backend)
+    if path is None:
+        raise ValueError(f"Unknown YOLO backend: {backend!r}")
+    if backend != "torch" and not os.path.exists(path):
+        logging.warning(
+            f"Model for {backend} backend not found at {path}, "
+            "using torch backend instead. "
+            "Export it with scripts/export_yolo.py."
+        )
+        path = MODEL_PATHS["torch"]
+    return YOLO(path, task="segment")
 
-    Primarily to allow directly calling to this function for testing purposes.
+
+# Load pretrained model from the same directory as this file.
+model = load_model(BACKEND)
+
+PAD_VALUE = 114
+"""Value of the padding around a letterboxed image, the same gray the model
+was trained with."""
+
+
+@dataclass(kw_only=True)
+class Letterbox:
+    """
+    How an image was fit into the model's input, so that coordinates found by
+    the model can be mapped back to the original image.
     """
 
-    original_dir = os.getcwd()
-    try:
-        os.chdir(path)
-        yield
-    finally:
-        os.chdir(original_dir)
+    scale: float
+    """How much the image was scaled by."""
 
+    pad_x: int
+    """Width of the padding to the left of the scaled image."""
 
-# Expected Image Size for Model to Use
-EXPECTED_SIZE = (640, 640)
+    pad_y: int
+    """Height of the padding above the scaled image."""
+
+    width: int
+    """Width of the original image."""
+
+    height: int
+    """Height of the original image."""
+
+    x: int = 0
+    """Left of the original image, if it is a tile of a larger image."""
+
+    y: int = 0
+    """Top of the original image, if it is a tile of a larger image."""
+
+    def to_image(self, points: np.ndarray) -> np.ndarray:
+        """
+        Maps (x, y) points from the model's input back to the original image,
+        or to the larger image if it is a tile. Points are not clipped to the
+        image.
+        """
+
+        points = np.asarray(points, dtype=np.float64)
+        return (points - (self.pad_x, self.pad_y)) / self.scale + (
+            self.x,
+            self.y,
+        )
+
+    def box_to_image(self, box: dict[str, float]) -> tuple[int, int, int, int]:
+        """
+        Maps a box found by the model back to the original image.
 
-# TODO: Relative path changed constantly depending
-# on which command and where it is ran. For now,
-# this implimentation works but should be improved
-# in the future.
-with temp_dir("tabby_server/vision/"):
-    # Load pretrained model from other directory.
-    model = YOLO("shelf_yolo.pt")
+        Args:
+            box: Dict with the "x1", "y1", "x2" and "y2" of the box.
+        Returns:
+            (x1, y1, x2, y2) of the box in the original image, with x1 <= x2
+            and y1 <= y2. The box is widened to whole pixels and clipped to
+            the image, so it can be used to slice the image. If the image is
+            a tile, the box is in the larger image, clipped to the tile.
+        """
 
+        corners = self.to_image(
+            np.array([[box["x1"], box["y1"]], [box["x2"], box["y2"]]])
+        )
+        x1, y1 = np.floor(corners.min(axis=0))
+        x2, y2 = np.ceil(corners.max(axis=0))
+        right, bottom = self.x + self.width, self.y + self.height
+        return (
+            int(min(max(x1, self.x), right)),
+            int(min(max(y1, self.y), bottom)),
+            int(min(max(x2, self.x), right)),
+            int(min(max(y2, self.y), bottom)),
+        )
 
-def find_books(tensor_image=None) -> list[dict[str, Any]]:
+
+class Letterboxer:
+    """
+    Prepares images for the model by scaling them to fit its input while
+    keeping their aspect ratio, then padding the rest. Stretching an image
+    instead would make thin spines even thinner.
+
+    The buffers the image is written to are allocated once per thread and
+    reused for every image, so a tensor returned by `letterbox()` is only
+    valid until that thread letterboxes another image.
+    """
+
+    def __init__(self, size: tuple[int, int] = EXPECTED_SIZE) -> None:
+        """
+        Creates a new Letterboxer object.
+
+        Args:
+            size: (height, width) of the model's input.
+        """
+
+        self._size = size
+        self._local = threading.local()
+
+    def _buffers(self) -> tuple[np.ndarray, torch.Tensor]:
+        """Gets the buffers of this thread, allocating them on first use."""
+        if not hasattr(self._local, "pixels"):
+            h, w = self._size
+            self._local.pixels = np.empty((h, w, 3), dtype=np.uint8)
+            self._local.tensor = torch.empty((1, 3, h, w), dtype=torch.float32)
+        return self._local.pixels, self._local.tensor
+
+    def letterbox(self, image: np.ndarray) -> tuple[torch.Tensor, Letterbox]:
+        """
+        Letterboxes an image for the model.
+
+        Args:
+            image: BGR image, as read by OpenCV.
+        Returns:
+            (1) RGB float32 tensor with values from 0 to 1, which can be given
+            to `find_books()`.
+            (2) How the image was letterboxed.
+        """
+
+        pixels, tensor = self._buffers()
+        letterbox = self._fit(image, pixels, tensor[0])
+        return tensor, letterbox
+
+    def letterbox_tiles(
+        self, image: np.ndarray, tiles: list[tuple[int, int, int, int]]
+    ) -> tuple[torch.Tensor, list[Letterbox]]:
+        """
+        Letterboxes tiles of an image for the model, into one batch.
+
+        Unlike `letterbox()`, the tensor is allocated for each call, since
+        the batch can have any size.
+
+        Args:
+            image: BGR image, as read by OpenCV.
+            tiles: (x1, y1, x2, y2) of each tile in the image.
+        Returns:
+            (1) Tensor of shape (N, 3, 640, 640) like the one given by
+            `letterbox()`, which can be given to `find_books_together()`.
+            (2) How each tile was letterboxed, mapping points back to the
+            whole image.
+        """
+
+        pixels, _ = self._buffers()
+        h, w = self._size
+        tensor = torch.empty((len(tiles), 3, h, w), dtype=torch.float32)
+        letterboxes = []
+        for i, (x1, y1, x2, y2) in enumerate(tiles):
+            letterbox = self._fit(image[y1:y2, x1:x2], pixels, tensor[i])
+            letterbox.x, letterbox.y = x1, y1
+            letterboxes.append(letterbox)
+        return tensor, letterboxes
+
+    def _fit(
+        self, image: np.ndarray, pixels: np.ndarray, tensor: torch.Tensor
+    ) -> Letterbox:
+        """
+        Letterboxes an image into the given buffers.
+
+        Args:
+            image: BGR image, as read by OpenCV.
+            pixels: Buffer of shape (640, 640, 3) the image is drawn on.
+            tensor: Tensor of shape (3, 640, 640) the image is written to.
+        Returns:
+            How the image was letterboxed.
+        """
+
+        out_h, out_w = self._size
+        h, w, _ = image.shape
+
+        scale = min(out_w / w, out_h / h)
+        new_w = min(max(round(w * scale), 1), out_w)
+        new_h = min(max(round(h * scale), 1), out_h)
+        pad_x = (out_w - new_w) // 2
+        pad_y = (out_h - new_h) // 2
+
+        resized = cv2.resize(
+            image, (new_w, new_h), interpolation=cv2.INTER_AREA
+        )
+        rows = slice(pad_y, pad_y + new_h)
+        cols = slice(pad_x, pad_x + new_w)
+        pixels.fill(PAD_VALUE)
+        # Reversing the channels turns BGR into RGB
+        pixels[rows, cols] = resized[:, :, ::-1]
+
+        # Converts straight from uint8 into the float32 tensor
+        tensor.copy_(torch.from_numpy(pixels).permute(2, 0, 1))
+        tensor.mul_(1 / 255)
+
+        return Letterbox(
+            scale=scale, pad_x=pad_x, pad_y=pad_y, width=w, height=h
+        )
+
+
+letterboxer = Letterboxer()
+"""Letterboxes images for the model."""
+
+
+def find_books(
+    tensor_image=None, *, check_values: bool = True
+) -> list[dict[str, Any]]:
     """
     When called, it will be given a tensor image matrix. It will verify that it
     is compatible with the yolo model before working.
 
+    Verifying that every value is normalized scans the whole tensor twice.
+    Tensors from `letterboxer.letterbox()` are always normalized, so they can
+    skip it by setting `check_values` to false.
+
     Once verified, The model will then scan the image matrix for books. The
     model uses segmentation, meaning it will attempt to 'cut' out the object
     it finds rather than attempting to use general bounding boxes.
@@ -147,8 +375,10 @@ def find_books(tensor_image=None) -> list[dict[str, Any]]:
         and tensor_image.shape[1] == 3
         and tensor_image.shape[2:] == EXPECTED_SIZE
         and tensor_image.dtype == torch.float32
-        and tensor_image.max() <= 1.0
-        and tensor_image.min() >= 0.0
+        and (
+            not check_values
+            or (tensor_image.max() <= 1.0 and tensor_image.min() >= 0.0)
+        )
     ):
         return [{"bad_tensor": [1]}]
     # tensor_image = tensor_image.float()   # Converts tensor to float32.
@@ -177,6 +407,218 @@ def find_books(tensor_image=None) -> list[dict[str, Any]]:
     return json.loads(output[0].to_json())
 
 
+def find_books_together(tensor_batch: torch.Tensor) -> list[list[dict]]:
+    """
+    Runs the model once over a batch of images. Unlike `find_books()`, the
+    tensor isn't verified, so it must come from `letterboxer.letterbox()`.
+    Run through `inference`.
+
+    Args:
+        tensor_batch: Tensor of shape (N, 3, 640, 640).
+    Returns:
+        For each image, the same list as `find_books()` returns.
+    """
+
+    # Not streaming, so the model gives a list of results
+    output = cast(
+        list[Results],
+        model(
+            source=tensor_batch,
+            conf=0.45,
+            save_conf=True,
+            classes=[0],
+        ),
+    )
+    return [json.loads(result.to_json()) for result in output]
+
+
+def _find_books_batch(tensor_images: list[torch.Tensor]) -> list[list[dict]]:
+    """Runs the model once over tensor images batched together."""
+    return inference.run(find_books_together, torch.cat(tensor_images))
+
+
+batcher = batching.MicroBatcher(
+    _find_books_batch, max_batch_size=MAX_BATCH_SIZE, window=BATCH_WINDOW
+)
+"""Batches images given to `find_books_batched()`."""
+
+
+def find_books_batched(tensor_image: torch.Tensor) -> list[dict[str, Any]]:
+    """
+    Scans an image for books like `find_books()`, but runs the model on it
+    together with the images other threads are scanning at the same time.
+
+    Args:
+        tensor_image: Tensor of shape (1, 3, 640, 640) from
+            `letterboxer.letterbox()`. It isn't verified.
+    Returns:
+        Same as `find_books()`.
+    """
+    return batcher.submit(tensor_image)
+
+
+TILE_OVERLAP = 0.25
+"""Fraction of each tile shared with the next one in `find_books_tiled()`,
+so that a spine cut by the edge of one tile is whole in the next."""
+
+_MERGE_OVERLAP = 0.6
+"""Minimum fraction of the smaller of two boxes found in different tiles
+which the larger one must cover for them to be the same book."""
+
+_SEAM_MARGIN = 2
+"""Distance, in pixels, from the edge of a tile within which a box counts as
+cut by the edge."""
+
+
+def tile_regions(
+    width: int, height: int, max_tiles: int
+) -> list[tuple[int, int, int, int]]:
+    """
+    Divides an image into overlapping tiles along its longer side, each
+    spanning its whole shorter side.
+
+    The number of tiles is chosen from the aspect ratio of the image, so that
+    each tile is about square. An image less than about 1.4 times longer
+    than it is wide is a single tile.
+
+    Args:
+        width: Width of the image.
+        height: Height of the image.
+        max_tiles: Maximum number of tiles. Tiles are made longer to cover
+            the image with no more than this many.
+    Returns:
+        (x1, y1, x2, y2) of each tile, from left to right or top to bottom.
+    """
+
+    long_side, short_side = max(width, height), max(min(width, height), 1)
+    count = round((long_side / short_side - TILE_OVERLAP) / (1 - TILE_OVERLAP))
+    count = min(max(count, 1), max_tiles)
+    if count <= 1:
+        return [(0, 0, width, height)]
+
+    length = long_side / (count - (count - 1) * TILE_OVERLAP)
+    stride = (long_side - length) / (count - 1)
+    tiles = []
+    for i in range(count):
+        start = round(i * stride)
+        end = long_side if i == count - 1 else round(i * stride + length)
+        if width >= height:
+            tiles.append((start, 0, end, height))
+        else:
+            tiles.append((0, start, width, end))
+    return tiles
+
+
+def find_books_tiled(
+    image: np.ndarray, max_tiles: int
+) -> list[tuple[dict[str, Any], Letterbox]]:
+    """
+    Scans an image for books like `find_books_batched()`, first dividing it
+    into tiles with `tile_regions()` if it is much longer than it is wide.
+    Otherwise, a wide panorama of a bookcase is shrunk so much to fit the
+    model's input that each spine is only a few pixels across.
+
+    Every tile is run through the model in one batch, then books found in
+    more than one tile, where the tiles overlap, are merged.
+
+    Args:
+        image: BGR image, as read by OpenCV.
+        max_tiles: Maximum number of tiles. If 1, the image isn't tiled.
+    Returns:
+        Each book found, as given by `find_books()`, with how the image or
+        tile it was found in was letterboxed. The letterbox maps the book
+        back to the whole image.
+    """
+
+    h, w, _ = image.shape
+    tiles = tile_regions(w, h, max_tiles)
+    if len(tiles) == 1:
+        tensor, letterbox = letterboxer.letterbox(image)
+        return [(result, letterbox) for result in find_books_batched(tensor)]
+
+    tensor, letterboxes = letterboxer.letterbox_tiles(image, tiles)
+    results = inference.run(find_books_together, tensor)
+    logging.info(f"Found books in {len(tiles)} tiles of the image.")
+    return _merge_tiles(
+        [
+            (result, letterbox)
+            for tile_results, letterbox in zip(results, letterboxes)
+            for result in tile_results
+        ],
+        w,
+        h,
+    )
+
+
+def _merge_tiles(
+    found: list[tuple[dict[str, Any], Letterbox]], width: int, height: int
+) -> list[tuple[dict[str, Any], Letterbox]]:
+    """
+    Keeps one of each book found in more than one tile.
+
+    A book is the same as another from a different tile if one of their
+    boxes mostly covers the other. Of the two, the one not cut by the edge of
+    its tile is kept, or else the one found with the most confidence.
+
+    Args:
+        found: Each book found and the letterbox of its tile.
+        width: Width of the whole image.
+        height: Height of the whole image.
+    Returns:
+        Books kept, in the same order.
+    """
+
+    boxes = [letterbox.box_to_image(r["box"]) for r, letterbox in found]
+    cut = [
+        _is_cut(box, letterbox, width, height)
+        for box, (_, letterbox) in zip(boxes, found)
+    ]
+    order = sorted(
+        range(len(found)),
+        key=lambda i: (cut[i], -found[i][0].get("confidence", 0.0)),
+    )
+
+    kept: list[int] = []
+    for i in order:
+        if all(
+            found[i][1] is found[k][1]
+            or _overlap(boxes[i], boxes[k]) < _MERGE_OVERLAP
+            for k in kept
+        ):
+            kept.append(i)
+    return [found[i] for i in sorted(kept)]
+
+
+def _is_cut(
+    box: tuple[int, int, int, int],
+    letterbox: Letterbox,
+    width: int,
+    height: int,
+) -> bool:
+    """Checks if a box touches an edge of its tile inside the whole image."""
+    x1, y1, x2, y2 = box
+    left, top = letterbox.x, letterbox.y
+    right, bottom = left + letterbox.width, top + letterbox.height
+    return (
+        (left > 0 and x1 <= left + _SEAM_MARGIN)
+        or (top > 0 and y1 <= top + _SEAM_MARGIN)
+        or (right < width and x2 >= right - _SEAM_MARGIN)
+        or (bottom < height and y2 >= bottom - _SEAM_MARGIN)
+    )
+
+
+def _overlap(
+    a: tuple[int, int, int, int], b: tuple[int, int, int, int]
+) -> float:
+    """Gets the fraction of the smaller of two boxes covered by the other."""
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+    smaller = min((a[2] - a[0]) * (a[3] - a[1]), (b[2] - b[0]) * (b[3] - b[1]))
+    if w <= 0 or h <= 0 or smaller <= 0:
+        return 0.0
+    return w * h / smaller
+
+
 """
 Ultralytics Credits
 @software{yolo11_ultralytics,
@@ -1,12 +1,56 @@
-from dataclasses import dataclass
+from collections.abc import Iterator
+from dataclasses import dataclass, field, replace
+from functools import cached_property
+import math
 from typing import Literal
 import cv2
 import easyocr
+from easyocr.recognition import get_text
+from easyocr.utils import four_point_transform
 import numpy as np
 
 MAX_AREA = 400_000
 """Maximum area an image is allowed to have before using OCR on it."""
 
+SHELF_MAX_AREA = 2_000_000
+"""Maximum area an image of a whole shelf is allowed to have before detecting
+text in it."""
+
+RESOLUTION_LADDER: tuple[int | None, ...] = (MAX_AREA, 4 * MAX_AREA, None)
+"""Maximum areas an image is scaled down to when finding text, from first to
+last try. `None` means the image is used at full resolution."""
+
+_LADDER_MIN_CHARACTERS = 6
+"""Minimum number of characters of confident text that must be found before
+stopping at a resolution."""
+
+_ORIENTATION_ASPECT_RATIO = 1.5
+"""Regions at least this many times taller than they are wide are considered
+sideways, and regions this many times wider than tall are considered
+upright."""
+
+_ORIENTATION_PROBE_REGIONS = 3
+"""Number of the largest regions of text read at each angle to predict the
+orientation of the text."""
+
+_ORIENTATION_MARGIN = 0.15
+"""How much higher the mean confidence at the best angle must be than at any
+other angle for the prediction to be trusted."""
+
+_LINE_HEIGHT = 64
+"""Height every line of text is scaled to before being read, as expected by
+EasyOCR's recognizer."""
+
+_LINE_BATCH_SIZE = 64
+"""Maximum number of lines of text read by the recognizer at once."""
+
+_ROTATE_CODES = {
+    90: cv2.ROTATE_90_CLOCKWISE,
+    180: cv2.ROTATE_180,
+    270: cv2.ROTATE_90_COUNTERCLOCKWISE,
+}
+"""Codes given to cv2.rotate() to rotate an image clockwise by an angle."""
+
 
 @dataclass(kw_only=True)
 class RecognizedText:
@@ -37,11 +81,294 @@ class RecognizedText:
         return np.average(self.corners, axis=0)
 
 
+@dataclass(kw_only=True)
+class RecognizedTextBatch:
+    """Dataclass which represents many pieces of text in an image at once.
+
+    The texts are stored as parallel arrays, so that computing areas and
+    centers, filtering, and mapping coordinates are done for every text in
+    one vectorized operation. The arrays should not be modified in place.
+    """
+
+    texts: np.ndarray
+    """Array of N strings, each being text recognized from the image."""
+
+    corners: np.ndarray
+    """Nx4x2 array of points which represents the corners of the bounds of
+    each recognized text."""
+
+    confidences: np.ndarray
+    """Array of N floats from 0 to 1 representing how confident that each
+    text matches the image."""
+
+    angles: tuple[int, ...] = ()
+    """Angles the image was read at, in the order they were tried. Empty if
+    unknown."""
+
+    @classmethod
+    def from_ocr_results(cls, ocr_results: list) -> "RecognizedTextBatch":
+        """Creates a batch from results given by EasyOCR.
+
+        Args:
+            ocr_results: List of (points, text, confidence) tuples.
+        """
+        if not ocr_results:
+            return cls.empty()
+        points, texts, confidences = zip(*ocr_results)
+        return cls(
+            texts=np.array(texts, dtype=str),
+            corners=np.array(points, dtype=np.int32).reshape(-1, 4, 2),
+            confidences=np.array(confidences, dtype=np.float64),
+        )
+
+    @classmethod
+    def from_texts(cls, texts: list[RecognizedText]) -> "RecognizedTextBatch":
+        """Creates a batch from a list of `RecognizedText` objects."""
+        if not texts:
+            return cls.empty()
+        return cls(
+            texts=np.array([t.text for t in texts], dtype=str),
+            corners=np.array([t.corners for t in texts]).reshape(-1, 4, 2),
+            confidences=np.array(
+                [t.confidence for t in texts], dtype=np.float64
+            ),
+        )
+
+    @classmethod
+    def empty(cls) -> "RecognizedTextBatch":
+        """Creates a batch with no text."""
+        return cls(
+            texts=np.array([], dtype=str),
+            corners=np.zeros((0, 4, 2), dtype=np.int32),
+            confidences=np.zeros(0, dtype=np.float64),
+        )
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def __getitem__(self, i: int) -> RecognizedText:
+        return RecognizedText(
+            text=str(self.texts[i]),
+            corners=self.corners[i],
+            confidence=float(self.confidences[i]),
+        )
+
+    def __iter__(self) -> Iterator[RecognizedText]:
+        return (self[i] for i in range(len(self)))
+
+    @cached_property
+    def areas(self) -> np.ndarray:
+        """Area that each bounding box takes up."""
+        sizes = self.corners.max(axis=1) - self.corners.min(axis=1)
+        return (sizes[:, 0] * sizes[:, 1]).astype(np.float64)
+
+    @cached_property
+    def centers(self) -> np.ndarray:
+        """Nx2 matrix of the center of each bounding box."""
+        return self.corners.mean(axis=1)
+
+    @cached_property
+    def lengths(self) -> np.ndarray:
+        """Length of each text."""
+        return np.char.str_len(self.texts)
+
+    def filtered(
+        self, min_confidence: float = 0.0, min_length: int = 0
+    ) -> "RecognizedTextBatch":
+        """Returns only the texts which are confident and long enough.
+
+        Args:
+            min_confidence: Minimum confidence of each kept text.
+            min_length: Minimum length of each kept text.
+        """
+        keep = (self.confidences >= min_confidence) & (
+            self.lengths >= min_length
+        )
+        return replace(
+            self,
+            texts=self.texts[keep],
+            corners=self.corners[keep],
+            confidences=self.confidences[keep],
+        )
+
+    def transformed(self, matrix: np.ndarray) -> "RecognizedTextBatch":
+        """Returns a copy of this batch with every corner mapped through the
+        given affine transformation.
+
+        Args:
+            matrix: 2x3 affine transformation matrix.
+        """
+        corners = _transform_points(self.corners, matrix)
+        if np.issubdtype(self.corners.dtype, np.integer):
+            corners = np.rint(corners)
+        return replace(self, corners=corners.astype(self.corners.dtype))
+
+
+@dataclass(frozen=True, kw_only=True)
+class QualityBar:
+    """Dataclass which represents how much confident text must be read from
+    an image before no other angle is tried."""
+
+    min_confidence: float = 0.0
+    """Minimum confidence for a text to count."""
+
+    min_length: int = 1
+    """Minimum length for a text to count."""
+
+    min_characters: int = 1
+    """Minimum total number of characters of the texts which count."""
+
+    min_mean_confidence: float = 0.0
+    """Minimum mean confidence of the texts which count."""
+
+    def met_by(self, results: RecognizedTextBatch) -> bool:
+        """Checks if the given results are good enough."""
+        found = results.filtered(self.min_confidence, self.min_length)
+        return (
+            len(found) > 0
+            and int(found.lengths.sum()) >= self.min_characters
+            and float(found.confidences.mean()) >= self.min_mean_confidence
+        )
+
+
+@dataclass(kw_only=True)
+class TextRegions:
+    """Dataclass which represents regions of text found in an image which
+    have not been read yet. Boxes are kept in the formats used by EasyOCR."""
+
+    horizontal: list[list[int]] = field(default_factory=list)
+    """Axis-aligned boxes, each in the format [x_min, x_max, y_min, y_max]."""
+
+    free: list[list[list[int]]] = field(default_factory=list)
+    """Rotated boxes, each as a list of four [x, y] corners."""
+
+    def __len__(self) -> int:
+        return len(self.horizontal) + len(self.free)
+
+    def centers(self) -> np.ndarray:
+        """Nx2 matrix of the center of each region. Centers of horizontal
+        boxes come first, followed by the centers of free boxes."""
+        centers = [np.zeros((0, 2))]
+        if self.horizontal:
+            h = np.array(self.horizontal, dtype=np.float64)
+            centers.append(np.stack([h[:, 0:2].mean(1), h[:, 2:4].mean(1)], 1))
+        if self.free:
+            f = np.array(self.free, dtype=np.float64)
+            centers.append(np.average(f, axis=1))
+        return np.concatenate(centers)
+
+    def sizes(self) -> np.ndarray:
+        """Nx2 matrix of the width and height of the bounding box of each
+        region, in the same order as `centers()`."""
+        sizes = [np.zeros((0, 2))]
+        if self.horizontal:
+            h = np.array(self.horizontal, dtype=np.float64)
+            sizes.append(np.stack([h[:, 1] - h[:, 0], h[:, 3] - h[:, 2]], 1))
+        if self.free:
+            f = np.array(self.free, dtype=np.float64)
+            sizes.append(np.max(f, axis=1) - np.min(f, axis=1))
+        return np.concatenate(sizes)
+
+    def subset(self, indices: list[int]) -> "TextRegions":
+        """Returns the regions at the given indices, in the same order as
+        `centers()`."""
+        horizontal_count = len(self.horizontal)
+        return TextRegions(
+            horizontal=[
+                self.horizontal[i] for i in indices if i < horizontal_count
+            ],
+            free=[
+                self.free[i - horizontal_count]
+                for i in indices
+                if i >= horizontal_count
+            ],
+        )
+
+    def scaled(self, k: float) -> "TextRegions":
+        """Returns a copy of these regions with every coordinate multiplied by
+        the given factor."""
+        return TextRegions(
+            horizontal=[[int(v * k) for v in box] for box in self.horizontal],
+            free=[
+                [[int(x * k), int(y * k)] for x, y in box] for box in self.free
+            ],
+        )
+
+    def rotated(
+        self, angle: Literal[0, 90, 180, 270], width: int, height: int
+    ) -> "TextRegions":
+        """Returns a copy of these regions in the coordinates of the image
+        rotated clockwise by the given angle.
+
+        Args:
+            angle: Angle the image is rotated by. Can only be right angles.
+            width: Width of the image before rotating.
+            height: Height of the image before rotating.
+        """
+        matrix = _rotation_matrix(angle, width, height)
+        horizontal = []
+        if self.horizontal:
+            h = np.array(self.horizontal)
+            a = _transform_points(h[:, [0, 2]], matrix)
+            b = _transform_points(h[:, [1, 3]], matrix)
+            mins = np.minimum(a, b).astype(int)
+            maxs = np.maximum(a, b).astype(int)
+            horizontal = np.stack(
+                [mins[:, 0], maxs[:, 0], mins[:, 1], maxs[:, 1]], axis=1
+            ).tolist()
+        free = []
+        if self.free:
+            f = _transform_points(np.array(self.free), matrix).astype(int)
+            free = f.tolist()
+        return TextRegions(horizontal=horizontal, free=free)
+
+    def transformed(self, matrix: np.ndarray) -> "TextRegions":
+        """Returns a copy of these regions mapped through the given 2x3 affine
+        matrix.
+
+        Horizontal boxes stay horizontal if the matrix only scales and moves
+        points. Otherwise, they are turned into free boxes, since they are no
+        longer axis-aligned.
+        """
+        boxes = [
+            [[x_min, y_min], [x_max, y_min], [x_max, y_max], [x_min, y_max]]
+            for x_min, x_max, y_min, y_max in self.horizontal
+        ] + self.free
+        if not boxes:
+            return TextRegions()
+        points = _transform_points(np.array(boxes, dtype=np.float64), matrix)
+        points = np.rint(points).astype(int)
+
+        horizontal_count = len(self.horizontal)
+        keeps_axes = matrix[0, 1] == 0.0 and matrix[1, 0] == 0.0
+        if not keeps_axes:
+            return TextRegions(free=points.tolist())
+        mins = points[:horizontal_count].min(axis=1)
+        maxs = points[:horizontal_count].max(axis=1)
+        return TextRegions(
+            horizontal=np.stack(
+                [mins[:, 0], maxs[:, 0], mins[:, 1], maxs[:, 1]], axis=1
+            ).tolist(),
+            free=points[horizontal_count:].tolist(),
+        )
+
+
 class TextRecognizer:
     """Wrapper class to recognize text from images."""
 
-    def __init__(self, reader: easyocr.Reader | None = None) -> None:
-        """Creates a new TextRecognizer object."""
+    def __init__(
+        self, reader: easyocr.Reader | None = None, quantized: bool = False
+    ) -> None:
+        """Creates a new TextRecognizer object.
+
+        Args:
+            reader: EasyOCR reader to use. If not given, one is created for
+                English.
+            quantized: If true, the detector and recognizer of the reader
+                are replaced with their int8 versions, which are faster on
+                the CPU. They must be created with `scripts/quantize_ocr.py`
+                first.
+        """
         import easyocr
 
         if reader is None:
@@ -52,9 +379,14 @@ class TextRecognizer:
         else:
             self._reader = reader
 
+        if quantized:
+            from tabby_server.vision import quantization
+
+            quantization.load_quantized(self._reader)
+
     def find_text(
         self, image: np.ndarray, angle: Literal[0, 90, 180, 270] = 0
-    ) -> list[RecognizedText]:
+    ) -> RecognizedTextBatch:
         """Finds text from the given image and returns the result.
 
         Args:
@@ -62,50 +394,458 @@ class TextRecognizer:
             angle: Angle at which to process the image at. Can only be right
                 angles.
         Returns:
-            List of text recognized from the image.
+            Batch of text recognized from the image.
         """
 
         h, w, _ = image.shape
 
-        if angle == 0:
-            f_m1 = lambda xp, yp: (xp, yp)  # noqa: E731
-        elif angle == 90:
-            f_m1 = lambda xp, yp: (yp, h - xp)  # noqa: E731
-            image = cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE)
-        elif angle == 180:
-            f_m1 = lambda xp, yp: (w - xp, h - yp)  # noqa: E731
-            image = cv2.rotate(image, cv2.ROTATE_180)
-        else:  # 270
-            f_m1 = lambda xp, yp: (w - yp, xp)  # noqa: E731
-            image = cv2.rotate(image, cv2.ROTATE_90_COUNTERCLOCKWISE)
+        if angle != 0:
+            image = cv2.rotate(image, _ROTATE_CODES[angle])
 
         results = self._find_text_one_way(image)
 
-        for r in results:
-            r.corners = np.array([f_m1(xp, yp) for xp, yp in r.corners])
+        if angle != 0:
+            results = results.transformed(_unrotation_matrix(angle, w, h))
+
+        return replace(results, angles=(angle,))
+
+    def find_text_multi(
+        self,
+        image: np.ndarray,
+        angles: tuple[Literal[0, 90, 180, 270], ...] = (0, 90, 270),
+        predict_orientation: bool = True,
+        quality: QualityBar | None = None,
+    ) -> RecognizedTextBatch:
+        """Finds text from the given image, reading each region of text at
+        every one of the given angles.
+
+        Unlike calling `find_text()` once per angle, the text detector only
+        runs once, on the image as given. Every detected region is then
+        recognized in all orientations in a single batched recognizer call,
+        and the orientation with the highest confidence is kept.
+
+        The angles actually read may be fewer than those given. With
+        `predict_orientation`, `choose_angles()` may narrow them down to a
+        single angle, which isn't necessarily upright. With `quality`, the
+        angles are read one at a time and reading stops at the first which
+        meets the bar. The `angles` of the result are the ones read.
+
+        Args:
+            image: Image to process.
+            angles: Angles at which to read each region of text. Can only be
+                right angles.
+            predict_orientation: If true, first try to predict the one angle
+                the text is at using `choose_angles()`, and only read the text
+                at that angle.
+            quality: If given, read the text at one angle at a time instead,
+                from the most likely to the least, until the text read meets
+                this bar. See `recognize_regions_until()`.
+        Returns:
+            Batch of text recognized from the image, in the coordinates of the
+            original image.
+        """
+
+        regions = self.detect_regions(image)
+        if quality is not None:
+            return self.recognize_regions_until(
+                image, regions, _order_by_shape(regions, angles), quality
+            )
+        if predict_orientation:
+            angles = self.choose_angles(image, regions, angles)
+        return self.recognize_regions(image, regions, angles)
+
+    def find_text_scaled(
+        self,
+        image: np.ndarray,
+        angles: tuple[Literal[0, 90, 180, 270], ...] = (0,),
+        min_confidence: float = 0.0,
+        min_length: int = 1,
+        ladder: tuple[int | None, ...] = RESOLUTION_LADDER,
+        quality: QualityBar | None = None,
+    ) -> RecognizedTextBatch:
+        """Finds text from the given image, starting from a downscaled copy
+        and only moving up to a higher resolution if needed.
+
+        At each step of the ladder, the image is scaled down to the given
+        maximum area and OCR is run on it. If enough confident text is found,
+        the results are returned without trying any higher resolution.
+
+        Args:
+            image: Image to process.
+            angles: Angles at which to read the text. Can only be right
+                angles. If more than one is given, `find_text_multi()` is
+                used.
+            min_confidence: Minimum confidence for text to count as found.
+            min_length: Minimum length for text to count as found.
+            ladder: Maximum areas to try, from first to last. `None` means
+                full resolution.
+            quality: Given to `find_text_multi()`, if used.
+        Returns:
+            Batch of text recognized at the last resolution tried, in the
+            coordinates of the original image.
+        """
+
+        results = RecognizedTextBatch.empty()
+        for max_area in ladder:
+            if max_area is None:
+                scaled_image, side_ratio = image, 1.0
+            else:
+                scaled_image, side_ratio = scale_image(image, max_area)
+
+            if len(angles) == 1:
+                results = self.find_text(scaled_image, angles[0])
+            else:
+                results = self.find_text_multi(
+                    scaled_image, angles, quality=quality
+                )
+
+            # Map back onto the original image
+            if side_ratio != 1.0:
+                results = results.transformed(
+                    _scaling_matrix(1.0 / side_ratio)
+                )
+
+            found = results.filtered(min_confidence, min_length)
+            found_characters = int(found.lengths.sum())
+            if found_characters >= _LADDER_MIN_CHARACTERS:
+                break
+            if side_ratio == 1.0:  # Already at full resolution
+                break
 
         return results
 
-    def _find_text_one_way(self, image: np.ndarray) -> list[RecognizedText]:
+    def detect_regions(
+        self, image: np.ndarray, merge_lines: bool = True
+    ) -> TextRegions:
+        """Finds the regions of text in the given image without reading them.
+
+        Args:
+            image: Image to process.
+            merge_lines: If true, nearby boxes on the same line are merged
+                into one region. Turn this off when neighbouring text belongs
+                to different objects, such as spines on a shelf.
+        Returns:
+            Regions of text found in the image.
+        """
+        kwargs = {} if merge_lines else {"width_ths": 0.0}
+        horizontal_lists, free_lists = self._reader.detect(image, **kwargs)
+        return TextRegions(horizontal=horizontal_lists[0], free=free_lists[0])
+
+    def recognize_regions(
+        self,
+        image: np.ndarray,
+        regions: TextRegions,
+        angles: tuple[Literal[0, 90, 180, 270], ...] = (0,),
+    ) -> RecognizedTextBatch:
+        """Reads the text in each of the given regions of an image. Every
+        region is read at all of the given angles in a single batched call,
+        and the orientation with the highest confidence is kept. If more than
+        one angle is given, the upright orientation is read too, since
+        EasyOCR always reads it alongside any rotation.
+
+        Args:
+            image: Image the regions were found in. Can be either BGR or
+                grayscale.
+            regions: Regions of text to read.
+            angles: Angles at which to read each region of text. Can only be
+                right angles.
+        Returns:
+            Batch of text recognized from the image, in the coordinates of the
+            image.
+        """
+
+        box_count = len(regions)
+        if box_count == 0:
+            return RecognizedTextBatch.empty()
+
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        if len(angles) == 1:
+            return self._recognize_regions_at(image, regions, angles[0])
+
+        # Our angles are clockwise, while EasyOCR rotates counterclockwise
+        rotation_info = [(360 - angle) % 360 for angle in angles if angle != 0]
+
+        ocr_results = self._reader.recognize(
+            image,
+            regions.horizontal,
+            regions.free,
+            batch_size=box_count * (len(rotation_info) + 1),
+            rotation_info=rotation_info or None,
+            reformat=False,
+        )
+        results = RecognizedTextBatch.from_ocr_results(ocr_results)
+        return replace(results, angles=(0, *(a for a in angles if a != 0)))
+
+    def recognize_regions_until(
+        self,
+        image: np.ndarray,
+        regions: TextRegions,
+        angles: tuple[Literal[0, 90, 180, 270], ...],
+        quality: QualityBar,
+    ) -> RecognizedTextBatch:
+        """Reads the text in each of the given regions of an image at one
+        angle at a time, stopping as soon as the text read meets a quality
+        bar. Each region keeps the angle it was read at with the highest
+        confidence.
+
+        Args:
+            image: Image the regions were found in. Can be either BGR or
+                grayscale.
+            regions: Regions of text to read.
+            angles: Angles at which to read the regions, from the most likely
+                to the least. Can only be right angles.
+            quality: Bar the text read must meet to stop.
+        Returns:
+            Batch of text recognized from the image, in the coordinates of the
+            image. Its `angles` are the angles actually tried.
+        """
+
+        best: dict[int, tuple[str, float, Literal[0, 90, 180, 270]]] = {}
+        tried: list[Literal[0, 90, 180, 270]] = []
+        results = RecognizedTextBatch.empty()
+        if len(regions) == 0:
+            return results
+        for angle in angles:
+            tried.append(angle)
+            lines = list(_crop_lines(image, regions, (angle,)))
+            read = self._read_lines([line for _, _, line in lines])
+            for (j, _, _), (text, confidence) in zip(lines, read):
+                if j not in best or confidence > best[j][1]:
+                    best[j] = (text, confidence, angle)
+
+            ocr_results = [
+                (_region_corners(regions, j, a), text, confidence)
+                for j, (text, confidence, a) in sorted(best.items())
+            ]
+            results = replace(
+                RecognizedTextBatch.from_ocr_results(ocr_results),
+                angles=tuple(tried),
+            )
+            if quality.met_by(results):
+                break
+        return results
+
+    def choose_angles(
+        self,
+        image: np.ndarray,
+        regions: TextRegions,
+        angles: tuple[Literal[0, 90, 180, 270], ...] = (0, 90, 270),
+    ) -> tuple[Literal[0, 90, 180, 270], ...]:
+        """Predicts the angle at which the text in the given regions should
+        be read, so it doesn't need to be read at every angle.
+
+        First, the shape of the regions decides whether the text is upright
+        or sideways. If that leaves more than one angle, the few largest
+        regions are read at each remaining angle, and the angle with the
+        highest mean confidence is picked if it's clearly the best.
+
+        Args:
+            image: Image the regions were found in. Can be either BGR or
+                grayscale.
+            regions: Regions of text to predict the orientation of.
+            angles: Angles to pick from. Can only be right angles.
+        Returns:
+            A tuple with the single best angle, or the angles left to try if
+            unsure.
+        """
+
+        angles = _angles_from_shape(regions, angles)
+        if len(angles) == 1 or len(regions) <= _ORIENTATION_PROBE_REGIONS:
+            return angles
+
+        # Read the largest regions at each angle
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        probe = _probe_regions(regions)
+        scores = []
+        for angle in angles:
+            results = self._recognize_regions_at(image, probe, angle)
+            scores.append(results.confidences.sum() / len(probe))
+        return _angles_from_scores(angles, scores)
+
+    def choose_angles_many(
+        self,
+        items: list[tuple[np.ndarray, TextRegions]],
+        angles: tuple[Literal[0, 90, 180, 270], ...] = (0, 90, 270),
+    ) -> list[tuple[Literal[0, 90, 180, 270], ...]]:
+        """Same as `choose_angles()`, for many images at once. The regions
+        read to predict the orientation of every image are read together,
+        in as few recognizer calls as possible.
+
+        Args:
+            items: List of (image, regions) tuples, each being an image and
+                the regions of text to predict the orientation of.
+            angles: Angles to pick from. Can only be right angles.
+        Returns:
+            Angles picked for each image, in the same order as the items.
+        """
+
+        chosen = [_angles_from_shape(regions, angles) for _, regions in items]
+
+        # Pool the largest regions of every image left unsure
+        lines: list[np.ndarray] = []
+        owners: list[tuple[int, int]] = []
+        probe_counts: dict[int, int] = {}
+        for i, (image, regions) in enumerate(items):
+            if len(chosen[i]) == 1:
+                continue
+            if len(regions) <= _ORIENTATION_PROBE_REGIONS:
+                continue
+            probe = _probe_regions(regions)
+            probe_counts[i] = len(probe)
+            for _, angle, line in _crop_lines(image, probe, chosen[i]):
+                lines.append(line)
+                owners.append((i, angle))
+
+        confidences: dict[tuple[int, int], float] = {}
+        for owner, (_, confidence) in zip(owners, self._read_lines(lines)):
+            confidences[owner] = confidences.get(owner, 0.0) + confidence
+
+        for i, count in probe_counts.items():
+            scores = [confidences.get((i, a), 0.0) / count for a in chosen[i]]
+            chosen[i] = _angles_from_scores(chosen[i], scores)
+        return chosen
+
+    def recognize_many(
+        self,
+        items: list[
+            tuple[
+                np.ndarray, TextRegions, tuple[Literal[0, 90, 180, 270], ...]
+            ]
+        ],
+    ) -> list[RecognizedTextBatch]:
+        """Same as `recognize_regions()`, for many images at once.
+
+        Rather than reading each image in its own recognizer calls, the
+        lines of text of all the images are cropped, scaled to the same
+        height and read together in large batches. The results are then
+        routed back to the image each line came from.
+
+        Args:
+            items: List of (image, regions, angles) tuples, each being an
+                image, the regions of text to read on it, and the angles at
+                which to read them.
+        Returns:
+            Batch of text recognized from each image, in the same order as
+            the items and in the coordinates of each image.
+        """
+
+        lines: list[np.ndarray] = []
+        owners: list[tuple[int, int, Literal[0, 90, 180, 270]]] = []
+        item_angles = []
+        for i, (image, regions, angles) in enumerate(items):
+            if len(angles) > 1 and 0 not in angles:
+                angles = (0, *angles)
+            item_angles.append(angles)
+            for j, angle, line in _crop_lines(image, regions, angles):
+                lines.append(line)
+                owners.append((i, j, angle))
+
+        # Keep the angle read with the highest confidence for each region
+        best: dict[
+            tuple[int, int], tuple[Literal[0, 90, 180, 270], str, float]
+        ] = {}
+        for (i, j, angle), (text, confidence) in zip(
+            owners, self._read_lines(lines)
+        ):
+            if (i, j) not in best or confidence > best[i, j][2]:
+                best[i, j] = (angle, text, confidence)
+
+        ocr_results: list[list] = [[] for _ in items]
+        for (i, j), (angle, text, confidence) in sorted(best.items()):
+            corners = _region_corners(items[i][1], j, angle)
+            ocr_results[i].append((corners, text, confidence))
+        return [
+            replace(RecognizedTextBatch.from_ocr_results(r), angles=angles)
+            for r, angles in zip(ocr_results, item_angles)
+        ]
+
+    def _read_lines(self, lines: list[np.ndarray]) -> list[tuple[str, float]]:
+        """Reads many lines of text with the recognizer.
+
+        The lines are sorted by width and read in batches of similar widths,
+        since every line in a batch is padded to the width of the widest.
+
+        Args:
+            lines: Greyscale image of each line of text, all scaled to a
+                height of `_LINE_HEIGHT`.
+        Returns:
+            (text, confidence) read from each line, in the same order.
+        """
+
+        reader = self._reader
+        ignore_char = "".join(set(reader.character) - set(reader.lang_char))
+        order = sorted(range(len(lines)), key=lambda k: lines[k].shape[1])
+        results = [("", 0.0)] * len(lines)
+        for start in range(0, len(order), _LINE_BATCH_SIZE):
+            end = start + _LINE_BATCH_SIZE
+            batch = order[start:end]
+            widest = lines[batch[-1]].shape[1]
+            max_width = max(math.ceil(widest / _LINE_HEIGHT), 1) * _LINE_HEIGHT
+            batch_results = get_text(
+                reader.character,
+                _LINE_HEIGHT,
+                max_width,
+                reader.recognizer,
+                reader.converter,
+                [(None, lines[k]) for k in batch],
+                ignore_char,
+                batch_size=len(batch),
+                workers=0,
+                device=reader.device,
+            )
+            for k, (_, text, confidence) in zip(batch, batch_results):
+                results[k] = (text, float(confidence))
+        return results
+
+    def _recognize_regions_at(
+        self,
+        image: np.ndarray,
+        regions: TextRegions,
+        angle: Literal[0, 90, 180, 270],
+    ) -> RecognizedTextBatch:
+        """Reads the text in each of the given regions of a grayscale image at
+        exactly one angle.
+
+        Args:
+            image: Grayscale image the regions were found in.
+            regions: Regions of text to read.
+            angle: Angle at which to read the text. Can only be right angles.
+        Returns:
+            Batch of text recognized from the image, in the coordinates of the
+            image.
+        """
+        h, w = image.shape[:2]
+        if angle != 0:
+            image = cv2.rotate(image, _ROTATE_CODES[angle])
+            regions = regions.rotated(angle, w, h)
+
+        ocr_results = self._reader.recognize(
+            image,
+            regions.horizontal,
+            regions.free,
+            batch_size=len(regions),
+            reformat=False,
+        )
+        results = RecognizedTextBatch.from_ocr_results(ocr_results)
+
+        if angle != 0:
+            results = results.transformed(_unrotation_matrix(angle, w, h))
+        return replace(results, angles=(angle,))
+
+    def _find_text_one_way(self, image: np.ndarray) -> RecognizedTextBatch:
         """Finds text from the given image and returns the result. Only runs
         OCR once in one orientation.
 
         Args:
             image: Image to process.
         Returns:
-            List of text recognized from the image.
+            Batch of text recognized from the image.
         """
         ocr_results = self._reader.readtext(image)
-        my_results: list[RecognizedText] = []
-        for points, text, confidence in ocr_results:
-            my_results.append(
-                RecognizedText(
-                    text=text,
-                    corners=np.array(points, dtype=np.int32),
-                    confidence=float(confidence),
-                )
-            )
-        return my_results
+        return RecognizedTextBatch.from_ocr_results(ocr_results)
 
 
 def scale_image(image: np.ndarray, max_area: int) -> tuple[np.ndarray, float]:
@@ -125,5 +865,259 @@ def scale_image(image: np.ndarray, max_area: int) -> tuple[np.ndarray, float]:
         side_ratio = np.sqrt(area_ratio)
         new_height = int(side_ratio * height)
         new_width = int(side_ratio * width)
-        image = cv2.resize(image, (new_height, new_width))
+        image = cv2.resize(image, (new_width, new_height))
     return image, float(side_ratio)
+
+
+def crop_polygon(
+    image: np.ndarray, polygon: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Crops the smallest rotated rectangle around a polygon out of an image,
+    turned so that its longest side is vertical.
+
+    Pixels outside of the polygon are filled with the mean color inside of
+    it, so that they don't add edges or text from around the polygon.
+
+    Args:
+        image: Image to crop, either in color or greyscale.
+        polygon: Nx2 matrix of the points of the polygon, with N >= 3.
+    Returns:
+        (1) Cropped image.
+        (2) 2x3 affine matrix which maps points on the image onto the
+        cropped image.
+    """
+
+    polygon = np.asarray(polygon, dtype=np.float32)
+    rect = cv2.minAreaRect(polygon)
+    (cx, cy), _, _ = rect
+    corners = cv2.boxPoints(rect)
+
+    # Rotate the longest side onto the y-axis, by as small an angle as
+    # possible, so the image is never turned upside down
+    side_a = corners[1] - corners[0]
+    side_b = corners[2] - corners[1]
+    long_side, short_side = side_a, side_b
+    if np.linalg.norm(side_b) > np.linalg.norm(side_a):
+        long_side, short_side = side_b, side_a
+    if long_side[1] < 0:
+        long_side = -long_side
+    angle = np.degrees(np.arctan2(-long_side[0], long_side[1]))
+
+    width = max(int(np.ceil(np.linalg.norm(short_side))), 1)
+    height = max(int(np.ceil(np.linalg.norm(long_side))), 1)
+    matrix = cv2.getRotationMatrix2D((float(cx), float(cy)), angle, 1.0)
+    matrix[0, 2] += width / 2 - cx
+    matrix[1, 2] += height / 2 - cy
+
+    crop = cv2.warpAffine(
+        image, matrix, (width, height), borderMode=cv2.BORDER_REPLICATE
+    )
+    mask = np.zeros((height, width), dtype=np.uint8)
+    points = np.rint(_transform_points(polygon, matrix)).astype(np.int32)
+    cv2.fillPoly(mask, [points], 255)
+    if np.any(mask):
+        channels = 1 if crop.ndim == 2 else crop.shape[2]
+        crop[mask == 0] = cv2.mean(crop, mask)[:channels]
+    return crop, matrix
+
+
+def _angles_from_shape(
+    regions: TextRegions, angles: tuple[Literal[0, 90, 180, 270], ...]
+) -> tuple[Literal[0, 90, 180, 270], ...]:
+    """Narrows down the angles at which to read some regions of text from
+    their shape, as tall regions are sideways while wide regions are
+    upright."""
+    if len(angles) <= 1 or len(regions) == 0:
+        return angles
+    sizes = regions.sizes()
+    areas = sizes[:, 0] * sizes[:, 1]
+    ratio = _ORIENTATION_ASPECT_RATIO
+    tall_area = areas[sizes[:, 1] >= ratio * sizes[:, 0]].sum()
+    wide_area = areas[sizes[:, 0] >= ratio * sizes[:, 1]].sum()
+    if tall_area != wide_area:
+        sideways = tall_area > wide_area
+        candidates = tuple(a for a in angles if (a in (90, 270)) == sideways)
+        if candidates:
+            return candidates
+    return angles
+
+
+def _order_by_shape(
+    regions: TextRegions, angles: tuple[Literal[0, 90, 180, 270], ...]
+) -> tuple[Literal[0, 90, 180, 270], ...]:
+    """Orders angles from the most to the least likely for some regions of
+    text to be read at. Angles which fit the shape of the regions come
+    first, otherwise the given order is kept."""
+    likely = _angles_from_shape(regions, angles)
+    return likely + tuple(a for a in angles if a not in likely)
+
+
+def _probe_regions(regions: TextRegions) -> TextRegions:
+    """Gets the largest regions, which are read at each angle to predict the
+    orientation of the text."""
+    sizes = regions.sizes()
+    areas = sizes[:, 0] * sizes[:, 1]
+    largest = np.argsort(areas)[::-1][:_ORIENTATION_PROBE_REGIONS]
+    return regions.subset([int(i) for i in largest])
+
+
+def _angles_from_scores(
+    angles: tuple[Literal[0, 90, 180, 270], ...], scores: list[float]
+) -> tuple[Literal[0, 90, 180, 270], ...]:
+    """Picks the angle with the highest score, but only if it's clearly
+    better than the others. Otherwise, all the angles are kept."""
+    order = np.argsort(scores)[::-1]
+    best, runner_up = scores[order[0]], scores[order[1]]
+    if best - runner_up < _ORIENTATION_MARGIN:
+        return angles
+    return (angles[order[0]],)
+
+
+def _crop_lines(
+    image: np.ndarray,
+    regions: TextRegions,
+    angles: tuple[Literal[0, 90, 180, 270], ...],
+) -> Iterator[tuple[int, Literal[0, 90, 180, 270], np.ndarray]]:
+    """Crops each region of text out of an image at each angle, scaled to a
+    height of `_LINE_HEIGHT` while keeping its aspect ratio.
+
+    Args:
+        image: Image the regions were found in. Can be either BGR or
+            grayscale.
+        regions: Regions of text to crop.
+        angles: Angles at which to crop each region. Can only be right
+            angles. A region cropped at an angle is the same as if it was
+            cropped out of the image rotated clockwise by that angle.
+    Returns:
+        Iterator of (index, angle, line) tuples, where index is the index of
+        the region in the same order as `TextRegions.centers()`, and line is
+        the greyscale crop. Empty regions are skipped.
+    """
+
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    crops = []
+    for x_min, x_max, y_min, y_max in regions.horizontal:
+        rows = slice(max(y_min, 0), y_max)
+        columns = slice(max(x_min, 0), x_max)
+        crops.append(image[rows, columns])
+    for box in regions.free:
+        crops.append(
+            four_point_transform(image, np.asarray(box, dtype=np.float32))
+        )
+
+    for index, crop in enumerate(crops):
+        if crop.shape[0] == 0 or crop.shape[1] == 0:
+            continue
+        for angle in angles:
+            line = crop
+            if angle != 0:
+                line = cv2.rotate(crop, _ROTATE_CODES[angle])
+            line_h, line_w = line.shape[:2]
+            width = max(round(_LINE_HEIGHT * line_w / line_h), 1)
+            line = cv2.resize(
+                line, (width, _LINE_HEIGHT), interpolation=cv2.INTER_LINEAR
+            )
+            yield index, angle, line
+
+
+def _region_corners(
+    regions: TextRegions, index: int, angle: Literal[0, 90, 180, 270]
+) -> np.ndarray:
+    """Gets the corners of one region, starting from the top left corner of
+    the region as read at the given angle.
+
+    Args:
+        regions: Regions of text.
+        index: Index of the region, in the same order as
+            `TextRegions.centers()`.
+        angle: Angle the region was read at. Can only be right angles.
+    Returns:
+        4x2 matrix of the corners of the region.
+    """
+    horizontal_count = len(regions.horizontal)
+    if index >= horizontal_count:
+        return np.array(regions.free[index - horizontal_count])
+    x_min, x_max, y_min, y_max = regions.horizontal[index]
+    corners = [[x_min, y_min], [x_max, y_min], [x_max, y_max], [x_min, y_max]]
+    return np.roll(np.array(corners), angle // 90, axis=0)
+
+
+def _rotation_matrix(
+    angle: Literal[0, 90, 180, 270], w: int, h: int
+) -> np.ndarray:
+    """2x3 affine matrix which maps points on a w by h image onto the same
+    image rotated clockwise by the given angle."""
+    if angle == 90:
+        return np.array([[0.0, -1.0, h], [1.0, 0.0, 0.0]])
+    elif angle == 180:
+        return np.array([[-1.0, 0.0, w], [0.0, -1.0, h]])
+    elif angle == 270:
+        return np.array([[0.0, 1.0, 0.0], [-1.0, 0.0, w]])
+    return _scaling_matrix(1.0)
+
+
+def _unrotation_matrix(
+    angle: Literal[0, 90, 180, 270], w: int, h: int
+) -> np.ndarray:
+    """2x3 affine matrix which maps points on a w by h image rotated clockwise
+    by the given angle back onto the original image. Inverse of
+    `_rotation_matrix()`."""
+    if angle == 90:
+        return np.array([[0.0, 1.0, 0.0], [-1.0, 0.0, h]])
+    elif angle == 180:
+        return np.array([[-1.0, 0.0, w], [0.0, -1.0, h]])
+    elif angle == 270:
+        return np.array([[0.0, -1.0, w], [1.0, 0.0, 0.0]])
+    return _scaling_matrix(1.0)
+
+
+def _scaling_matrix(k: float) -> np.ndarray:
+    """2x3 affine matrix which scales points by the given factor."""
+    return np.array([[k, 0.0, 0.0], [0.0, k, 0.0]])
+
+
+def _transform_points(points: np.ndarray, matrix: np.ndarray) -> np.ndarray:
+    """Maps an array of points, with x and y along the last axis, through the
+    given 2x3 affine matrix."""
+    return points @ matrix[:, :2].T + matrix[:, 2]
+
+
+def group_regions_by_polygons(
+    regions: TextRegions, polygons: list[np.ndarray]
+) -> list[TextRegions]:
+    """Assigns each region of text to the polygon which contains its center.
+
+    If several polygons contain a region, the smallest of them is chosen.
+    Regions outside of every polygon are dropped.
+
+    Args:
+        regions: Regions of text to assign.
+        polygons: Polygons, each as an Nx2 matrix of points.
+    Returns:
+        List parallel to `polygons`, containing the regions assigned to each
+        polygon.
+    """
+
+    groups = [TextRegions() for _ in polygons]
+    if not polygons or len(regions) == 0:
+        return groups
+
+    contours = [np.asarray(p, dtype=np.float32) for p in polygons]
+    areas = [cv2.contourArea(c) for c in contours]
+    horizontal_count = len(regions.horizontal)
+    for i, (x, y) in enumerate(regions.centers()):
+        owner = None
+        for j, contour in enumerate(contours):
+            is_inside = (
+                cv2.pointPolygonTest(contour, (float(x), float(y)), False) >= 0
+            )
+            if is_inside and (owner is None or areas[j] < areas[owner]):
+                owner = j
+        if owner is None:
+            continue
+        if i < horizontal_count:
+            groups[owner].horizontal.append(regions.horizontal[i])
+        else:
+            groups[owner].free.append(regions.free[i - horizontal_count])
+    return groups
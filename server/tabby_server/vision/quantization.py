@@ -0,0 +1,189 @@
+from collections.abc import Iterable
+from contextlib import contextmanager
+import difflib
+import logging
+import os
+import easyocr
+import numpy as np
+import torch
+from torch.ao.quantization import (
+    default_dynamic_qconfig,
+    get_default_qconfig_mapping,
+)
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+"""
+Runs the EasyOCR models in int8.
+
+EasyOCR already quantizes the LSTM and linear layers of its recognizer when
+running on the CPU, but leaves every convolution in float32, which is where
+most of the time is spent. The models here are statically quantized, so the
+convolutions of the detector (CRAFT) and the recognizer (CRNN) run in int8
+too. The scale of each layer is calibrated by reading real images.
+"""
+
+MODEL_DIR = "./tabby_server/vision/EasyOCR"
+"""Directory containing the EasyOCR models."""
+
+MODEL_PATHS = {
+    "detector": os.path.join(MODEL_DIR, "craft_mga_2500.pth"),
+    "recognizer": os.path.join(MODEL_DIR, "english_g2.pth"),
+}
+"""Path to the float32 weights of each EasyOCR model, downloaded by EasyOCR
+the first time a reader is created."""
+
+QUANTIZED_MODEL_PATHS = {
+    "detector": os.path.join(MODEL_DIR, "craft_int8.pt"),
+    "recognizer": os.path.join(MODEL_DIR, "english_g2_int8.pt"),
+}
+"""Path to the quantized version of each EasyOCR model. They are created by
+`scripts/quantize_ocr.py`."""
+
+_DETECTOR_EXAMPLE_SIZE = (1, 3, 320, 320)
+"""Shape of the input used to trace the detector. Any size works when the
+traced model is run."""
+
+_RECOGNIZER_EXAMPLE_SIZE = (1, 1, 64, 256)
+"""Shape of the input used to trace the recognizer. Any batch size and width
+works when the traced model is run."""
+
+_RECOGNIZER_TEXT_LENGTH = 26
+"""Length of the (unused) text input given to the recognizer when tracing."""
+
+
+def reader_unquantized() -> easyocr.Reader:
+    """Creates an English EasyOCR reader whose models are left in float32,
+    which is needed to quantize them."""
+    return easyocr.Reader(
+        lang_list=["en"],
+        gpu=False,
+        model_storage_directory=MODEL_DIR,
+        quantize=False,
+    )
+
+
+def quantize_reader(
+    reader: easyocr.Reader, calibration_images: Iterable[np.ndarray]
+) -> tuple[torch.jit.ScriptModule, torch.jit.ScriptModule]:
+    """Quantizes the detector and recognizer of a reader to int8.
+
+    Args:
+        reader: Reader whose models are in float32, like one from
+            `reader_unquantized()`. It is left unchanged.
+        calibration_images: Images read to calibrate the quantized models.
+            They should look like the images the server gets.
+    Returns:
+        Traced quantized detector and recognizer, in that order.
+    """
+
+    qconfig_mapping = get_default_qconfig_mapping(
+        torch.backends.quantized.engine
+    )
+    detector = prepare_fx(
+        reader.detector.eval(),
+        qconfig_mapping,
+        (torch.zeros(_DETECTOR_EXAMPLE_SIZE),),
+    )
+    # LSTM and linear layers have no static int8 kernels
+    qconfig_mapping = qconfig_mapping.set_object_type(
+        torch.nn.LSTM, default_dynamic_qconfig
+    ).set_object_type(torch.nn.Linear, default_dynamic_qconfig)
+    recognizer = prepare_fx(
+        reader.recognizer.eval(),
+        qconfig_mapping,
+        (torch.zeros(_RECOGNIZER_EXAMPLE_SIZE), None),
+    )
+
+    # Observe the values in each layer while reading the images
+    with using_models(reader, detector, recognizer), torch.no_grad():
+        for image in calibration_images:
+            reader.readtext(image)
+
+    detector = convert_fx(detector)
+    recognizer = convert_fx(recognizer)
+
+    with torch.no_grad():
+        traced_detector = torch.jit.trace(
+            detector,
+            (torch.zeros(_DETECTOR_EXAMPLE_SIZE),),
+            check_trace=False,
+        )
+        traced_recognizer = torch.jit.trace(
+            recognizer,
+            (
+                torch.zeros(_RECOGNIZER_EXAMPLE_SIZE),
+                torch.zeros(
+                    _RECOGNIZER_EXAMPLE_SIZE[0],
+                    _RECOGNIZER_TEXT_LENGTH,
+                    dtype=torch.long,
+                ),
+            ),
+            check_trace=False,
+        )
+    return traced_detector, traced_recognizer
+
+
+def save_quantized(
+    detector: torch.jit.ScriptModule, recognizer: torch.jit.ScriptModule
+) -> None:
+    """Saves quantized models where `load_quantized()` looks for them."""
+    torch.jit.save(detector, QUANTIZED_MODEL_PATHS["detector"])
+    torch.jit.save(recognizer, QUANTIZED_MODEL_PATHS["recognizer"])
+
+
+def load_quantized(reader: easyocr.Reader) -> bool:
+    """Replaces the models of a reader with their quantized versions.
+
+    If either quantized model is missing, the reader is left unchanged.
+
+    Args:
+        reader: Reader to use the quantized models in.
+    Returns:
+        Whether the quantized models were loaded.
+    """
+
+    missing = [
+        path
+        for path in QUANTIZED_MODEL_PATHS.values()
+        if not os.path.exists(path)
+    ]
+    if missing:
+        logging.warning(
+            f"Quantized OCR models not found at {missing}, "
+            "using float32 models instead. "
+            "Create them with scripts/quantize_ocr.py."
+        )
+        return False
+    reader.detector = torch.jit.load(QUANTIZED_MODEL_PATHS["detector"])
+    reader.recognizer = torch.jit.load(QUANTIZED_MODEL_PATHS["recognizer"])
+    return True
+
+
+@contextmanager
+def using_models(
+    reader: easyocr.Reader,
+    detector: torch.nn.Module,
+    recognizer: torch.nn.Module,
+):
+    """Context manager which temporarily makes a reader use other models.
+
+    The original models are restored even if an exception occurs.
+    """
+
+    original = reader.detector, reader.recognizer
+    reader.detector, reader.recognizer = detector, recognizer
+    try:
+        yield
+    finally:
+        reader.detector, reader.recognizer = original
+
+
+def text_similarity(expected: str, actual: str) -> float:
+    """Gets how similar two texts are, from 0 (nothing in common) to 1
+    (equal)."""
+    return difflib.SequenceMatcher(None, expected, actual).ratio()
+
+
+def read_all_text(reader: easyocr.Reader, image: np.ndarray) -> str:
+    """Reads the text of an image, in reading order, as one string."""
+    return " ".join(reader.readtext(image, detail=0))
@@ -0,0 +1,64 @@
+import cv2 as cv
+from cv2.typing import MatLike
+
+"""
+Cheap checks of whether an image could have any readable text on it, run
+before the much slower OCR.
+"""
+
+TOO_SMALL = "too small"
+"""Reason given for images too small to read text on."""
+
+NO_EDGES = "no edges"
+"""Reason given for images too flat to have text on, such as plain
+bindings or glare."""
+
+NO_TEXT_DETECTED = "no text detected"
+"""Reason given for images on which the text detector found nothing."""
+
+_EDGE_IMAGE_SIZE = 256
+"""Length the longest side of an image is shrunk to before finding its
+edges, so that the density of edges doesn't depend on the size of the
+image."""
+
+
+def edge_density(image: MatLike) -> float:
+    """Gets the fraction of the pixels of an image which are on an edge.
+
+    Args:
+        image: Image, either BGR or greyscale.
+    Returns:
+        Fraction from 0 to 1.
+    """
+    if image.ndim == 3:
+        image = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+    k = _EDGE_IMAGE_SIZE / max(image.shape[:2])
+    if k < 1.0:
+        image = cv.resize(image, None, fx=k, fy=k, interpolation=cv.INTER_AREA)
+    edges = cv.Canny(image, 50, 150)
+    return cv.countNonZero(edges) / edges.size
+
+
+def skip_reason(
+    image: MatLike,
+    min_width: int,
+    min_height: int,
+    min_edge_density: float,
+) -> str | None:
+    """Checks if an upright image of a spine can't have readable text.
+
+    Args:
+        image: Image of the spine, with its longest side vertical.
+        min_width: Minimum width, in pixels.
+        min_height: Minimum height, in pixels.
+        min_edge_density: Minimum fraction of pixels on an edge. Text has
+            many edges, while plain surfaces have next to none.
+    Returns:
+        Why the spine can't have readable text, or `None` if it might.
+    """
+    h, w = image.shape[:2]
+    if w < min_width or h < min_height:
+        return TOO_SMALL
+    if edge_density(image) < min_edge_density:
+        return NO_EDGES
+    return None
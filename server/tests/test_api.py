@@ -1,13 +1,18 @@
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from typing import Any, Callable
-from unittest.mock import Mock
+import json
+from typing import Any, Callable, cast
+from unittest.mock import DEFAULT, Mock
+import cv2 as cv
 import numpy as np
 import requests_mock
-from tabby_server import app
+from tabby_server import app, jobs
+from tabby_server.api import books
 from flask.testing import FlaskClient
 from http import HTTPStatus
 import logging
 import pytest
+import threading
 from tabby_server.vision import extraction, image_labelling, ocr
 from werkzeug.datastructures import FileStorage
 
@@ -17,22 +22,54 @@ def client():
     return app.test_client()
 
 
+@pytest.fixture(autouse=True)
+def clear_scan_cache():
+    """Keeps results of scans in one test from being reused by another."""
+    books.scan_cache.clear()
+    books.spine_cache.clear()
+
+
 @pytest.fixture(scope="function")
 def mock_recognizer(request):
 
     original_function = ocr.TextRecognizer.find_text
+    original_multi_function = ocr.TextRecognizer.find_text_multi
 
     ocr.TextRecognizer.find_text = Mock()
-    ocr.TextRecognizer.find_text.return_value = [
-        ocr.RecognizedText(
-            text="abc",
-            corners=np.array([[1.0, 1.0], [2.0, 2.0], [3.0, 3.0], [4.0, 4.0]]),
-            confidence=0.9,
+    ocr.TextRecognizer.find_text.return_value = (
+        ocr.RecognizedTextBatch.from_texts(
+            [
+                ocr.RecognizedText(
+                    text="abc",
+                    corners=np.array(
+                        [[1.0, 1.0], [2.0, 2.0], [3.0, 3.0], [4.0, 4.0]]
+                    ),
+                    confidence=0.9,
+                )
+            ]
         )
-    ]
+    )
+    ocr.TextRecognizer.find_text_multi = Mock()
+    ocr.TextRecognizer.find_text_multi.return_value = (
+        ocr.TextRecognizer.find_text.return_value
+    )
+
+    # Shelf scans detect text once, then recognize it spine by spine
+    original_detect_function = ocr.TextRecognizer.detect_regions
+    original_recognize_function = ocr.TextRecognizer.recognize_many
+    ocr.TextRecognizer.detect_regions = Mock()
+    ocr.TextRecognizer.detect_regions.return_value = ocr.TextRegions()
+    ocr.TextRecognizer.recognize_many = Mock(
+        side_effect=lambda items: [
+            ocr.TextRecognizer.find_text.return_value for _ in items
+        ]
+    )
 
     def teardown():
         ocr.TextRecognizer.find_text = original_function
+        ocr.TextRecognizer.find_text_multi = original_multi_function
+        ocr.TextRecognizer.detect_regions = original_detect_function
+        ocr.TextRecognizer.recognize_many = original_recognize_function
 
     request.addfinalizer(teardown)
 
@@ -41,15 +78,18 @@ def mock_recognizer(request):
 def mock_find_books(request):
 
     original_function = image_labelling.find_books
+    original_batched_function = image_labelling.find_books_batched
 
     image_labelling.find_books = Mock()
     image_labelling.find_books.return_value = None
+    image_labelling.find_books_batched = image_labelling.find_books
 
     def set_value(value):
         image_labelling.find_books.return_value = value
 
     def teardown():
         image_labelling.find_books = original_function
+        image_labelling.find_books_batched = original_batched_function
 
     request.addfinalizer(teardown)
 
@@ -61,11 +101,14 @@ def mock_extract(request):
 
     original_function = extraction.extract_from_recognized_texts
 
-    extraction.extract_from_recognized_texts = Mock()
-    extraction.extract_from_recognized_texts.return_value = None
+    mock = Mock(return_value=None)
+    extraction.extract_from_recognized_texts = mock
 
     def set_value(value):
-        extraction.extract_from_recognized_texts.return_value = value
+        mock.return_value = value
+
+    # Lets tests check the calls, or make it do more than return a value
+    set_value.mock = mock
 
     def teardown():
         extraction.extract_from_recognized_texts = original_function
@@ -75,6 +118,41 @@ def mock_extract(request):
     return set_value
 
 
+@pytest.fixture(scope="function")
+def mock_shelf(monkeypatch, mock_find_books, mock_extract):
+    """Fixture to mock a shelf of spines, which are all read as the same
+    title and author. Has two spines unless the returned function is called
+    with another count."""
+
+    # The mocked spines are too small and have no text detected on them
+    monkeypatch.setattr(books, "_SKIP_BLANK_SPINES", False)
+
+    def set_spine_count(count: int) -> None:
+        mock_find_books(
+            [
+                {
+                    "box": {"x1": x, "x2": x + 1.0, "y1": x, "y2": x + 1.0},
+                    "class": 0,
+                    "confidence": 0.9,
+                    "name": "book",
+                }
+                for x in (300.0 + i for i in range(count))
+            ]
+        )
+
+    set_spine_count(2)
+    mock_extract(
+        extraction.ExtractionResult(
+            options=[
+                extraction.ExtractionOption(
+                    title="KICKING AWAY THE LADDER", author="HA-JOON CHANG"
+                )
+            ]
+        )
+    )
+    return set_spine_count
+
+
 @pytest.fixture(scope="function")
 def mock_chat_completion() -> Callable[[Any], None]:
     """Fixture to mock the result of a chat completion."""
@@ -115,6 +193,28 @@ class TestAPIEndpoint:
         assert response.json is not None and "message" in response.json
         assert response.status_code == HTTPStatus.OK
 
+    def test_metrics(self, client: FlaskClient):
+        """Tests endpoint /metrics"""
+
+        response = client.get("/metrics")
+        logging.info(response.json)
+        assert response.status_code == HTTPStatus.OK
+        assert response.json is not None
+        assert set(response.json) == {
+            "cores",
+            "find_books",
+            "ocr_angles_read",
+            "recognize_spines",
+            "scan_cache",
+            "scan_jobs",
+            "spine_cache",
+        }
+        assert set(response.json["scan_cache"]) == {"hits", "misses", "size"}
+        assert set(response.json["find_books"]) == {
+            "batch_size",
+            "wait_seconds",
+        }
+
     @pytest.mark.usefixtures("mock_recognizer")
     def test_scan_cover(self, client: FlaskClient, mock_extract):
         """Tests endpoint /books/scan_cover"""
@@ -286,14 +386,37 @@ class TestAPIEndpoint:
             assert results[0]["title"] == "APPLES"
             assert results[1]["title"] == "CHERRIES"
 
+            # Nearly the same image again is answered from the cache
+            find_text = cast(Mock, ocr.TextRecognizer.find_text)
+            recognize_calls = find_text.call_count
+            image = cv.imread("tests/img/cpp.jpg")
+            assert image is not None
+            _, smaller_image = cv.imencode(
+                ".jpg", cv.resize(image, None, fx=0.5, fy=0.5)
+            )
+            response = client.post(
+                "/books/scan_cover", data=BytesIO(smaller_image.tobytes())
+            )
+            assert response.json is not None
+            assert response.json["resultsCount"] == 2
+            assert find_text.call_count == recognize_calls
+
     @pytest.mark.usefixtures("mock_recognizer")
     def test_scan_shelf(
-        self, client: FlaskClient, mock_extract, mock_find_books
+        self, client: FlaskClient, mock_extract, mock_find_books, monkeypatch
     ):
         """Tests endpoint /books/scan_shelf"""
 
         url = "books/scan_shelf"
 
+        # The mocked spines are too small and have no text detected on them
+        monkeypatch.setattr(books, "_SKIP_BLANK_SPINES", False)
+
+        # Google Books answers in the order it's asked, so look the spines up
+        # one at a time
+        lookups = ThreadPoolExecutor(1)
+        monkeypatch.setattr(books, "_spine_lookups", lookups)
+
         # Blank
         response = client.post(url)
         logging.info(response.json)
@@ -341,18 +464,18 @@ class TestAPIEndpoint:
         # Test that it returns nothing when it extracts no authors
         find_books_result: list[dict[str, Any]] = [
             {
-                "box": {"x1": 0.0, "x2": 1.0, "y1": 0.0, "y2": 1.0},
+                "box": {"x1": 300.0, "x2": 301.0, "y1": 300.0, "y2": 301.0},
                 "class": 0,
                 "confidence": 0.9,
                 "name": "book",
-                "segments": {"x": [0.0, 0.0], "y": [1.0, 1.0]},
+                "segments": {"x": [300.0, 300.0], "y": [301.0, 301.0]},
             },
             {
-                "box": {"x1": 1.0, "x2": 2.0, "y1": 1.0, "y2": 2.0},
+                "box": {"x1": 301.0, "x2": 302.0, "y1": 301.0, "y2": 302.0},
                 "class": 0,
                 "confidence": 0.8,
                 "name": "book",
-                "segments": {"x": [1.0, 1.0], "y": [2.0, 2.0]},
+                "segments": {"x": [301.0, 301.0], "y": [302.0, 302.0]},
             },
         ]
         mock_find_books(find_books_result)
@@ -478,6 +601,8 @@ class TestAPIEndpoint:
                 google_books_url,
                 json=lambda r, c: next(responses_iter),  # return next response
             )
+            crop_polygon = Mock(wraps=ocr.crop_polygon)
+            monkeypatch.setattr(ocr, "crop_polygon", crop_polygon)
             response = client.post(url, data=BytesIO(image_bytes))
 
             logging.info(response.json)
@@ -491,9 +616,180 @@ class TestAPIEndpoint:
                 == len(response.json["results"])
                 == 2
             )
+            assert crop_polygon.call_count == 2  # Each spine cropped once
             results = response.json["results"]
             assert results[0]["title"] == "APPLES"
             assert results[1]["title"] == "CHERRIES"
+            assert response.json["spineCacheHits"] == 0
+
+            # Scanning the shelf again reuses the results of its spines,
+            # without searching Google Books again
+            books.scan_cache.clear()
+            response = client.post(url, data=BytesIO(image_bytes))
+            assert response.json is not None
+            assert response.json["spineCacheHits"] == 2
+            assert response.json["resultsCount"] == 2
+            assert response.json["skippedSpines"] == []
+
+        # Spines which can't have readable text are skipped
+        monkeypatch.setattr(books, "_SKIP_BLANK_SPINES", True)
+        books.scan_cache.clear()
+        books.spine_cache.clear()
+        mock_extract.mock.reset_mock()
+        response = client.post(
+            "/books/scan_shelf?nosearch", data=BytesIO(image_bytes)
+        )
+        logging.info(response.json)
+        assert response.status_code == HTTPStatus.OK
+        assert response.json is not None
+        assert response.json["titles"] == ["", ""]
+        assert response.json["skippedSpines"] == [
+            {"index": 0, "reason": "too small"},
+            {"index": 1, "reason": "too small"},
+        ]
+        mock_extract.mock.assert_not_called()
+
+    @pytest.mark.usefixtures("mock_recognizer", "mock_shelf")
+    def test_scan_shelf_stream(self, client: FlaskClient):
+        """Tests streaming the results of endpoint /books/scan_shelf"""
+
+        with open("tests/img/cpp.jpg", "rb") as f:
+            image_bytes = f.read()
+
+        # The count of spines, then each spine, then a summary
+        response = client.post(
+            "/books/scan_shelf?nosearch&stream", data=BytesIO(image_bytes)
+        )
+        assert response.status_code == HTTPStatus.OK
+        assert response.mimetype == "application/x-ndjson"
+        records = [json.loads(line) for line in response.text.splitlines()]
+        logging.info(records)
+        assert [r["type"] for r in records] == [
+            "spines",
+            "spine",
+            "spine",
+            "summary",
+        ]
+        assert records[0]["count"] == 2
+        assert sorted(r["index"] for r in records[1:3]) == [0, 1]
+        for record in records[1:3]:
+            assert record["title"] == "KICKING AWAY THE LADDER"
+            assert record["results"] == []
+            assert not record["cached"] and record["skipReason"] is None
+        assert records[3]["titles"] == ["KICKING AWAY THE LADDER"] * 2
+
+        # Same scan again, as server-sent events, answered from the cache
+        response = client.post(
+            "/books/scan_shelf?nosearch",
+            data=BytesIO(image_bytes),
+            headers={"Accept": "text/event-stream"},
+        )
+        assert response.status_code == HTTPStatus.OK
+        assert response.mimetype == "text/event-stream"
+        events = response.text.strip().split("\n\n")
+        assert len(events) == 2
+        assert events[0].startswith("event: spines\ndata: ")
+        assert events[-1].startswith("event: summary\ndata: ")
+        summary = json.loads(events[-1].split("data: ", 1)[1])
+        assert summary["titles"] == records[3]["titles"]
+
+        # Bad images are still rejected before streaming
+        response = client.post(
+            "/books/scan_shelf?stream", data=BytesIO(b"dummy file content")
+        )
+        assert response.status_code == HTTPStatus.BAD_REQUEST
+        assert response.json is not None and "message" in response.json
+
+    @pytest.mark.usefixtures("mock_recognizer")
+    def test_scan_shelf_concurrent_spines(
+        self, client: FlaskClient, mock_extract, mock_shelf, monkeypatch
+    ):
+        """Tests that the spines of a shelf are looked up at the same time,
+        with their results still in order"""
+
+        lookups = ThreadPoolExecutor(3)
+        monkeypatch.setattr(books, "_spine_lookups", lookups)
+        with open("tests/img/cpp.jpg", "rb") as f:
+            image_bytes = f.read()
+        mock_shelf(3)
+
+        # Each lookup only returns once all three are running
+        barrier = threading.Barrier(3, timeout=10)
+
+        def extract(recognized_texts):
+            barrier.wait()
+            return DEFAULT
+
+        mock_extract.mock.side_effect = extract
+        response = client.post(
+            "/books/scan_shelf?nosearch", data=BytesIO(image_bytes)
+        )
+        logging.info(response.json)
+        assert response.status_code == HTTPStatus.OK
+        assert response.json is not None
+        assert response.json["titles"] == ["KICKING AWAY THE LADDER"] * 3
+        assert response.json["authors"] == ["HA-JOON CHANG"] * 3
+        lookups.shutdown()
+
+    @pytest.mark.usefixtures("mock_recognizer", "mock_shelf")
+    def test_scan_shelf_jobs(self, client: FlaskClient, monkeypatch, tmp_path):
+        """Tests endpoints /books/scan_shelf/jobs and
+        /books/scan_shelf/jobs/<id>"""
+
+        queue = jobs.JobQueue(
+            str(tmp_path / "jobs.sqlite3"),
+            books._run_scan_shelf_job,
+            workers=0,
+            ttl=60,
+            lease=60,
+            max_queued=1,
+        )
+        monkeypatch.setattr(books, "scan_jobs", queue)
+        with open("tests/img/cpp.jpg", "rb") as f:
+            image_bytes = f.read()
+
+        # Bad images are rejected without being queued
+        response = client.post(
+            "/books/scan_shelf/jobs", data=BytesIO(b"dummy file content")
+        )
+        assert response.status_code == HTTPStatus.BAD_REQUEST
+        assert queue.stats()["queued"] == 0
+
+        response = client.post(
+            "/books/scan_shelf/jobs?nosearch", data=BytesIO(image_bytes)
+        )
+        logging.info(response.json)
+        assert response.status_code == HTTPStatus.ACCEPTED
+        assert response.json is not None and "id" in response.json
+        job_id = response.json["id"]
+
+        response = client.get(f"/books/scan_shelf/jobs/{job_id}")
+        assert response.status_code == HTTPStatus.OK
+        assert response.json is not None
+        assert response.json["status"] == "queued"
+
+        # The queue is full until the scan is run
+        response = client.post(
+            "/books/scan_shelf/jobs?nosearch", data=BytesIO(image_bytes)
+        )
+        assert response.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+        assert response.json is not None and "message" in response.json
+
+        assert queue.run_next()
+        response = client.get(f"/books/scan_shelf/jobs/{job_id}")
+        logging.info(response.json)
+        assert response.status_code == HTTPStatus.OK
+        assert response.json is not None
+        assert response.json["status"] == "done"
+        assert response.json["progress"] == {"spines": 2, "scanned": 2}
+        assert (
+            response.json["result"]["titles"]
+            == ["KICKING AWAY THE LADDER"] * 2
+        )
+
+        response = client.get("/books/scan_shelf/jobs/missing")
+        assert response.status_code == HTTPStatus.NOT_FOUND
+        assert response.json is not None and "message" in response.json
 
     def test_search(self, client: FlaskClient):
         """Tests endpoint /books/search"""
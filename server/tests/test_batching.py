@@ -0,0 +1,59 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import pytest
+from tabby_server.batching import Histogram, MicroBatcher
+
+
+def test_histogram():
+    """Tests counting values in buckets"""
+
+    histogram = Histogram([1, 5])
+    for value in (0.5, 1, 3, 10):
+        histogram.observe(value)
+
+    stats = histogram.to_dict()
+    assert stats["buckets"] == {"1": 2, "5": 1, "+Inf": 1}
+    assert stats["count"] == 4
+    assert stats["sum"] == 14.5
+
+
+def test_micro_batcher():
+    """Tests that items submitted at the same time are run in one batch and
+    that each caller gets its own result"""
+
+    batches = []
+    release = threading.Event()
+
+    def double(items: list[int]) -> list[int]:
+        release.wait()
+        batches.append(items)
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(double, max_batch_size=4, window=0.2)
+    with ThreadPoolExecutor(6) as executor:
+        futures = [executor.submit(batcher.submit, i) for i in range(6)]
+        release.set()
+        results = [f.result() for f in futures]
+
+    assert results == [0, 2, 4, 6, 8, 10]
+    assert sorted(len(b) for b in batches) == [2, 4]
+
+    stats = batcher.stats()
+    assert stats["batch_size"]["count"] == 2
+    assert stats["wait_seconds"]["count"] == 6
+
+
+def test_micro_batcher_error():
+    """Tests that errors are raised to every caller of the batch"""
+
+    def fail(items: list[int]) -> list[int]:
+        raise ValueError("bad batch")
+
+    batcher = MicroBatcher(fail, max_batch_size=4, window=0.0)
+    with pytest.raises(ValueError):
+        batcher.submit(1)
+
+    # Callers aren't left waiting if some results are missing
+    batcher = MicroBatcher(lambda items: [], max_batch_size=4, window=0.0)
+    with pytest.raises(ValueError):
+        batcher.submit(1)
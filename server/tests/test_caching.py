@@ -0,0 +1,92 @@
+import cv2 as cv
+from tabby_server import caching
+from tabby_server.vision import hashing
+
+
+def test_perceptual_hash():
+    """Tests that hashes match for the same image at another size or
+    quality, but not for another image"""
+
+    image = cv.imread("tests/img/kicking.jpg")
+    image_hash = hashing.perceptual_hash(image)
+
+    smaller = cv.resize(image, None, fx=0.5, fy=0.5)
+    _, encoded = cv.imencode(".jpg", smaller, [cv.IMWRITE_JPEG_QUALITY, 50])
+    recompressed = cv.imdecode(encoded, cv.IMREAD_COLOR)
+    assert (
+        hashing.hamming_distance(
+            image_hash, hashing.perceptual_hash(recompressed)
+        )
+        <= 4
+    )
+
+    other = cv.imread("tests/img/linalg.jpg")
+    assert (
+        hashing.hamming_distance(image_hash, hashing.perceptual_hash(other))
+        > 10
+    )
+
+    # Greyscale gives the same hash
+    grey = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+    assert hashing.perceptual_hash(grey) == image_hash
+
+
+def test_perceptual_hash_padded():
+    """Tests that long and narrow images keep their hash when padded to a
+    square, and that their aspect ratio is told apart"""
+
+    image = cv.imread("tests/img/kicking.jpg")
+    other = cv.imread("tests/img/linalg.jpg")
+    left, right = image.shape[1] // 2 - 20, image.shape[1] // 2 + 20
+    spine = image[:, left:right]
+    other_spine = other[:, left:right]
+
+    spine_hash = hashing.perceptual_hash(spine, pad_to_square=True)
+    smaller = cv.resize(spine, None, fx=0.5, fy=0.5)
+    assert hashing.perceptual_hash(smaller, pad_to_square=True) == spine_hash
+    assert (
+        hashing.hamming_distance(
+            spine_hash,
+            hashing.perceptual_hash(other_spine, pad_to_square=True),
+        )
+        > 10
+    )
+
+    assert hashing.aspect_bucket(smaller) == hashing.aspect_bucket(spine)
+    assert hashing.aspect_bucket(spine) != hashing.aspect_bucket(image)
+    assert hashing.aspect_bucket(image.transpose(1, 0, 2)) == -2
+
+
+def test_perceptual_cache(monkeypatch):
+    """Tests matching, evicting and expiring cached results"""
+
+    now = 0.0
+    monkeypatch.setattr(caching.time, "monotonic", lambda: now)
+    cache: caching.PerceptualCache[str] = caching.PerceptualCache(
+        max_size=2, ttl=10.0, max_distance=2
+    )
+
+    cache.put("a", 0b1111, "first")
+    assert cache.get("a", 0b1111) == "first"
+    assert cache.get("a", 0b1100) == "first"  # Close enough
+    assert cache.get("a", 0b0000) is None  # Too far
+    assert cache.get("b", 0b1111) is None  # Other key
+
+    # Least recently used is evicted
+    cache.put("a", 0b11110000, "second")
+    cache.get("a", 0b1111)
+    cache.put("a", 0b111100000000, "third")
+    assert cache.get("a", 0b11110000) is None
+    assert cache.get("a", 0b1111) == "first"
+
+    # Expired
+    now = 11.0
+    assert cache.get("a", 0b1111) is None
+    assert cache.stats() == {"hits": 4, "misses": 4, "size": 0}
+
+    # Nothing is stored with a size of 0
+    empty: caching.PerceptualCache[str] = caching.PerceptualCache(
+        max_size=0, ttl=10.0, max_distance=2
+    )
+    empty.put("a", 0, "value")
+    assert empty.get("a", 0) is None
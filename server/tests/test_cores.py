@@ -0,0 +1,38 @@
+import cv2 as cv
+import torch
+from tabby_server import cores
+
+
+def test_split_cores():
+    """Tests dividing cores into slots"""
+
+    assert cores.split_cores([0, 1, 2, 3], 2) == [[0, 1], [2, 3]]
+    assert cores.split_cores([0, 1, 2, 3, 4], 2) == [[0, 1, 2], [3, 4]]
+    assert cores.split_cores([0, 1, 2, 3], 1) == [[0, 1, 2, 3]]
+
+    # More slots than cores, so slots share cores
+    assert cores.split_cores([4, 5], 3) == [[4], [5], [4]]
+
+
+def test_assign(monkeypatch):
+    """Tests setting the thread counts of this process from its slot"""
+
+    monkeypatch.setattr(cores, "_layout", None)
+    torch_threads = torch.get_num_threads()
+    opencv_threads = cv.getNumThreads()
+    try:
+        slot_cores = cores.assign(1, 2, cores=[0, 1, 2, 3], pin=False)
+        assert slot_cores == [2, 3]
+        assert torch.get_num_threads() == 2
+
+        layout = cores.layout()
+        assert layout["cores"] == [2, 3]
+        assert layout["slot"] == 1 and layout["slots"] == 2
+        assert layout["torch_threads"] == 2
+        assert not layout["pinned"]
+
+        # Processes started from this one split its slot
+        assert cores.available_cores() == [2, 3]
+    finally:
+        torch.set_num_threads(torch_threads)
+        cv.setNumThreads(opencv_threads)
@@ -0,0 +1,44 @@
+from io import BytesIO
+import numpy as np
+from PIL import Image
+from tabby_server.vision import decoding
+
+
+def _encode(image: Image.Image, image_format: str, **kwargs) -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, image_format, **kwargs)
+    return buffer.getvalue()
+
+
+def test_decode_image():
+    """Tests decoding uploaded images into BGR arrays"""
+
+    # Red band along the top
+    rgb = np.zeros((300, 200, 3), dtype=np.uint8)
+    rgb[:50, :, 0] = 255
+    image = Image.fromarray(rgb)
+
+    # Colors come out in BGR order
+    png = decoding.decode_image(_encode(image, "PNG"))
+    assert png is not None
+    assert png.shape == (300, 200, 3) and png.flags["C_CONTIGUOUS"]
+    assert (png[10, 10] == [0, 0, 255]).all()
+
+    # EXIF orientation is applied, rotating the band to the right side
+    exif = image.getexif()
+    exif[0x0112] = 6
+    jpeg = _encode(image, "JPEG", exif=exif)
+    upright = decoding.decode_image(jpeg, min_area=0)
+    assert upright is not None and upright.shape == (200, 300, 3)
+    assert upright[100, 290, 2] > 200 and upright[100, 10, 2] < 50
+
+    # Large JPEGs are reduced, but never below the minimum area
+    assert decoding.decode_image(jpeg, min_area=15_000).shape == (100, 150, 3)
+    assert decoding.decode_image(jpeg, min_area=15_001).shape == (200, 300, 3)
+
+    # Formats OpenCV can't read are decoded with Pillow
+    gif = decoding.decode_image(_encode(image, "GIF"))
+    assert gif is not None and gif.shape == (300, 200, 3)
+
+    # Not an image
+    assert decoding.decode_image(b"dummy file content") is None
@@ -0,0 +1,43 @@
+from tabby_server import inference
+
+
+def _do_nothing(*args) -> None:
+    """Stands in for loading the models in the processes of the pool."""
+
+
+def test_run_inline():
+    """Tests running work without a pool"""
+
+    assert inference.run(pow, 2, 3) == 8
+    assert inference.run_all(pow, [2, 3], [2, 2]) == [4, 9]
+    assert list(inference.run_each(pow, [2, 3], [2, 2])) == [4, 9]
+
+
+def test_run_pool(monkeypatch):
+    """Tests running work in a pool of processes"""
+
+    monkeypatch.setattr(inference, "_init_process", _do_nothing)
+
+    inference.start(2)
+    try:
+        assert inference.run(pow, 2, 3) == 8
+        assert inference.run_all(pow, [2, 3, 4], [2, 2, 2]) == [4, 9, 16]
+        results = inference.run_each(pow, [2, 3, 4], [2, 2, 2])
+        assert next(results) == 4
+        assert list(results) == [9, 16]
+    finally:
+        inference.shutdown()
+
+    # Runs inline again after shutting down
+    assert inference.run(pow, 2, 3) == 8
+
+
+def test_replacement_pool_not_forked():
+    """Tests that pools created once threads are running don't fork"""
+
+    pool = inference._create_pool(1, fork=False)
+    try:
+        method = pool._mp_context.get_start_method()  # type: ignore
+        assert method in ("forkserver", "spawn")
+    finally:
+        pool.shutdown()
@@ -0,0 +1,129 @@
+import pytest
+from tabby_server import jobs
+
+
+def test_job_queue(tmp_path, monkeypatch):
+    """Tests running jobs in order, reporting progress, failing and expiring
+    results"""
+
+    now = 1000.0
+    monkeypatch.setattr(jobs.time, "time", lambda: now)
+
+    def handler(params, payload, report):
+        if params.get("fail"):
+            raise ValueError("Bad job")
+        report({"done": 1})
+        return {"length": len(payload), **params}
+
+    queue = jobs.JobQueue(
+        str(tmp_path / "jobs.sqlite3"),
+        handler,
+        workers=0,
+        ttl=60,
+        lease=30,
+        max_queued=2,
+    )
+
+    # Nothing is created until a job is submitted
+    assert queue.stats() == {"queued": 0, "running": 0, "done": 0, "failed": 0}
+    assert queue.get("missing") is None
+    assert not (tmp_path / "jobs.sqlite3").exists()
+
+    first = queue.submit({"n": 1}, b"abc")
+    now += 1
+    second = queue.submit({"fail": True}, b"")
+    with pytest.raises(jobs.QueueFull):
+        queue.submit({}, b"")
+    assert queue.get(first) == {
+        "id": first,
+        "status": jobs.QUEUED,
+        "progress": None,
+        "result": None,
+        "error": None,
+    }
+    assert queue.get("missing") is None
+
+    # Oldest first
+    assert queue.run_next()
+    job = queue.get(first)
+    assert job is not None
+    assert job["status"] == jobs.DONE
+    assert job["progress"] == {"done": 1}
+    assert job["result"] == {"length": 3, "n": 1}
+
+    assert queue.run_next()
+    job = queue.get(second)
+    assert job is not None
+    assert job["status"] == jobs.FAILED
+    assert job["error"] == "Bad job"
+
+    assert not queue.run_next()
+    assert queue.stats() == {"queued": 0, "running": 0, "done": 1, "failed": 1}
+
+    # Results expire after the TTL
+    now += 61
+    assert queue.get(first) is None
+    assert queue.stats()["done"] == 0
+
+    # So do jobs which wait too long to be run
+    third = queue.submit({}, b"")
+    now += 61
+    assert queue.get(third) is None
+    assert not queue.run_next()
+
+
+def test_job_queue_lease(tmp_path, monkeypatch):
+    """Tests that jobs abandoned by a worker which died are run again, until
+    they've been started too many times"""
+
+    now = 1000.0
+    monkeypatch.setattr(jobs.time, "time", lambda: now)
+    path = str(tmp_path / "jobs.sqlite3")
+    runs = []
+
+    def handler(params, payload, report):
+        runs.append(params)
+        return {}
+
+    queue = jobs.JobQueue(
+        path,
+        handler,
+        workers=0,
+        ttl=60,
+        lease=30,
+        max_queued=2,
+        max_attempts=2,
+    )
+    job_id = queue.submit({}, b"")
+
+    # Another worker takes the job, then dies
+    other = jobs.JobQueue(
+        path,
+        handler,
+        workers=0,
+        ttl=60,
+        lease=30,
+        max_queued=2,
+        max_attempts=2,
+    )
+    assert other._claim() is not None
+    assert not queue.run_next()
+    job = queue.get(job_id)
+    assert job is not None and job["status"] == jobs.RUNNING
+
+    # Taken again once the lease runs out
+    now += 31
+    assert queue.run_next()
+    job = queue.get(job_id)
+    assert job is not None and job["status"] == jobs.DONE
+    assert len(runs) == 1
+
+    # Failed once started more than max_attempts times
+    job_id = queue.submit({}, b"")
+    for _ in range(2):
+        assert other._claim() is not None
+        now += 31
+    assert queue.run_next()
+    job = queue.get(job_id)
+    assert job is not None and job["status"] == jobs.FAILED
+    assert len(runs) == 1
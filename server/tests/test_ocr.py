@@ -1,8 +1,20 @@
 from unittest.mock import Mock
+import os
 import cv2 as cv
 
 import numpy as np
-from tabby_server.vision.ocr import TextRecognizer, scale_image
+import pytest
+from tabby_server.vision import ocr, quantization
+from tabby_server.vision.ocr import (
+    RecognizedText,
+    QualityBar,
+    RecognizedTextBatch,
+    TextRecognizer,
+    TextRegions,
+    crop_polygon,
+    group_regions_by_polygons,
+    scale_image,
+)
 
 
 def test_init():
@@ -13,7 +25,7 @@ def test_init():
     mock_reader.readtext.return_value = []
     recognizer = TextRecognizer(mock_reader)
     image = np.zeros((640, 640, 3))
-    assert recognizer.find_text(image) == []
+    assert len(recognizer.find_text(image)) == 0
 
 
 def test_finding_text_real():
@@ -104,6 +116,351 @@ def test_finding_text_mock():
     ).all()
 
 
+def test_finding_text_multi_mock():
+    """Tests finding text at multiple angles with mock results"""
+
+    image = np.zeros((100, 100, 3), dtype=np.uint8)
+
+    mock_reader = Mock()
+    mock_reader.detect.return_value = ([[[50, 100, 50, 100]]], [[]])
+    mock_reader.recognize.return_value = [
+        (
+            [
+                [50.0, 50.0],
+                [100.0, 50.0],
+                [100.0, 100.0],
+                [50.0, 100.0],
+            ],
+            "some text",
+            0.9,
+        )
+    ]
+
+    recognizer = TextRecognizer(mock_reader)
+
+    # Detector and recognizer are each called only once
+    results = recognizer.find_text_multi(image, (0, 90, 270))
+    mock_reader.detect.assert_called_once()
+    mock_reader.recognize.assert_called_once()
+    assert mock_reader.recognize.call_args.kwargs["rotation_info"] == [
+        270,
+        90,
+    ]
+
+    # Corners are already in the coordinates of the original image
+    assert len(results) == 1
+    assert results[0].text == "some text"
+    assert (
+        results[0].corners
+        == [
+            [50.0, 50.0],
+            [100.0, 50.0],
+            [100.0, 100.0],
+            [50.0, 100.0],
+        ]
+    ).all()
+
+    # Nothing detected, so nothing is recognized
+    mock_reader.reset_mock()
+    mock_reader.detect.return_value = ([[]], [[]])
+    assert len(recognizer.find_text_multi(image, (0, 90, 270))) == 0
+    mock_reader.recognize.assert_not_called()
+
+
+def test_choose_angles_mock():
+    """Tests predicting the orientation of text with mock results"""
+
+    image = np.zeros((200, 100, 3), dtype=np.uint8)
+
+    def result(confidence):
+        return [([[0, 0], [10, 0], [10, 10], [0, 10]], "text", confidence)]
+
+    mock_reader = Mock()
+    recognizer = TextRecognizer(mock_reader)
+
+    # No regions, nothing to predict
+    assert recognizer.choose_angles(image, TextRegions(), (0, 90)) == (0, 90)
+
+    # Tall regions are sideways, so upright is ruled out without reading
+    tall = TextRegions(horizontal=[[10, 20, 10, 110], [40, 50, 10, 110]])
+    angles = recognizer.choose_angles(image, tall, (0, 90, 270))
+    assert angles == (90, 270)
+    mock_reader.recognize.assert_not_called()
+
+    # Enough regions to read a few of them at each angle
+    tall.horizontal += [[60, 70, 10, 110], [80, 90, 10, 110]]
+    mock_reader.recognize.side_effect = [result(0.9) * 3, result(0.1) * 3]
+    assert recognizer.choose_angles(image, tall, (0, 90, 270)) == (90,)
+    assert mock_reader.recognize.call_count == 2
+
+    # Too close to call
+    mock_reader.recognize.side_effect = [result(0.5) * 3, result(0.4) * 3]
+    angles = recognizer.choose_angles(image, tall, (0, 90, 270))
+    assert angles == (90, 270)
+
+
+def test_recognize_regions_one_angle_mock():
+    """Tests reading regions of text at exactly one angle with mock
+    results"""
+
+    image = np.zeros((100, 100), dtype=np.uint8)
+
+    mock_reader = Mock()
+    mock_reader.recognize.return_value = [
+        (
+            [
+                [50.0, 50.0],
+                [100.0, 50.0],
+                [100.0, 100.0],
+                [50.0, 100.0],
+            ],
+            "some text",
+            0.9,
+        )
+    ]
+    recognizer = TextRecognizer(mock_reader)
+
+    # 90 clockwise, boxes are given in the coordinates of the rotated image
+    regions = TextRegions(horizontal=[[50, 100, 0, 50]])
+    results = recognizer.recognize_regions(image, regions, (90,))
+    assert mock_reader.recognize.call_args.args[1] == [[50, 100, 50, 100]]
+    assert mock_reader.recognize.call_args.kwargs.get("rotation_info") is None
+
+    # Corners are mapped back onto the original image
+    assert len(results) == 1
+    assert (
+        results[0].corners
+        == [
+            [50.0, 50.0],
+            [50.0, 0.0],
+            [100.0, 0.0],
+            [100.0, 50.0],
+        ]
+    ).all()
+
+
+def _mock_get_text(calls: list):
+    """Stands in for EasyOCR's `get_text()`. Reads each line as "text", with
+    the brightness of its top left pixel as the confidence."""
+
+    def get_text(
+        character, imgH, imgW, model, converter, image_list, *_, **__
+    ):
+        calls.append((imgH, imgW, [line for _, line in image_list]))
+        return [(box, "text", line[0, 0] / 255) for box, line in image_list]
+
+    return get_text
+
+
+def test_choose_angles_many_mock(monkeypatch):
+    """Tests predicting the orientation of text on many images at once with
+    mock results"""
+
+    calls: list = []
+    monkeypatch.setattr(ocr, "get_text", _mock_get_text(calls))
+    recognizer = TextRecognizer(Mock(character="abc", lang_char="abc"))
+
+    # Bottom left corners are bright, so the text reads best at 90
+    image = np.zeros((200, 100), dtype=np.uint8)
+    tall = TextRegions(horizontal=[[10, 20, 10, 110], [40, 50, 10, 110]])
+    probed = TextRegions(horizontal=tall.horizontal + [[60, 70, 10, 110]])
+    probed.horizontal.append([80, 90, 10, 110])
+    for x_min, _, _, y_max in probed.horizontal:
+        image[y_max - 1, x_min] = 255
+
+    angles = recognizer.choose_angles_many(
+        [(image, TextRegions()), (image, tall), (image, probed)],
+        (0, 90, 270),
+    )
+    assert angles == [(0, 90, 270), (90, 270), (90,)]
+
+    # The largest regions are read at both angles in a single call
+    assert len(calls) == 1
+    assert len(calls[0][2]) == 6
+
+
+def test_recognize_many_mock(monkeypatch):
+    """Tests reading the regions of text of many images at once with mock
+    results"""
+
+    calls: list = []
+    monkeypatch.setattr(ocr, "get_text", _mock_get_text(calls))
+    recognizer = TextRecognizer(Mock(character="abc", lang_char="abc"))
+
+    wide_image = np.zeros((100, 100), dtype=np.uint8)
+    wide_image[20, 10] = 200
+    wide = TextRegions(horizontal=[[10, 50, 20, 30]])
+    tall_image = np.zeros((100, 100), dtype=np.uint8)
+    tall_image[49, 10] = 255  # Top left corner once turned 90 clockwise
+    tall = TextRegions(horizontal=[[10, 20, 10, 50]])
+
+    results = recognizer.recognize_many(
+        [
+            (wide_image, wide, (0,)),
+            (tall_image, tall, (90,)),
+            (tall_image, tall, (270, 90)),
+            (wide_image, TextRegions(), (0,)),
+        ]
+    )
+
+    # Every line is read in one call, scaled to the same height and sorted
+    # by width
+    assert len(calls) == 1
+    imgH, imgW, lines = calls[0]
+    assert len(lines) == 5  # Upright is also tried with several angles
+    assert all(line.shape[0] == imgH for line in lines)
+    widths = [line.shape[1] for line in lines]
+    assert widths == sorted(widths)
+    assert imgW % imgH == 0 and imgW >= widths[-1]
+
+    # Results go back to the image they came from, at the best angle
+    assert [len(r) for r in results] == [1, 1, 1, 0]
+    assert results[0].confidences[0] == pytest.approx(200 / 255)
+    assert results[0].corners[0].tolist() == [
+        [10, 20],
+        [50, 20],
+        [50, 30],
+        [10, 30],
+    ]
+    for result in results[1:3]:
+        assert result.confidences[0] == 1.0
+        assert result.corners[0].tolist() == [
+            [10, 50],
+            [10, 10],
+            [20, 10],
+            [20, 50],
+        ]
+
+
+def test_recognize_regions_until_mock(monkeypatch):
+    """Tests reading text one angle at a time until it's good enough with
+    mock results"""
+
+    calls: list = []
+    monkeypatch.setattr(ocr, "get_text", _mock_get_text(calls))
+    recognizer = TextRecognizer(Mock(character="abc", lang_char="abc"))
+
+    image = np.zeros((100, 100), dtype=np.uint8)
+    regions = TextRegions(horizontal=[[10, 20, 10, 50], [30, 40, 10, 50]])
+    image[49, 10] = 255  # Top left corner of the first region at 90
+    image[49, 30] = 100
+    image[10, 39] = 200  # Top left corner of the second region at 270
+    quality = QualityBar(min_confidence=0.3, min_characters=8)
+
+    # Good enough at the first angle, so no other angle is read
+    results = recognizer.recognize_regions_until(
+        image, regions, (90, 270, 0), quality
+    )
+    assert results.angles == (90,)
+    assert len(calls) == 1
+    assert results.texts.tolist() == ["text", "text"]
+
+    # Not enough confident text, so the next angle is read too, and each
+    # region keeps its best angle
+    quality = QualityBar(min_confidence=0.5, min_characters=8)
+    results = recognizer.recognize_regions_until(
+        image, regions, (90, 270, 0), quality
+    )
+    assert results.angles == (90, 270)
+    assert results.confidences.tolist() == pytest.approx([1.0, 200 / 255])
+
+    # Never good enough, so every angle is read
+    quality = QualityBar(min_confidence=0.5, min_characters=100)
+    results = recognizer.recognize_regions_until(
+        image, regions, (90, 270, 0), quality
+    )
+    assert results.angles == (90, 270, 0)
+
+    # Angles which fit the shape of the regions are read first
+    calls.clear()
+    monkeypatch.setattr(recognizer, "detect_regions", lambda _: regions)
+    results = recognizer.find_text_multi(
+        image, (0, 270, 90), quality=QualityBar(min_characters=1)
+    )
+    assert results.angles == (270,)
+
+
+def test_finding_text_scaled_mock():
+    """Tests finding text starting from a downscaled image with mock
+    results"""
+
+    image = np.zeros((1000, 1000, 3), dtype=np.uint8)
+
+    def result(text, confidence):
+        corners = [[10, 10], [20, 10], [20, 20], [10, 20]]
+        return [(corners, text, confidence)]
+
+    mock_reader = Mock()
+    recognizer = TextRecognizer(mock_reader)
+
+    # Confident text found on the downscaled image, so stop there
+    mock_reader.readtext.side_effect = [result("confident", 0.9)]
+    results = recognizer.find_text_scaled(
+        image, min_confidence=0.5, ladder=(10_000, None)
+    )
+    assert mock_reader.readtext.call_count == 1
+    assert mock_reader.readtext.call_args.args[0].shape == (100, 100, 3)
+    assert results[0].text == "confident"
+    assert (
+        results[0].corners == [[100, 100], [200, 100], [200, 200], [100, 200]]
+    ).all()
+
+    # Not confident enough, so try again at full resolution
+    mock_reader.reset_mock()
+    mock_reader.readtext.side_effect = [
+        result("unsure", 0.1),
+        result("confident", 0.9),
+    ]
+    results = recognizer.find_text_scaled(
+        image, min_confidence=0.5, ladder=(10_000, None)
+    )
+    assert mock_reader.readtext.call_count == 2
+    assert mock_reader.readtext.call_args.args[0].shape == (1000, 1000, 3)
+    assert results[0].text == "confident"
+    assert (
+        results[0].corners == [[10, 10], [20, 10], [20, 20], [10, 20]]
+    ).all()
+
+
+def test_recognized_text_batch() -> None:
+    """Tests vectorized operations on RecognizedTextBatch"""
+
+    texts = [
+        RecognizedText(
+            text="title",
+            corners=np.array([[0, 0], [40, 0], [40, 10], [0, 10]]),
+            confidence=0.9,
+        ),
+        RecognizedText(
+            text="a",
+            corners=np.array([[0, 20], [10, 20], [10, 30], [0, 30]]),
+            confidence=0.8,
+        ),
+        RecognizedText(
+            text="unsure",
+            corners=np.array([[0, 40], [20, 40], [20, 60], [0, 60]]),
+            confidence=0.1,
+        ),
+    ]
+    batch = RecognizedTextBatch.from_texts(texts)
+
+    # Same results as each RecognizedText on its own
+    assert len(batch) == 3
+    assert batch.areas.tolist() == [t.area for t in texts]
+    assert batch.centers.tolist() == [t.center.tolist() for t in texts]
+    assert [r.text for r in batch] == ["title", "a", "unsure"]
+
+    # Filtering
+    filtered = batch.filtered(min_confidence=0.3, min_length=2)
+    assert filtered.texts.tolist() == ["title"]
+    assert len(RecognizedTextBatch.empty().filtered(0.3, 2)) == 0
+
+    # Transforming with an affine matrix
+    shifted = batch.transformed(np.array([[1.0, 0.0, 5.0], [0.0, 1.0, 0.0]]))
+    assert shifted.corners[0].tolist() == [[5, 0], [45, 0], [45, 10], [5, 10]]
+    assert batch.corners[0].tolist() == [[0, 0], [40, 0], [40, 10], [0, 10]]
+
+
 def test_scale_image() -> None:
     """Tests scale_image()"""
 
@@ -112,3 +469,122 @@ def test_scale_image() -> None:
     image, k = scale_image(image, 5000)  # scale down to below 5000 pixels
     w, h, _ = image.shape
     assert w * h <= 5000
+
+    # Aspect ratio is kept
+    image = np.zeros((100, 400, 3))
+    image, k = scale_image(image, 10_000)
+    h, w, _ = image.shape
+    assert (h, w) == (50, 200)
+    assert k == 0.5
+
+
+def test_crop_polygon() -> None:
+    """Tests cropping a leaning spine upright out of an image"""
+
+    image = np.zeros((400, 400, 3), dtype=np.uint8)
+    rect = ((200.0, 200.0), (40.0, 200.0), 20.0)  # leaning 20 degrees
+    polygon = cv.boxPoints(rect)
+    cv.fillPoly(image, [polygon.astype(np.int32)], (255, 255, 255))
+
+    crop, matrix = crop_polygon(image, polygon)
+
+    # Upright, only as large as the spine, and without any background
+    h, w, _ = crop.shape
+    assert abs(w - 40) <= 2 and abs(h - 200) <= 2
+    assert np.mean(crop) > 250
+    assert np.allclose(matrix @ [200.0, 200.0, 1.0], [w / 2, h / 2])
+
+    # The longest side is turned vertical, and greyscale works too
+    grey = np.zeros((100, 300), dtype=np.uint8)
+    polygon = np.array([[10, 40], [290, 40], [290, 60], [10, 60]])
+    crop, _ = crop_polygon(grey, polygon)
+    assert crop.shape[0] > crop.shape[1]
+
+
+def test_regions_transformed() -> None:
+    """Tests mapping regions of text through affine matrices"""
+
+    regions = TextRegions(
+        horizontal=[[10, 30, 0, 100]],
+        free=[[[60, 10], [90, 10], [90, 20], [60, 20]]],
+    )
+
+    # Only moving keeps horizontal boxes horizontal
+    shifted = regions.transformed(np.array([[1.0, 0, -10], [0, 1.0, 5]]))
+    assert shifted.horizontal == [[0, 20, 5, 105]]
+    assert shifted.free == [[[50, 15], [80, 15], [80, 25], [50, 25]]]
+
+    # Scaling back up from a downscaled image
+    scaled = TextRegions(horizontal=[[5, 15, 0, 50]]).scaled(2.0)
+    assert scaled.horizontal == [[10, 30, 0, 100]]
+
+    # Rotating turns them into free boxes
+    matrix = cv.getRotationMatrix2D((0.0, 0.0), 30.0, 1.0)
+    rotated = regions.transformed(matrix)
+    assert rotated.horizontal == []
+    assert len(rotated.free) == 2
+    assert np.allclose(
+        rotated.centers(), regions.centers() @ matrix[:, :2].T, atol=1
+    )
+
+
+def test_group_regions_by_polygons() -> None:
+    """Tests assigning regions of text to the polygons that contain them"""
+
+    regions = TextRegions(
+        horizontal=[
+            [10, 30, 40, 60],  # inside the triangle and the square
+            [500, 510, 500, 510],  # outside every polygon
+        ],
+        free=[[[80, 80], [90, 80], [90, 90], [80, 90]]],  # square only
+    )
+    triangle = np.array([[0, 0], [100, 0], [0, 100]])
+    square = np.array([[0, 0], [100, 0], [100, 100], [0, 100]])
+
+    groups = group_regions_by_polygons(regions, [square, triangle])
+
+    assert groups[0].horizontal == []
+    assert groups[0].free == [[[80, 80], [90, 80], [90, 90], [80, 90]]]
+    assert groups[1].horizontal == [[10, 30, 40, 60]]
+    assert groups[1].free == []
+
+
+def test_quantized_missing(monkeypatch) -> None:
+    """Tests that the float32 models are kept if the quantized models are
+    missing"""
+
+    monkeypatch.setattr(
+        quantization,
+        "QUANTIZED_MODEL_PATHS",
+        {"detector": "missing.pt", "recognizer": "missing.pt"},
+    )
+    mock_reader = Mock()
+    detector, recognizer = mock_reader.detector, mock_reader.recognizer
+
+    TextRecognizer(mock_reader, quantized=True)
+
+    assert mock_reader.detector is detector
+    assert mock_reader.recognizer is recognizer
+
+
+def test_quantized_accuracy() -> None:
+    """Tests that the int8 models read the OCR test images about as well as
+    the float32 models"""
+
+    if not all(
+        map(os.path.exists, quantization.QUANTIZED_MODEL_PATHS.values())
+    ):
+        pytest.skip("OCR models not quantized")
+    if not all(map(os.path.exists, quantization.MODEL_PATHS.values())):
+        pytest.skip("float32 OCR models not downloaded")
+
+    reader = quantization.reader_unquantized()
+    quantized_reader = quantization.reader_unquantized()
+    assert quantization.load_quantized(quantized_reader)
+
+    for path in ("easyocr.png", "kicking.jpg", "linalg.jpg", "practical.jpg"):
+        image = cv.imread(f"tests/img/{path}")
+        assert image is not None, path
+        expected = quantization.read_all_text(reader, image)
+        actual = quantization.read_all_text(quantized_reader, image)
+        assert quantization.text_similarity(expected, actual) >= 0.8, path
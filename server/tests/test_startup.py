@@ -0,0 +1,38 @@
+from unittest.mock import Mock
+import pytest
+from tabby_server import startup
+from tabby_server.api import books
+from tabby_server.vision import image_labelling
+
+
+def test_warm_up(monkeypatch):
+    """Tests that warming up runs each model once on the bundled image"""
+
+    mock_find_books = Mock(return_value=[])
+    mock_recognizer = Mock()
+    monkeypatch.setattr(image_labelling, "find_books", mock_find_books)
+    monkeypatch.setattr(books, "get_text_recognizer", lambda: mock_recognizer)
+
+    startup.load_models()
+    startup.warm_up()
+
+    mock_find_books.assert_called_once()
+    (image_tensor,), _ = mock_find_books.call_args
+    assert image_tensor.shape == (1, 3, *image_labelling.EXPECTED_SIZE)
+
+    mock_recognizer.find_text_scaled.assert_called_once()
+    (image,), _ = mock_recognizer.find_text_scaled.call_args
+    assert image.ndim == 3
+
+    # A missing image is reported as such
+    monkeypatch.setattr(startup, "WARMUP_IMAGE_PATH", "missing.jpg")
+    with pytest.raises(FileNotFoundError):
+        startup.warm_up()
+
+
+def test_memory_usage():
+    """Tests reading the memory usage of the process"""
+
+    usage = startup.memory_usage()
+    assert usage["Rss"] > 0
+    assert usage.get("Pss", 0) <= usage["Rss"]
@@ -0,0 +1,25 @@
+import cv2 as cv
+import numpy as np
+from tabby_server.vision import text_presence
+
+
+def test_skip_reason():
+    """Tests finding spines which can't have readable text"""
+
+    # Plain binding
+    blank = np.full((400, 60, 3), 180, dtype=np.uint8)
+    assert text_presence.edge_density(blank) == 0.0
+    assert text_presence.skip_reason(blank, 8, 32, 0.005) == (
+        text_presence.NO_EDGES
+    )
+
+    # Sliver left over from a bad outline
+    sliver = np.full((400, 4, 3), 180, dtype=np.uint8)
+    assert text_presence.skip_reason(sliver, 8, 32, 0.005) == (
+        text_presence.TOO_SMALL
+    )
+
+    # Spine with a title on it
+    spine = cv.imread("tests/img/kicking.jpg")
+    assert text_presence.edge_density(spine) > 0.005
+    assert text_presence.skip_reason(spine, 8, 32, 0.005) is None
@@ -0,0 +1,73 @@
+from http import HTTPStatus
+from io import BytesIO
+import numpy as np
+from PIL import Image
+import pytest
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request
+from tabby_server.api import uploads
+
+
+def _request(data: bytes, content_length: bool = True) -> Request:
+    builder = EnvironBuilder(method="POST", input_stream=BytesIO(data))
+    environ = builder.get_environ()
+    if content_length:
+        environ["CONTENT_LENGTH"] = str(len(data))
+    else:
+        environ.pop("CONTENT_LENGTH", None)
+        environ["wsgi.input_terminated"] = True
+    return Request(environ)
+
+
+def test_read_image():
+    """Tests reading uploaded images while checking their format and size"""
+
+    with open("tests/img/cpp.jpg", "rb") as f:
+        jpeg = f.read()
+
+    # The whole image is read, with or without a length
+    assert uploads.read_image(_request(jpeg)) == jpeg
+    assert uploads.read_image(_request(jpeg, content_length=False)) == jpeg
+
+    # Not an image
+    with pytest.raises(uploads.RejectedUpload) as e:
+        uploads.read_image(_request(b"dummy file content"))
+    assert e.value.status == HTTPStatus.BAD_REQUEST
+    with pytest.raises(uploads.RejectedUpload) as e:
+        uploads.read_image(_request(b""))
+    assert e.value.status == HTTPStatus.BAD_REQUEST
+
+    # Too many bytes, with or without a length
+    with pytest.raises(uploads.RejectedUpload) as e:
+        uploads.read_image(_request(jpeg), max_bytes=len(jpeg) - 1)
+    assert e.value.status == HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+    with pytest.raises(uploads.RejectedUpload) as e:
+        uploads.read_image(
+            _request(jpeg, content_length=False), max_bytes=len(jpeg) - 1
+        )
+    assert e.value.status == HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+
+    # Too many pixels, rejected from the header before the rest is read
+    request = _request(jpeg)
+    with pytest.raises(uploads.RejectedUpload) as e:
+        uploads.read_image(request, max_pixels=4032 * 3024 - 1)
+    assert e.value.status == HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+    assert "3024x4032" in e.value.message
+    assert request.stream.read() != b""
+
+
+@pytest.mark.parametrize("image_format", ["JPEG", "PNG", "GIF", "WEBP"])
+def test_image_size(image_format: str):
+    """Tests reading the size of an image from its header"""
+
+    buffer = BytesIO()
+    Image.fromarray(np.zeros((30, 70, 3), dtype=np.uint8)).save(
+        buffer, image_format
+    )
+    data = buffer.getvalue()
+
+    assert uploads.sniff_format(data) == image_format
+    assert uploads.image_size(memoryview(data), image_format) == (70, 30)
+
+    # Not enough of the header has arrived
+    assert uploads.image_size(memoryview(data)[:8], image_format) is None
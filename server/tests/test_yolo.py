@@ -1,6 +1,9 @@
+import os
+import pytest
 import torch
 import json
 import cv2
+import numpy as np
 
 
 def test_find_books():
@@ -68,3 +71,154 @@ def test_find_books():
         result[0] is not None
         and result[0]["confidence"] == test_output[0]["confidence"]
     )
+
+
+def test_letterbox():
+    """
+    Letterboxes images of different shapes and checks that boxes are mapped
+    back to where they were in the original image.
+    """
+
+    from tabby_server.vision.image_labelling import Letterboxer, PAD_VALUE
+
+    letterboxer = Letterboxer()
+
+    # Tall image: scaled to 320x640, padded on the left and right
+    image = np.zeros((1280, 640, 3), dtype=np.uint8)
+    image[:, :, 0] = 255  # Blue in BGR
+    tensor, letterbox = letterboxer.letterbox(image)
+
+    assert tensor.shape == (1, 3, 640, 640)
+    assert tensor.dtype == torch.float32
+    assert letterbox.scale == 0.5
+    assert (letterbox.pad_x, letterbox.pad_y) == (160, 0)
+    assert tensor[0, :, 0, 0].tolist() == pytest.approx([PAD_VALUE / 255] * 3)
+    assert tensor[0, :, 320, 320].tolist() == [0.0, 0.0, 1.0]  # RGB
+
+    box = {"x1": 160.0, "y1": 10.0, "x2": 170.5, "y2": 640.0}
+    assert letterbox.box_to_image(box) == (0, 20, 21, 1280)
+
+    # Boxes in the padding are clipped to the image
+    box = {"x1": 0.0, "y1": 0.0, "x2": 100.0, "y2": 100.0}
+    x1, y1, x2, y2 = letterbox.box_to_image(box)
+    assert x1 == x2 == 0
+
+    # Wide image, reusing the same buffer
+    image = np.full((100, 400, 3), 255, dtype=np.uint8)
+    tensor_wide, letterbox = letterboxer.letterbox(image)
+
+    assert tensor_wide.data_ptr() == tensor.data_ptr()
+    assert letterbox.scale == 1.6
+    assert (letterbox.pad_x, letterbox.pad_y) == (0, 240)
+    assert tensor_wide[0, :, 0, 0].tolist() == pytest.approx(
+        [PAD_VALUE / 255] * 3
+    )
+    assert tensor_wide.max() == 1.0
+
+    box = {"x1": 0.0, "y1": 240.0, "x2": 640.0, "y2": 400.0}
+    assert letterbox.box_to_image(box) == (0, 0, 400, 100)
+
+
+def test_tile_regions():
+    """
+    Divides images into overlapping tiles, from their aspect ratio.
+    """
+
+    from tabby_server.vision.image_labelling import tile_regions
+
+    # Photos of a normal shape aren't tiled
+    assert tile_regions(2016, 1512, 6) == [(0, 0, 2016, 1512)]
+
+    # Wide panorama: square tiles across its whole height
+    tiles = tile_regions(4000, 1000, 6)
+    assert len(tiles) == 5
+    assert tiles[0] == (0, 0, 1000, 1000)
+    assert tiles[-1] == (3000, 0, 4000, 1000)
+    for (x1, _, x2, _), (next_x1, _, _, _) in zip(tiles, tiles[1:]):
+        assert x2 - next_x1 == 250  # Overlap
+
+    # Tall image, with fewer tiles than its aspect ratio calls for
+    tiles = tile_regions(500, 2000, 2)
+    assert [(x1, x2) for x1, _, x2, _ in tiles] == [(0, 500)] * 2
+    assert tiles[0][1] == 0 and tiles[-1][3] == 2000
+    assert tiles[0][3] > tiles[1][1]
+
+    # Tiling turned off
+    assert tile_regions(4000, 1000, 1) == [(0, 0, 4000, 1000)]
+
+
+def test_find_books_tiled(monkeypatch):
+    """
+    Finds books in the tiles of a panorama, merging books found in more than
+    one tile.
+    """
+
+    from tabby_server.vision import image_labelling
+
+    def box(x1, x2, confidence):
+        return {
+            "box": {"x1": x1, "y1": 100.0, "x2": x2, "y2": 500.0},
+            "confidence": confidence,
+        }
+
+    # Tiles of 1000x1000 at x = 0, 750, 1500, 2250 and 3000, scaled to 640
+    results = [
+        [box(64.0, 128.0, 0.9), box(600.0, 640.0, 0.9)],  # Second one is cut
+        [box(16.0, 160.0, 0.8)],  # Same book as the cut one, whole
+        [box(320.0, 384.0, 0.7)],
+        [],
+        [box(320.0, 384.0, 0.6), box(320.0, 384.0, 0.5)],  # Not merged
+    ]
+    monkeypatch.setattr(
+        image_labelling,
+        "find_books_together",
+        lambda tensor: results[: len(tensor)],
+    )
+
+    image = np.zeros((1000, 4000, 3), dtype=np.uint8)
+    found = image_labelling.find_books_tiled(image, 6)
+    boxes = [letterbox.box_to_image(r["box"]) for r, letterbox in found]
+    assert boxes == [
+        (100, 156, 200, 782),
+        (775, 156, 1000, 782),
+        (2000, 156, 2100, 782),
+        (3500, 156, 3600, 782),
+        (3500, 156, 3600, 782),
+    ]
+
+
+@pytest.mark.parametrize(
+    "backend,runtime", [("onnx", "onnxruntime"), ("openvino", "openvino")]
+)
+def test_backend_parity(backend, runtime, monkeypatch):
+    """
+    Checks that the model exported for another backend finds the same books
+    as the PyTorch model, within a small tolerance.
+
+    Skipped if the model hasn't been exported with scripts/export_yolo.py.
+    """
+
+    from tabby_server.vision import image_labelling
+
+    if not os.path.exists(image_labelling.MODEL_PATHS[backend]):
+        pytest.skip(f"Model not exported for {backend}")
+    pytest.importorskip(runtime)
+
+    image = cv2.imread("tests/yolo_example.jpg")
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    image = cv2.resize(image, (640, 640)) / 255.0
+    tensor = torch.from_numpy(image).float().permute(2, 0, 1).unsqueeze(0)
+
+    results = {}
+    for name in ("torch", backend):
+        monkeypatch.setattr(
+            image_labelling, "model", image_labelling.load_model(name)
+        )
+        books = image_labelling.find_books(tensor)
+        results[name] = sorted(books, key=lambda b: b["box"]["x1"])
+
+    assert len(results["torch"]) == len(results[backend])
+    for expected, actual in zip(results["torch"], results[backend]):
+        for key in ("x1", "x2", "y1", "y2"):
+            assert abs(expected["box"][key] - actual["box"][key]) <= 2.0
+        assert abs(expected["confidence"] - actual["confidence"]) <= 0.02